@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Measure the time from process start to the first successful GET /messages/latest
+
+Starts the service (python app.py or the PyInstaller executable) several times and prints
+how long the port took to accept requests and how long until /messages/latest returned 200.
+EMAIL_ID, EMAIL_PASS and EMAIL_HOST must point at a mailbox with at least one message.
+
+Usage:
+  python benchmarks/startup_benchmark.py
+  python benchmarks/startup_benchmark.py --runs 10 --command dist/imap-json-proxy
+  IMAP_PREWARM_SESSIONS=1 python benchmarks/startup_benchmark.py
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import urllib.error
+import urllib.request
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'flaskapp')
+
+def wait_for(url: str, process: subprocess.Popen, timeout: float) -> float:
+  """Poll url until it returns 200
+
+  Returns:
+    Seconds until the first 200 response
+
+  Raises:
+    RuntimeError: If the service exits or does not answer within timeout
+  """
+  started = time.perf_counter()
+  while time.perf_counter() - started < timeout:
+    if process.poll() is not None:
+      raise RuntimeError(f"Service exited with code {process.returncode}")
+    try:
+      with urllib.request.urlopen(url, timeout=timeout) as response:
+        if response.status == 200:
+          return time.perf_counter() - started
+    except (urllib.error.URLError, OSError):
+      pass
+    time.sleep(0.01)
+  raise RuntimeError(f"No 200 response from {url} within {timeout} seconds")
+
+def run_once(command: list, base_url: str, timeout: float) -> tuple:
+  """Returns:
+    Tuple (seconds until / answered, seconds until /messages/latest answered)
+  """
+  started = time.perf_counter()
+  process = subprocess.Popen(command, cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    wait_for(f"{base_url}/", process, timeout)
+    listening = time.perf_counter() - started
+    wait_for(f"{base_url}/messages/latest", process, timeout)
+    return listening, time.perf_counter() - started
+  finally:
+    process.terminate()
+    process.wait()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--command', help="Executable to start instead of python app.py")
+  parser.add_argument('--url', default="http://127.0.0.1:8000")
+  parser.add_argument('--timeout', type=float, default=60)
+  args = parser.parse_args()
+
+  missing = [name for name in ('EMAIL_ID', 'EMAIL_PASS', 'EMAIL_HOST') if name not in os.environ]
+  if missing:
+    sys.exit(f"Missing required environment variables: {', '.join(missing)}")
+
+  command = [os.path.abspath(args.command)] if args.command else [sys.executable, 'app.py']
+  results = []
+  for run in range(1, args.runs + 1):
+    listening, first_message = run_once(command, args.url, args.timeout)
+    results.append((listening, first_message))
+    print(f"run {run}: listening {listening * 1000:.0f} ms, first /messages/latest {first_message * 1000:.0f} ms")
+
+  print(f"median: listening {statistics.median(r[0] for r in results) * 1000:.0f} ms, "
+    f"first /messages/latest {statistics.median(r[1] for r in results) * 1000:.0f} ms")
+
+if __name__ == '__main__':
+  main()
@@ -5,17 +5,36 @@ import sys
 import uvicorn
 import logging
 import imaplib
+import hashlib
+import tempfile
+import time
 from typing import Union
+from contextlib import contextmanager, ExitStack
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.openapi.utils import get_openapi
-from imapreader import IMAPReader
-from helpers import email_messages_to_messages_dict
+from imapreader import IMAPReader, MailboxNotFound
+from helpers import email_message_to_dict, email_messages_to_messages_dict, env_flag, file_response_with_range
+from exporter import ExportManager, EXPORT_FORMATS
+from scheduler import SessionScheduler, QueueFull, SchedulerBusy
+from cache import TTLCache, MessageIdIndex, MessageCache
+from threads import ThreadIndex, summarize_thread
+from webhooks import WebhookStore, WebhookManager
+from sharedstore import SharedStore, SharedSync
+from locks import LeaderLock
+from profiling import ProfiledRoute, ProfilingMiddleware, ProfileStore, admin_token_valid, phase
+import metrics
 
 app = FastAPI()
+# Lets ?profile=1 requests run their endpoint under cProfile, see profiling.py
+app.router.route_class = ProfiledRoute
 
 def my_schema():
+   # Built once, on the first /openapi.json or /docs request
+   if app.openapi_schema:
+     return app.openapi_schema
    openapi_schema = get_openapi(
        title="IMAP to JSON API",
        version="1.0",
@@ -35,7 +54,173 @@ except KeyError:
   sys.exit("Missing required environment variables: EMAIL_ID, EMAIL_PASS and / or EMAIL_HOST")
 
 
-reader = IMAPReader(email_id=email_id, email_password=email_pass, email_host=email_host)
+imap_compress = env_flag('IMAP_COMPRESS', default=True)
+
+export_dir = os.environ.get('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'imap-json-proxy-exports'))
+
+message_id_index = MessageIdIndex(int(os.environ.get('MESSAGE_ID_INDEX_SIZE', 100000)))
+
+thread_index = ThreadIndex(int(os.environ.get('THREAD_INDEX_SIZE', 100000)))
+
+# Parsed messages kept in memory, 0 disables the cache
+message_cache_bytes = int(os.environ.get('MESSAGE_CACHE_BYTES', 64 * 1024 * 1024))
+message_cache = MessageCache(message_cache_bytes) if message_cache_bytes > 0 else None
+
+def new_reader() -> IMAPReader:
+  return IMAPReader(email_id=email_id, email_password=email_pass, email_host=email_host, compress=imap_compress,
+    message_id_index=message_id_index, thread_index=thread_index, message_cache=message_cache)
+
+# Server wide request deadline, 0 (the default) disables it. Requests can override it with ?timeout_ms=
+# Off by default so clients that do not read X-Partial-Result never get a cut short list
+default_timeout_ms = int(os.environ.get('REQUEST_TIMEOUT_MS', 0))
+
+def request_deadline(timeout_ms: Union[int, None] = None) -> Union[float, None]:
+  """time.monotonic() value the request has to finish by, None for no limit"""
+  if timeout_ms is None:
+    timeout_ms = default_timeout_ms
+  if timeout_ms <= 0:
+    return None
+  return time.monotonic() + timeout_ms / 1000
+
+scheduler = SessionScheduler(
+  new_reader,
+  max_sessions=int(os.environ.get('IMAP_MAX_SESSIONS', 4)),
+  max_queue=int(os.environ.get('IMAP_QUEUE_SIZE', 16)),
+  queue_timeout=float(os.environ.get('IMAP_QUEUE_TIMEOUT', 10)),
+  idle_timeout=float(os.environ.get('IMAP_IDLE_TIMEOUT', 300)),
+  max_background=int(os.environ['IMAP_MAX_BACKGROUND_SESSIONS']) if 'IMAP_MAX_BACKGROUND_SESSIONS' in os.environ else None,
+)
+
+# IMAP sessions logged in in the background at startup so the first requests skip the login
+prewarm_sessions = int(os.environ.get('IMAP_PREWARM_SESSIONS', 0))
+
+@contextmanager
+def imap_session(deadline: float = None):
+  """Logged in IMAPReader for the duration of a request
+
+  Raises:
+    HTTPException: 429 / 503 with Retry-After when no session is available, 500 if login fails,
+      504 if the IMAP server does not answer before the deadline, 404 if the mailbox does not exist
+  """
+  def deadline_exceeded(error):
+    if isinstance(error, TimeoutError) or (deadline is not None and time.monotonic() >= deadline):
+      return HTTPException(status_code = 504, detail = "IMAP server did not respond before the deadline")
+    return None
+
+  stack = ExitStack()
+  try:
+    with phase('session'):
+      reader = stack.enter_context(scheduler.session(deadline))
+  except (imaplib.IMAP4.abort, OSError) as error:
+    raise deadline_exceeded(error) or error
+  except SchedulerBusy as error:
+    status_code = 429 if isinstance(error, QueueFull) else 503
+    raise HTTPException(status_code = status_code, detail = str(error), headers = {'Retry-After': str(error.retry_after)})
+  except imaplib.IMAP4.error as error:
+    # Strip b'' from error message e.g. b'LOGIN failed.' becomes LOGIN failed.
+    error_message = str(error).replace("b'", "").replace("'", "")
+    raise HTTPException(status_code = 500, detail = f"Something went wrong ... {error_message}")
+  # Sessions are reused, clear the previous request's result
+  reader.partial = False
+  reader.cursor = None
+  try:
+    with stack:
+      yield reader
+  except (imaplib.IMAP4.abort, OSError) as error:
+    raise deadline_exceeded(error) or error
+  except MailboxNotFound as error:
+    raise HTTPException(status_code = 404, detail = str(error))
+
+def set_partial_result_headers(response: Response, reader: IMAPReader, cursor: Union[int, None] = None) -> None:
+  """Mark a list of messages cut short by the deadline
+
+  X-Partial-Result: true
+  X-Continuation-Cursor: <uid>, repeat the request with ?cursor=<uid> for the older messages
+  """
+  if not reader.partial:
+    return
+  response.headers['X-Partial-Result'] = 'true'
+  continuation_cursor = reader.cursor or cursor
+  if continuation_cursor:
+    response.headers['X-Continuation-Cursor'] = str(continuation_cursor)
+
+# Per request profiling needs ADMIN_TOKEN (sent as X-Admin-Token) and ?profile=1,
+# PROFILING_ENABLED profiles every request
+admin_token = os.environ.get('ADMIN_TOKEN')
+profile_store = ProfileStore(
+  os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'imap-json-proxy-profiles')),
+  max_profiles=int(os.environ.get('PROFILE_KEEP', 20)),
+)
+app.add_middleware(ProfilingMiddleware, store=profile_store, admin_token=admin_token, always=env_flag('PROFILING_ENABLED'))
+
+def require_admin(request: Request) -> None:
+  """Raises:
+    HTTPException: 404 if no ADMIN_TOKEN is configured, 403 if X-Admin-Token does not match
+  """
+  if not admin_token:
+    raise HTTPException(status_code = 404, detail = "Not Found")
+  if not admin_token_valid(request.headers.get('x-admin-token', ''), admin_token):
+    raise HTTPException(status_code = 403, detail = "Invalid admin token")
+
+mailbox_status_cache = TTLCache(float(os.environ.get('MAILBOX_STATUS_TTL', 5)))
+
+# Exports wait behind requests for as long as it takes
+exports = ExportManager(export_dir, lambda: scheduler.session(background=True), max_exports=int(os.environ.get('EXPORT_MAX_COUNT', 20)))
+
+# Cross-process mode for uvicorn --workers, one worker syncs INBOX into a shared SQLite
+# database and every worker serves the message lists from it
+shared_store_path = os.environ.get('SHARED_STORE_PATH')
+shared_store = None
+shared_sync = None
+shared_sync_interval = float(os.environ.get('SHARED_SYNC_INTERVAL', 30))
+# Without a sync for this long (e.g. the IMAP server is down) requests go to IMAP again
+shared_store_max_age = float(os.environ.get('SHARED_STORE_MAX_AGE', 3 * shared_sync_interval))
+if shared_store_path:
+  shared_store = SharedStore(shared_store_path)
+  shared_sync = SharedSync(
+    shared_store,
+    LeaderLock(shared_store_path + '.lock'),
+    lambda: scheduler.session(background=True),
+    interval=shared_sync_interval,
+  )
+
+# One database per mailbox, proxies for different accounts on the same host must not share subscriptions
+webhook_db = os.environ.get('WEBHOOK_DB') or os.path.join(
+  tempfile.gettempdir(), f"imap-json-proxy-webhooks-{hashlib.sha256(f'{email_id}@{email_host}'.encode('utf-8')).hexdigest()[:16]}.db")
+webhooks = WebhookManager(
+  WebhookStore(webhook_db),
+  lambda: scheduler.session(background=True),
+  # Workers sharing the database elect one poller
+  lock=LeaderLock(webhook_db + '.lock'),
+  interval=float(os.environ.get('WEBHOOK_POLL_INTERVAL', 30)),
+  concurrency=int(os.environ.get('WEBHOOK_CONCURRENCY', 2)),
+  max_attempts=int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 8)),
+)
+
+@app.on_event('startup')
+def start_background_tasks():
+  if prewarm_sessions > 0:
+    scheduler.prewarm(prewarm_sessions)
+  if shared_sync is not None:
+    shared_sync.start()
+  # Otherwise the poller starts with the first subscription
+  if webhooks.store.exists() and webhooks.store.subscriptions():
+    webhooks.start()
+
+@app.on_event('shutdown')
+def stop_background_tasks():
+  if shared_sync is not None:
+    shared_sync.stop()
+  webhooks.stop()
+
+def stored_messages(limit: Union[int, None] = None, before_uid: Union[int, None] = None) -> Union[list, None]:
+  """INBOX messages from the shared store, None when shared mode is off or the last finished sync is older than SHARED_STORE_MAX_AGE"""
+  if shared_store is None or not shared_store.synced(max_age=shared_store_max_age):
+    return None
+  messages = shared_store.messages(limit=limit, before_uid=before_uid)
+  for message in messages:
+    message.pop('uid', None)
+  return messages
 
 responses = {
     500: { 
@@ -78,6 +263,15 @@ response_list_of_messages = {
 def index():
     return{'version': '1.0.0-beta'}
 
+@app.get('/metrics')
+def get_metrics():
+  """Get service counters e.g. IMAP bytes before (imap_bytes_*) and after (imap_bytes_*_wire) compression"""
+  counters = metrics.snapshot()
+  if message_cache is not None:
+    counters['message_cache_bytes'] = message_cache.size
+    counters['message_cache_entries'] = len(message_cache)
+  return counters
+
 @app.get('/messages/latest', responses={**responses, 
     200: {
       "description": "Get latest email message",
@@ -94,25 +288,22 @@ def index():
       },
     },
 })
-def get_latest():
+def get_latest(timeout_ms: Union[int, None] = None):
   """Get the latest / most recent message in the mailbox"""
-  try:
-    reader.login()
-  except imaplib.IMAP4.error as error:
-    # Strip b'' from error message e.g. b'LOGIN failed.' becomes LOGIN failed.
-    error_message = str(error).replace("b'", "").replace("'", "")
-    raise HTTPException(status_code = 500, detail = f"Something went wrong ... {error_message}")
-  
-  
-  message = reader.get_mail()[0]
-  subject = message.get('Subject')
-  date = message.get('Date')
-  email_from = message.get('From')
-  email_to = message.get('To')
-  email_body = reader.get_email_body(message, format='plain')
-
-  reader.close()
-  
+  messages = stored_messages(limit=1)
+  if messages:
+    return messages[0]
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    messages = reader.get_mail(limit=1)
+    if not messages and reader.partial:
+      raise HTTPException(status_code = 504, detail = "IMAP server did not respond before the deadline")
+    message = messages[0]
+    subject = message.get('Subject')
+    date = message.get('Date')
+    email_from = message.get('From')
+    email_to = message.get('To')
+    email_body = reader.get_email_body(message, format='plain')
+
   return {
     'to': email_to,
     'from': email_from,
@@ -122,46 +313,56 @@ def get_latest():
     }
 
 @app.get('/messages/all', responses={**responses, **response_list_of_messages})
-def get_all():
-  """Get all messages in the mailbox"""
-  try:
-    reader.login()
-  except imaplib.IMAP4.error as error:
-    # Strip b'' from error message e.g. b'LOGIN failed.' becomes LOGIN failed.
-    error_message = str(error).replace("b'", "").replace("'", "")
-    raise HTTPException(status_code = 500, detail = f"Something went wrong ... {error_message}")
-  messages = reader.get_mail()
+def get_all(response: Response, timeout_ms: Union[int, None] = None, cursor: Union[int, None] = None):
+  """Get all messages in the mailbox
+
+  If timeout_ms (or the server default) passes, the messages fetched so far are returned with a
+  X-Partial-Result header and X-Continuation-Cursor to pass as cursor to continue.
+  """
+  messages_dict = stored_messages(before_uid=cursor)
+  if messages_dict is not None:
+    return messages_dict
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    messages = reader.get_mail(before_uid=cursor) if cursor else reader.get_mail()
+
+    messages_dict = email_messages_to_messages_dict(reader, messages)
+    set_partial_result_headers(response, reader, cursor)
 
-  messages_dict = email_messages_to_messages_dict(reader, messages)
-  
-  reader.close()
   return messages_dict
 
 @app.get('/messages/last', responses={**responses, **response_list_of_messages})
-def get_last_n_messages(count: int = 1): 
-  """Get the last n most recent messages in the mailbox"""
-  try:
-    reader.login()
-  except imaplib.IMAP4.error as error:
-    # Strip b'' from error message e.g. b'LOGIN failed.' becomes LOGIN failed.
-    error_message = str(error).replace("b'", "").replace("'", "")
-    raise HTTPException(status_code = 500, detail = f"Something went wrong ... {error_message}")
-  messages = reader.get_mail()[:count]
+def get_last_n_messages(response: Response, count: int = 1, timeout_ms: Union[int, None] = None, cursor: Union[int, None] = None):
+  """Get the last n most recent messages in the mailbox, see /messages/all for timeout_ms and cursor"""
+  messages_dict = stored_messages(limit=max(count, 0), before_uid=cursor)
+  if messages_dict is not None:
+    return messages_dict
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    messages = reader.get_mail(before_uid=cursor, limit=max(count, 0))
+
+    messages_dict = email_messages_to_messages_dict(reader, messages)
+    set_partial_result_headers(response, reader, cursor)
 
-  messages_dict = email_messages_to_messages_dict(reader, messages)
-  
-  reader.close()
   return messages_dict
 
 @app.get('/messages/search', responses={**responses, **response_list_of_messages})
-def search_by(subject: Union[str, None] = None, 
+def search_by(response: Response,
+    subject: Union[str, None] = None, 
     body: Union[str, None] = None, 
-    datetime: Union[str, None] = None):
-  """Search by subject, body or date"""
+    datetime: Union[str, None] = None,
+    since: Union[str, None] = None,
+    until: Union[str, None] = None,
+    timeout_ms: Union[int, None] = None,
+    cursor: Union[int, None] = None):
+  """Search by subject, body or date
+
+  since / until are ISO 8601 date times compared with the time the server received the message,
+  since is inclusive and until is exclusive. datetime is the same as since.
+  See /messages/all for timeout_ms and cursor.
+  """
   
   subject_unsanitized = subject
   body_unsanitized = body
-  datetime_unsanitized = datetime
+  datetime_unsanitized = datetime if datetime != None else since
 
   parameter_count = 0
   if subject_unsanitized != None:
@@ -170,40 +371,314 @@ def search_by(subject: Union[str, None] = None,
   if body_unsanitized != None:
     parameter_count += 1
   
-  if datetime_unsanitized != None:
+  if datetime != None and since != None:
+    parameter_count += 1
+
+  if datetime_unsanitized != None or until != None:
     parameter_count += 1
   
   if parameter_count > 1:
     raise HTTPException(status_code = 400, detail = "Too many paremeters received.")
 
-  try:
-    reader.login()
-  except imaplib.IMAP4.error as error:
-    # Strip b'' from error message e.g. b'LOGIN failed.' becomes LOGIN failed.
-    error_message = str(error).replace("b'", "").replace("'", "")
-    raise HTTPException(status_code = 500, detail = f"Something went wrong ... {error_message}")
+  if parameter_count == 0:
+    raise HTTPException(status_code = 400, detail = "subject, body or datetime is required")
 
-  # Subject only
-  if subject_unsanitized and not body_unsanitized and not datetime_unsanitized:
-    messages = reader.get_emails_with_subject(subject_unsanitized)
-  # Body only
-  elif body_unsanitized and not subject_unsanitized and not datetime_unsanitized:
-    messages = reader.get_emails_with_body(body_unsanitized)
-  # Date / time only
-  elif datetime_unsanitized and not subject_unsanitized and not body_unsanitized:
+  since_date_time = None
+  until_date_time = None
+  if datetime_unsanitized != None or until != None:
     try:
-      messages = reader.get_emails_since_date(datetime_unsanitized)
+      since_date_time = IMAPReader.parse_iso8601_datetime(datetime_unsanitized) if datetime_unsanitized != None else None
+      until_date_time = IMAPReader.parse_iso8601_datetime(until) if until != None else None
     except ValueError as error:
-      raise HTTPException(status_code = 400, detail = "Invalid ISO 8601 string")  
-  else:
-    raise HTTPException(status_code = 400, detail = "subject, body or datetime is required")
+      raise HTTPException(status_code = 400, detail = "Invalid ISO 8601 string")
 
-  messages_dict = email_messages_to_messages_dict(reader, messages)
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    # Subject only
+    if subject_unsanitized:
+      messages = reader.get_emails_with_subject(subject_unsanitized, before_uid=cursor)
+    # Body only
+    elif body_unsanitized:
+      messages = reader.get_emails_with_body(body_unsanitized, before_uid=cursor)
+    # Date / time only
+    elif since_date_time or until_date_time:
+      messages = reader.get_emails_between(since_date_time, until_date_time, before_uid=cursor)
+    else:
+      raise HTTPException(status_code = 400, detail = "subject, body or datetime is required")
+
+    messages_dict = email_messages_to_messages_dict(reader, messages)
+    set_partial_result_headers(response, reader, cursor)
 
-  reader.close()
   return messages_dict
 
 
+response_single_message = {
+  200: {
+    "description": "Get a single email message",
+    "content": {
+      "application/json": {
+        "example": {
+            "uid": 42,
+            "to": "recipient@example.com",
+            "from": "sender@example.com",
+            "subject": "Email subject",
+            "date": "Wed, 15 Mar 2023 17:26:42 +0000",
+            "body": "Email body in plain text"
+        }
+      }
+    },
+  },
+  404: {"description": "Message not found"},
+}
+
+@app.get('/messages/by-message-id/{message_id:path}', responses={**responses, **response_single_message})
+def get_by_message_id(message_id: str, mailbox: str = 'INBOX', timeout_ms: Union[int, None] = None):
+  """Get one message by its Message-ID header, with or without the angle brackets"""
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    result = reader.get_email_by_message_id(message_id, mailbox)
+    if result is None:
+      raise HTTPException(status_code = 404, detail = "Message not found")
+    uid, message = result
+    message_dict = email_message_to_dict(reader, message)
+  return {'uid': uid, **message_dict}
+
+@app.get('/messages/{uid}', responses={**responses, **response_single_message})
+def get_by_uid(uid: int, mailbox: str = 'INBOX', timeout_ms: Union[int, None] = None):
+  """Get one message by UID"""
+  if mailbox == 'INBOX' and shared_store is not None and shared_store.synced(max_age=shared_store_max_age):
+    message_dict = shared_store.message(uid)
+    if message_dict is not None:
+      return {'uid': uid, **{key: value for key, value in message_dict.items() if key != 'uid'}}
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    message = reader.get_email_by_uid(uid, mailbox)
+    if message is None:
+      raise HTTPException(status_code = 404, detail = "Message not found")
+    message_dict = email_message_to_dict(reader, message)
+  return {'uid': uid, **message_dict}
+
+@app.get('/messages/{uid}/raw', response_class=StreamingResponse, responses={
+    **responses,
+    200: {"description": "Original message bytes", "content": {"message/rfc822": {}}},
+    404: {"description": "Message not found"},
+})
+def get_raw_by_uid(uid: int, mailbox: str = 'INBOX', timeout_ms: Union[int, None] = None):
+  """Get the original message (message/rfc822), streamed as it is read from the IMAP server without parsing"""
+  with ExitStack() as stack:
+    reader = stack.enter_context(imap_session(request_deadline(timeout_ms)))
+    raw_message = reader.open_raw_message(uid, mailbox)
+    if raw_message is None:
+      raise HTTPException(status_code = 404, detail = "Message not found")
+    # Keep the session until the body has been sent
+    session = stack.pop_all()
+
+  size, chunks = raw_message
+
+  def stream():
+    with session:
+      yield from chunks
+
+  return StreamingResponse(
+    stream(),
+    media_type='message/rfc822',
+    headers={'Content-Length': str(size)},
+    # Releases the session if the client goes away before the stream starts
+    background=BackgroundTask(session.close)
+  )
+
+@app.get('/mailboxes')
+def get_mailboxes(timeout_ms: Union[int, None] = None):
+  """List mailboxes with message counts (messages, unseen, recent, uidnext, uidvalidity, highestmodseq) without fetching any messages"""
+  mailboxes = mailbox_status_cache.get('LIST')
+  if mailboxes is None:
+    with imap_session(request_deadline(timeout_ms)) as reader:
+      mailboxes = reader.list_mailboxes()
+    mailbox_status_cache.set('LIST', mailboxes)
+  return mailboxes
+
+@app.get('/mailboxes/{name:path}/status')
+def get_mailbox_status(name: str, timeout_ms: Union[int, None] = None):
+  """Get message counts for one mailbox with a single STATUS command"""
+  status = mailbox_status_cache.get(('STATUS', name))
+  if status is None:
+    with imap_session(request_deadline(timeout_ms)) as reader:
+      try:
+        status = reader.get_mailbox_status(name)
+      except imaplib.IMAP4.abort:
+        raise
+      except imaplib.IMAP4.error:
+        status = None
+    if status is None:
+      raise HTTPException(status_code = 404, detail = "Mailbox not found")
+    mailbox_status_cache.set(('STATUS', name), status)
+  return {'name': name, **status}
+
+@app.get('/threads', responses={**responses,
+    200: {
+      "description": "Page of conversation threads, newest first",
+      "content": {
+        "application/json": {
+          "example": {
+            "page": 1,
+            "page_size": 20,
+            "total": 1,
+            "threads": [{
+              "id": 40,
+              "subject": "Email subject",
+              "count": 2,
+              "last_date": "Wed, 15 Mar 2023 17:26:42 +0000",
+              "participants": ["sender@example.com", "recipient@example.com"],
+              "uids": [40, 42]
+            }]
+          }
+        }
+      },
+    },
+})
+def get_threads(mailbox: str = 'INBOX', page: int = 1, page_size: int = 20, timeout_ms: Union[int, None] = None):
+  """List conversation threads with the newest activity first, only headers are fetched
+
+  The thread id is the lowest UID in the thread. page_size is at most 100.
+  """
+  if page < 1 or page_size < 1 or page_size > 100:
+    raise HTTPException(status_code = 400, detail = "page must be at least 1 and page_size between 1 and 100")
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    threads = reader.get_threads(mailbox)
+    page_threads = threads[(page - 1) * page_size:page * page_size]
+    records = reader.get_thread_records([uid for uids in page_threads for uid in uids])
+  return {
+    'page': page,
+    'page_size': page_size,
+    'total': len(threads),
+    'threads': [summarize_thread(uids, records) for uids in page_threads]
+    }
+
+@app.get('/threads/{thread_id}', responses={**responses, 404: {"description": "Thread not found"}})
+def get_thread(thread_id: int, mailbox: str = 'INBOX', timeout_ms: Union[int, None] = None):
+  """Get one thread with the headers of its messages, oldest first. Bodies are available from /messages/{uid}"""
+  with imap_session(request_deadline(timeout_ms)) as reader:
+    uids = next((uids for uids in reader.get_threads(mailbox) if uids[0] == thread_id), None)
+    if uids is None:
+      raise HTTPException(status_code = 404, detail = "Thread not found")
+    records = reader.get_thread_records(uids)
+  messages = []
+  for uid in uids:
+    record = records.get(uid) or {}
+    messages.append({'uid': uid, **{key: record.get(key) for key in ('message_id', 'from', 'to', 'cc', 'subject', 'date')}})
+  return {**summarize_thread(uids, records), 'messages': messages}
+
+@app.post('/webhooks', status_code=201, responses={400: {"description": "Invalid URL"}})
+def create_webhook(url: str, subject: Union[str, None] = None, sender: Union[str, None] = Query(default=None, alias='from')):
+  """Subscribe a URL to new INBOX messages, optionally only those whose subject / from contain the given text
+
+  New messages are POSTed as JSON {"subscription_id", "delivery_id", "mailbox", "messages": [...]}
+  in batches. Failed deliveries are retried with backoff.
+  """
+  try:
+    subscription = webhooks.subscribe(url, subject, sender)
+  except ValueError as error:
+    raise HTTPException(status_code = 400, detail = str(error))
+  webhooks.start()
+  return subscription
+
+@app.get('/webhooks')
+def list_webhooks():
+  """List webhook subscriptions"""
+  return webhooks.store.subscriptions()
+
+@app.get('/webhooks/{subscription_id}', responses={404: {"description": "Subscription not found"}})
+def get_webhook(subscription_id: str):
+  """Get a webhook subscription with its number of pending and failed deliveries"""
+  subscription = webhooks.store.subscription(subscription_id)
+  if subscription is None:
+    raise HTTPException(status_code = 404, detail = "Subscription not found")
+  return subscription
+
+@app.delete('/webhooks/{subscription_id}', status_code=204, responses={404: {"description": "Subscription not found"}})
+def delete_webhook(subscription_id: str):
+  """Remove a webhook subscription and its undelivered messages"""
+  if not webhooks.store.remove_subscription(subscription_id):
+    raise HTTPException(status_code = 404, detail = "Subscription not found")
+  return Response(status_code = 204)
+
+@app.post('/export', status_code=202, responses=responses)
+def create_export(format: str = 'jsonl', since: Union[str, None] = None, until: Union[str, None] = None):
+  """Start a background export of the mailbox as JSON lines or mbox
+
+  since and until are dates (YYYY-MM-DD) compared with the date the server received the message,
+  until is inclusive. Unlike /messages/search a time is not accepted.
+  Poll /export/{job_id} for progress and download from /export/{job_id}/download when complete.
+  """
+  try:
+    job = exports.create(format, since, until)
+  except ValueError as error:
+    raise HTTPException(status_code = 400, detail = str(error))
+  exports.start(job)
+  return job.to_dict()
+
+@app.get('/export/{job_id}')
+def get_export(job_id: str):
+  """Get the status of an export"""
+  job = exports.get(job_id)
+  if job is None:
+    raise HTTPException(status_code = 404, detail = "Export not found")
+  return job.to_dict()
+
+@app.post('/export/{job_id}/resume', status_code=202)
+def resume_export(job_id: str):
+  """Resume a failed export from its last completed batch"""
+  job = exports.get(job_id)
+  if job is None:
+    raise HTTPException(status_code = 404, detail = "Export not found")
+  if job.status == 'failed':
+    try:
+      exports.start(job)
+    except RuntimeError as error:
+      raise HTTPException(status_code = 409, detail = str(error))
+  return job.to_dict()
+
+@app.get('/export/{job_id}/download')
+def download_export(job_id: str, request: Request):
+  """Download a completed export, supports HTTP Range requests"""
+  job = exports.get(job_id)
+  if job is None:
+    raise HTTPException(status_code = 404, detail = "Export not found")
+  if job.status != 'complete':
+    raise HTTPException(status_code = 409, detail = f"Export is {job.status}")
+  return file_response_with_range(
+    exports.export_path(job),
+    request.headers.get('range'),
+    media_type=EXPORT_FORMATS[job.format],
+    filename=f"export-{job.id}.{job.format}"
+  )
+
+@app.delete('/export/{job_id}', status_code=204)
+def delete_export(job_id: str):
+  """Delete an export and its file"""
+  try:
+    deleted = exports.delete(job_id)
+  except RuntimeError as error:
+    raise HTTPException(status_code = 409, detail = str(error))
+  if not deleted:
+    raise HTTPException(status_code = 404, detail = "Export not found")
+  return Response(status_code = 204)
+
+@app.get('/admin/profiles/{profile_id}', responses={
+    200: {"description": "cProfile data in pstats format, or the top functions as text with format=text", "content": {"application/octet-stream": {}, "text/plain": {}}},
+    404: {"description": "Profile not found"},
+})
+def get_profile(profile_id: str, request: Request, format: str = 'pstats'):
+  """Download the profile of a request made with ?profile=1, the id is in its X-Profile-Id header
+
+  Load it with python -m pstats or snakeviz. Requires the X-Admin-Token header.
+  """
+  require_admin(request)
+  path = profile_store.path(profile_id)
+  if path is None:
+    raise HTTPException(status_code = 404, detail = "Profile not found")
+  if format == 'text':
+    return Response(profile_store.text(profile_id), media_type='text/plain')
+  return file_response_with_range(path, request.headers.get('range'), media_type='application/octet-stream', filename=f"{profile_id}.prof")
+
+
 def main():
   logging.basicConfig(
     filename='flaskapp.log', 
@@ -212,7 +687,7 @@ def main():
     level=logging.DEBUG
     )
   logging.info('Starting service')
-  
+
   uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
 
   logging.info('Service stopped')
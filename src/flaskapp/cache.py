@@ -0,0 +1,194 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+
+class TTLCache:
+  """Small thread safe cache whose entries expire after a fixed number of seconds
+
+  Args:
+    ttl: Seconds an entry is valid for, 0 disables the cache
+  """
+  def __init__(self, ttl: float):
+    self.ttl = ttl
+    self.entries = {}
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """Get a cached value
+
+    Returns:
+      The value or None if missing or expired
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      expires_at, value = entry
+      if time.monotonic() >= expires_at:
+        del self.entries[key]
+        return None
+      return value
+
+  def set(self, key, value) -> None:
+    if self.ttl <= 0:
+      return
+    with self.lock:
+      # Drop expired entries so keys that are never read again do not pile up
+      now = time.monotonic()
+      for expired_key in [k for k, (expires_at, _) in self.entries.items() if expires_at <= now]:
+        del self.entries[expired_key]
+      self.entries[key] = (now + self.ttl, value)
+
+  def clear(self) -> None:
+    with self.lock:
+      self.entries.clear()
+
+class MessageIdIndex:
+  """Bounded Message-ID to UID index, least recently used entries are dropped first
+
+  UIDs are only valid for one UIDVALIDITY of a mailbox so both are part of the lookup.
+
+  Args:
+    max_entries: (optional) Maximum number of Message-IDs kept. Defaults to 100000
+  """
+  def __init__(self, max_entries: int = 100000):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def normalize(message_id: str) -> str:
+    message_id = message_id.strip()
+    if not message_id.startswith('<'):
+      message_id = f"<{message_id}>"
+    return message_id
+
+  def add(self, message_id: str, mailbox: str, uidvalidity: int, uid: int) -> None:
+    if not message_id or uid is None or self.max_entries <= 0:
+      return
+    key = (mailbox, self.normalize(message_id))
+    with self.lock:
+      self.entries[key] = (uidvalidity, uid)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def get(self, message_id: str, mailbox: str, uidvalidity: int):
+    """Look up the UID of a message
+
+    Returns:
+      UID or None if unknown or recorded under a different UIDVALIDITY
+    """
+    key = (mailbox, self.normalize(message_id))
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      if entry[0] != uidvalidity:
+        del self.entries[key]
+        return None
+      self.entries.move_to_end(key)
+      return entry[1]
+
+  def __len__(self):
+    return len(self.entries)
+
+class MessageCache:
+  """Parsed messages and fields extracted from them, least recently used dropped first
+
+  Entries are keyed by (mailbox, UIDVALIDITY, UID) and their estimated size counts against
+  a byte budget, so memory stays bounded however large the mailboxes are. Hits, misses and
+  evictions are counted in metrics (message_cache_*).
+
+  Args:
+    max_bytes: Byte budget, 0 disables the cache
+  """
+  # A parsed EmailMessage holds its payload about once (decoded parts can add to it) plus a
+  # fixed cost for the header objects, policy references and the entry itself, measured at
+  # around 1.5 - 2.5 KB per message e.g. a 269 byte message parses to ~2.7 KB
+  PARSED_SIZE_FACTOR = 1.5
+  ENTRY_OVERHEAD_BYTES = 4096
+
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    # id() of cached messages to their key, valid while the entry holds the message
+    self.keys_by_message = {}
+    self.size = 0
+    self.lock = threading.Lock()
+
+  def get(self, mailbox: str, uidvalidity: int, uid: int):
+    """Returns:
+      Cached email.message.EmailMessage or None
+    """
+    key = (mailbox, uidvalidity, uid)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.entries.move_to_end(key)
+    metrics.increment('message_cache_hits' if entry is not None else 'message_cache_misses')
+    return entry['message'] if entry is not None else None
+
+  def set(self, mailbox: str, uidvalidity: int, uid: int, message, raw_size: int) -> None:
+    """Cache a parsed message, raw_size is the length of the RFC822 bytes it was parsed from"""
+    if uidvalidity is None or uid is None:
+      return
+    size = int(raw_size * self.PARSED_SIZE_FACTOR) + self.ENTRY_OVERHEAD_BYTES
+    if size > self.max_bytes:
+      return
+    key = (mailbox, uidvalidity, uid)
+    with self.lock:
+      self._remove(key)
+      self.entries[key] = {'message': message, 'size': size, 'fields': {}}
+      self.keys_by_message[id(message)] = key
+      self.size += size
+      self._evict()
+
+  def get_field(self, message, name: str):
+    """Get a value extracted from a cached message e.g. its plain text body
+
+    Returns:
+      The value or None if the message is not cached or the field was not stored
+    """
+    with self.lock:
+      key = self.keys_by_message.get(id(message))
+      entry = self.entries.get(key) if key is not None else None
+      if entry is None or entry['message'] is not message or name not in entry['fields']:
+        return None
+      return entry['fields'][name]
+
+  def set_field(self, message, name: str, value: str) -> None:
+    """Store a value extracted from a cached message, ignored for messages that are not cached"""
+    with self.lock:
+      key = self.keys_by_message.get(id(message))
+      entry = self.entries.get(key) if key is not None else None
+      if entry is None or entry['message'] is not message or name in entry['fields']:
+        return
+      entry['fields'][name] = value
+      size = sys.getsizeof(value) if isinstance(value, (str, bytes)) else 0
+      entry['size'] += size
+      self.size += size
+      self._evict()
+
+  def clear(self) -> None:
+    with self.lock:
+      self.entries.clear()
+      self.keys_by_message.clear()
+      self.size = 0
+
+  def _remove(self, key) -> None:
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.size -= entry['size']
+      self.keys_by_message.pop(id(entry['message']), None)
+
+  def _evict(self) -> None:
+    while self.size > self.max_bytes and self.entries:
+      self._remove(next(iter(self.entries)))
+      metrics.increment('message_cache_evictions')
+
+  def __len__(self):
+    return len(self.entries)
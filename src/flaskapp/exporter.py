@@ -0,0 +1,315 @@
+import os
+import re
+import json
+import time
+import uuid
+import email
+import logging
+import threading
+from datetime import datetime, timedelta
+from email.policy import default as default_policy
+
+from helpers import email_message_to_dict
+from locks import LeaderLock
+
+EXPORT_FORMATS = {
+  'jsonl': 'application/x-ndjson',
+  'mbox': 'application/mbox',
+}
+
+# mboxrd quoting - https://www.loc.gov/preservation/digital/formats/fdd/fdd000385.shtml
+MBOX_FROM_PATTERN = re.compile(rb'^(>*From )', re.MULTILINE)
+
+def message_to_jsonl(reader, uid: int, raw_message: bytes) -> bytes:
+  """Serialize a raw message as a single JSON line"""
+  message = email.message_from_bytes(raw_message, policy=default_policy)
+  try:
+    message_dict = email_message_to_dict(reader, message)
+  except AttributeError:
+    # No text/plain part, keep the headers rather than failing the whole export
+    message_dict = {key: message.get(key.capitalize()) for key in ('to', 'from', 'subject', 'date')}
+    message_dict['body'] = None
+  message_dict['uid'] = uid
+  return json.dumps(message_dict).encode('utf-8') + b'\n'
+
+def message_to_mbox(reader, uid: int, raw_message: bytes) -> bytes:
+  """Serialize a raw message as an mboxrd entry"""
+  body = raw_message.replace(b'\r\n', b'\n')
+  body = MBOX_FROM_PATTERN.sub(rb'>\1', body)
+  if not body.endswith(b'\n'):
+    body += b'\n'
+  from_line = f"From MAILER-DAEMON {time.asctime(time.gmtime())}\n".encode('ascii')
+  return from_line + body + b'\n'
+
+def parse_export_date(date_string: str) -> datetime:
+  """Parse an export date, IMAP SINCE / BEFORE only compare dates so a time is rejected
+  rather than silently dropped
+
+  Raises:
+    ValueError: If the string is not a YYYY-MM-DD date
+  """
+  if not re.fullmatch(r'\d{4}-\d{2}-\d{2}', date_string):
+    raise ValueError("Invalid date. Expected YYYY-MM-DD without a time, e.g. 2023-02-28")
+  return datetime.strptime(date_string, "%Y-%m-%d")
+
+def search_criteria(since: str = None, until: str = None) -> tuple:
+  """IMAP search keys for an export date range, until is inclusive
+
+  Raises:
+    ValueError: If invalid date string is provided.
+  """
+  criteria = []
+  if since:
+    criteria += ['SINCE', parse_export_date(since).strftime("%d-%b-%Y")]
+  if until:
+    criteria += ['BEFORE', (parse_export_date(until) + timedelta(days=1)).strftime("%d-%b-%Y")]
+  return tuple(criteria) or ('ALL',)
+
+SERIALIZERS = {
+  'jsonl': message_to_jsonl,
+  'mbox': message_to_mbox,
+}
+
+class ExportJob:
+  """State of one export, persisted next to the export file so it can be resumed
+
+  Args:
+    job_id: Unique job ID
+    format: jsonl or mbox
+    since: (optional) Start date, YYYY-MM-DD
+    until: (optional) End date, YYYY-MM-DD, inclusive
+  """
+  def __init__(self, job_id: str, format: str, since: str = None, until: str = None):
+    self.id = job_id
+    self.format = format
+    self.since = since
+    self.until = until
+    self.status = 'pending'
+    self.error = None
+    self.uidvalidity = None
+    # Last UID and file offset that are fully written, export continues after these
+    self.last_uid = 0
+    self.offset = 0
+    self.exported = 0
+    self.total = None
+
+  def to_dict(self) -> dict:
+    return {
+      'id': self.id,
+      'format': self.format,
+      'since': self.since,
+      'until': self.until,
+      'status': self.status,
+      'error': self.error,
+      'uidvalidity': self.uidvalidity,
+      'last_uid': self.last_uid,
+      'offset': self.offset,
+      'exported': self.exported,
+      'total': self.total,
+    }
+
+  @classmethod
+  def from_dict(cls, job_dict: dict):
+    job = cls(job_dict['id'], job_dict['format'], job_dict.get('since'), job_dict.get('until'))
+    for key in ('status', 'error', 'uidvalidity', 'last_uid', 'offset', 'exported', 'total'):
+      setattr(job, key, job_dict.get(key, getattr(job, key)))
+    return job
+
+class ExportManager:
+  """Create, run and resume mailbox exports written incrementally to disk
+
+  The process writing an export holds a lock file next to it, so with several workers a
+  job is only reported as interrupted, and can only be resumed, once its owner has gone.
+
+  Args:
+    export_dir: Directory for export and job state files
+    session_factory: Callable returning a context manager that yields a logged in IMAPReader
+    batch_size: (optional) Number of messages fetched per UID FETCH command
+    max_exports: (optional) Number of exports kept on disk, the oldest are deleted when a new one is created. Defaults to 20
+  """
+  def __init__(self, export_dir: str, session_factory, batch_size: int = 50, max_exports: int = 20):
+    self.export_dir = export_dir
+    self.session_factory = session_factory
+    self.batch_size = batch_size
+    self.max_exports = max_exports
+    self.jobs = {}
+    # Owner locks of the jobs created or run by this process
+    self.owners = {}
+    self.lock = threading.RLock()
+    os.makedirs(export_dir, exist_ok=True)
+
+  def export_path(self, job: ExportJob) -> str:
+    return os.path.join(self.export_dir, f"{job.id}.{job.format}")
+
+  def state_path(self, job_id: str) -> str:
+    return os.path.join(self.export_dir, f"{job_id}.json")
+
+  def lock_path(self, job_id: str) -> str:
+    return os.path.join(self.export_dir, f"{job_id}.lock")
+
+  def owner(self, job_id: str) -> LeaderLock:
+    """Take the owner lock of a job
+
+    Raises:
+      RuntimeError: If another process holds it
+    """
+    with self.lock:
+      owner = self.owners.get(job_id) or LeaderLock(self.lock_path(job_id))
+      if not owner.acquire():
+        raise RuntimeError("Export is running in another worker")
+      self.owners[job_id] = owner
+      return owner
+
+  def release(self, job_id: str) -> None:
+    with self.lock:
+      self.jobs.pop(job_id, None)
+      owner = self.owners.pop(job_id, None)
+    if owner is not None:
+      owner.release()
+
+  def save(self, job: ExportJob) -> None:
+    state_path = self.state_path(job.id)
+    with open(state_path + '.tmp', 'w') as state_file:
+      json.dump(job.to_dict(), state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+  def create(self, format: str, since: str = None, until: str = None) -> ExportJob:
+    """Create a new export job
+
+    Raises:
+      ValueError: If the format or dates are invalid
+    """
+    if format not in SERIALIZERS:
+      raise ValueError(f"Invalid format. Expected one of {', '.join(SERIALIZERS)}")
+    # Validate the dates before anything is written
+    search_criteria(since, until)
+    job = ExportJob(uuid.uuid4().hex, format, since, until)
+    # Owned before the state is visible to other workers
+    self.owner(job.id)
+    self.save(job)
+    with self.lock:
+      self.jobs[job.id] = job
+    self.prune()
+    return job
+
+  def delete(self, job_id: str) -> bool:
+    """Delete an export file and its job state
+
+    Returns:
+      False if the job does not exist
+
+    Raises:
+      RuntimeError: If the export is running
+    """
+    job = self.get(job_id)
+    if job is None:
+      return False
+    with self.lock:
+      if job.status == 'running':
+        raise RuntimeError("Export is running")
+      self.owner(job_id)
+    self.release(job_id)
+    for path in (self.export_path(job), self.state_path(job_id), self.lock_path(job_id)):
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+    logging.info(f"ExportManager -> delete : {job_id}")
+    return True
+
+  def prune(self) -> None:
+    """Delete the oldest exports beyond max_exports, running exports are kept"""
+    state_paths = sorted((os.path.join(self.export_dir, name) for name in os.listdir(self.export_dir) if name.endswith('.json')), key=os.path.getmtime)
+    for state_path in state_paths[:-self.max_exports]:
+      try:
+        self.delete(os.path.basename(state_path)[:-len('.json')])
+      except (RuntimeError, OSError):
+        pass
+
+  def get(self, job_id: str):
+    """Get a job by ID, loading it from disk if it was created by another worker or a previous process
+
+    Returns:
+      ExportJob or None if the job does not exist
+    """
+    with self.lock:
+      if job_id in self.jobs:
+        # Owned by this process, the copy in memory is the latest
+        return self.jobs[job_id]
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id) or not os.path.exists(self.state_path(job_id)):
+      return None
+    with open(self.state_path(job_id)) as state_file:
+      job = ExportJob.from_dict(json.load(state_file))
+    if job.status in ('pending', 'running'):
+      owner = LeaderLock(self.lock_path(job_id))
+      if owner.acquire():
+        # No process holds the job, the one running it has gone away
+        owner.release()
+        job.status = 'failed'
+        job.error = 'Interrupted'
+    # Not kept, the owner updates the state on disk
+    return job
+
+  def start(self, job: ExportJob) -> None:
+    """Run the job in a background thread
+
+    Raises:
+      RuntimeError: If another worker is running the job
+    """
+    with self.lock:
+      if job.status == 'running':
+        return
+      self.owner(job.id)
+      job.status = 'running'
+      job.error = None
+      self.jobs[job.id] = job
+    threading.Thread(target=self.run, args=(job,), name=f"export-{job.id}", daemon=True).start()
+
+  def run(self, job: ExportJob) -> None:
+    """Write the export, continuing from the last completed batch if the job ran before
+
+    Raises:
+      RuntimeError: If another worker is running the job
+    """
+    self.owner(job.id)
+    job.status = 'running'
+    try:
+      with self.session_factory() as reader:
+        self.write(job, reader)
+      job.status = 'complete'
+    except Exception as error:
+      logging.exception(f"ExportManager -> run : export {job.id} failed")
+      job.status = 'failed'
+      job.error = str(error)
+    finally:
+      self.save(job)
+      self.release(job.id)
+
+  def write(self, job: ExportJob, reader) -> None:
+    """Append every message after the job checkpoint to the export file"""
+    serialize = SERIALIZERS[job.format]
+    reader.select_mailbox_and_get_email_count_in_mailbox()
+    if job.uidvalidity is not None and job.uidvalidity != reader.uidvalidity:
+      logging.info(f"ExportManager -> write : UIDVALIDITY changed, restarting export {job.id}")
+      job.last_uid, job.offset, job.exported = 0, 0, 0
+    job.uidvalidity = reader.uidvalidity
+
+    uids = [uid for uid in reader.search_uids(*search_criteria(job.since, job.until)) if uid > job.last_uid]
+    job.total = job.exported + len(uids)
+    self.save(job)
+
+    export_path = self.export_path(job)
+    with open(export_path, 'r+b' if os.path.exists(export_path) else 'wb') as export_file:
+      # Drop anything written after the last checkpoint
+      export_file.truncate(job.offset)
+      export_file.seek(job.offset)
+      for index in range(0, len(uids), self.batch_size):
+        batch = uids[index:index + self.batch_size]
+        for uid, raw_message in reader.fetch_raw_messages(batch):
+          export_file.write(serialize(reader, uid, raw_message))
+          job.exported += 1
+        export_file.flush()
+        os.fsync(export_file.fileno())
+        job.last_uid = batch[-1]
+        job.offset = export_file.tell()
+        self.save(job)
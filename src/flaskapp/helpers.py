@@ -1,20 +1,101 @@
+import os
 import email
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from imapreader import IMAPReader
+from profiling import phase
 
-def email_messages_to_messages_dict(reader: IMAPReader, messages: email.message.Message) -> list:
-  messages_dict = []
-  for message in messages:
+def email_message_to_dict(reader: IMAPReader, message: email.message.Message) -> dict:
+  with phase('serialize'):
     subject = message.get('Subject')
     date = message.get('Date')
     email_from = message.get('From')
     email_to = message.get('To')
     email_body = reader.get_email_body(message, format='plain')
-    message_dict = {
+  return {
     'to': email_to,
     'from': email_from,
     'subject': subject,
     'date': date,
     'body': email_body
     }
-    messages_dict.append(message_dict)
-  return messages_dict
\ No newline at end of file
+
+def email_messages_to_messages_dict(reader: IMAPReader, messages: email.message.Message) -> list:
+  messages_dict = []
+  for message in messages:
+    messages_dict.append(email_message_to_dict(reader, message))
+  return messages_dict
+
+def env_flag(name: str, default: bool = False) -> bool:
+  """Read a boolean environment variable e.g. 1 / true / yes / on"""
+  value = os.environ.get(name)
+  if value is None:
+    return default
+  return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def parse_range_header(range_header: str, file_size: int):
+  """Parse a single HTTP byte range e.g. bytes=0-499, bytes=500- or bytes=-500
+
+  Args:
+    range_header: Value of the Range request header
+    file_size: Size of the requested file in bytes
+
+  Returns:
+    Tuple (start, end) with end inclusive, None if the header should be ignored
+
+  Raises:
+    ValueError: If the range can not be satisfied
+  """
+  unit, _, ranges = range_header.partition('=')
+  # Multiple ranges and unknown units are allowed to be ignored (RFC 9110 section 14.2)
+  if unit.strip().lower() != 'bytes' or ',' in ranges:
+    return None
+  start, _, end = ranges.strip().partition('-')
+  try:
+    if start == '':
+      length = int(end)
+      if length <= 0:
+        raise ValueError("Range not satisfiable")
+      return (max(file_size - length, 0), file_size - 1)
+    start = int(start)
+    end = int(end) if end else file_size - 1
+  except ValueError:
+    raise ValueError("Range not satisfiable")
+  if start >= file_size or start > end:
+    raise ValueError("Range not satisfiable")
+  return (start, min(end, file_size - 1))
+
+def file_response_with_range(path: str, range_header: str = None, media_type: str = None, filename: str = None) -> Response:
+  """Serve a file from disk, honouring a single byte Range request
+
+  Whole files are served with FileResponse (which uses sendfile where the server supports it).
+  Ranges are streamed from disk in chunks so the file never has to fit in memory.
+  """
+  file_size = os.path.getsize(path)
+  headers = {'Accept-Ranges': 'bytes'}
+  if filename:
+    headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+  byte_range = None
+  if range_header:
+    try:
+      byte_range = parse_range_header(range_header, file_size)
+    except ValueError:
+      return Response(status_code=416, headers={'Content-Range': f'bytes */{file_size}'})
+  if byte_range is None:
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+  start, end = byte_range
+
+  def read_range(chunk_size: int = 65536):
+    with open(path, 'rb') as range_file:
+      range_file.seek(start)
+      remaining = end - start + 1
+      while remaining > 0:
+        chunk = range_file.read(min(chunk_size, remaining))
+        if not chunk:
+          break
+        remaining -= len(chunk)
+        yield chunk
+
+  headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+  headers['Content-Length'] = str(end - start + 1)
+  return StreamingResponse(read_range(), status_code=206, media_type=media_type, headers=headers)
@@ -0,0 +1,147 @@
+import imaplib
+import logging
+import time
+import zlib
+from imaplib import IMAP4_SSL
+
+import metrics
+
+# COMPRESS is not part of the imaplib command table
+# https://www.rfc-editor.org/rfc/rfc4978
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+READ_CHUNK_SIZE = 16384
+
+class DeadlineExceeded(TimeoutError):
+  """The request deadline passed before the next IMAP command could be sent"""
+
+class DeflateIMAP4_SSL(IMAP4_SSL):
+  """IMAP4_SSL connection with support for the COMPRESS=DEFLATE extension
+
+  Until compress() succeeds the connection behaves exactly like IMAP4_SSL.
+  Afterwards every byte sent is deflated and every byte received is inflated
+  using a raw (headerless) zlib stream as required by RFC 4978.
+
+  Byte counts before and after compression are recorded in metrics:
+    imap_bytes_sent / imap_bytes_sent_wire
+    imap_bytes_received / imap_bytes_received_wire
+
+  When deadline (a time.monotonic() value) is set, the socket timeout is lowered to the
+  time remaining before every command. Pass it to the constructor so it also covers the
+  CAPABILITY command imaplib sends while connecting.
+  """
+
+  def __init__(self, *args, deadline: float = None, **kwargs):
+    self.deadline = deadline
+    self._capabilities_refreshed = False
+    # Connect and greeting use the timeout passed in, apply_deadline takes over from there
+    self._deadline_applied = kwargs.get('timeout') is not None
+    self._compressor = None
+    self._decompressor = None
+    self._inbuf = bytearray()
+    super().__init__(*args, **kwargs)
+
+  @property
+  def compressed(self) -> bool:
+    return self._compressor is not None
+
+  def refresh_capabilities(self) -> tuple:
+    """Re-read the server capabilities, they commonly change after LOGIN
+
+    Returns:
+      Tuple of upper case capability names
+    """
+    response_code, data = self.capability()
+    if response_code == 'OK' and data and data[-1]:
+      self.capabilities = tuple(data[-1].decode('ascii', 'replace').upper().split())
+    self._capabilities_refreshed = True
+    return self.capabilities
+
+  def has_capability(self, name: str) -> bool:
+    """Check a capability, re-reading them once after LOGIN"""
+    if not self._capabilities_refreshed and self.state in ('AUTH', 'SELECTED'):
+      self.refresh_capabilities()
+    return name.upper() in self.capabilities
+
+  def compress(self) -> bool:
+    """Negotiate COMPRESS=DEFLATE if the server advertises it
+
+    Returns:
+      True if compression is now active, False otherwise
+    """
+    if self.compressed:
+      return True
+    if not self.has_capability('COMPRESS=DEFLATE'):
+      return False
+    response_code, _ = self._simple_command('COMPRESS', 'DEFLATE')
+    logging.debug(f"DeflateIMAP4_SSL -> compress : response code {response_code}")
+    if response_code != 'OK':
+      return False
+    self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    return True
+
+  def apply_deadline(self) -> None:
+    """Set the socket timeout to the time left before the deadline
+
+    Raises:
+      DeadlineExceeded: If the deadline has passed.
+    """
+    if self.deadline is None:
+      if self._deadline_applied:
+        self.sock.settimeout(None)
+        self._deadline_applied = False
+      return
+    remaining = self.deadline - time.monotonic()
+    if remaining <= 0:
+      raise DeadlineExceeded("Request deadline exceeded")
+    self.sock.settimeout(remaining)
+    self._deadline_applied = True
+
+  def send(self, data):
+    self.apply_deadline()
+    metrics.increment('imap_bytes_sent', len(data))
+    if self._compressor is not None:
+      data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    metrics.increment('imap_bytes_sent_wire', len(data))
+    super().send(data)
+
+  def read(self, size):
+    if self._decompressor is None:
+      data = super().read(size)
+      metrics.increment('imap_bytes_received', len(data))
+      metrics.increment('imap_bytes_received_wire', len(data))
+      return data
+    while len(self._inbuf) < size:
+      self._fill()
+    data = bytes(self._inbuf[:size])
+    del self._inbuf[:size]
+    return data
+
+  def readline(self):
+    if self._decompressor is None:
+      line = super().readline()
+      metrics.increment('imap_bytes_received', len(line))
+      metrics.increment('imap_bytes_received_wire', len(line))
+      return line
+    while True:
+      end = self._inbuf.find(b'\n', 0, imaplib._MAXLINE + 1)
+      if end >= 0:
+        break
+      if len(self._inbuf) > imaplib._MAXLINE:
+        raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+      self._fill()
+    line = bytes(self._inbuf[:end + 1])
+    del self._inbuf[:end + 1]
+    return line
+
+  def _fill(self):
+    """Read the next compressed chunk from the socket and inflate it into the input buffer"""
+    # read1 also drains anything already buffered after the COMPRESS response
+    raw = self.file.read1(READ_CHUNK_SIZE)
+    if not raw:
+      raise self.abort('socket error: EOF')
+    data = self._decompressor.decompress(raw)
+    metrics.increment('imap_bytes_received_wire', len(raw))
+    metrics.increment('imap_bytes_received', len(data))
+    self._inbuf += data
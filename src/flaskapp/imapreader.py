@@ -1,21 +1,175 @@
-from imaplib import IMAP4_SSL
 from email.policy import default as default_policy
 import email
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
+import imaplib
 import logging
+import math
+import time
+import re
+
+from imapcompress import DeflateIMAP4_SSL, DeadlineExceeded
+from cache import MessageIdIndex
+from profiling import phase
+from threads import ThreadIndex, THREAD_HEADER_FIELDS, thread_record, thread_record_from_bytes, parse_thread_response
+
+FETCH_UID_PATTERN = re.compile(rb'UID (\d+)')
+
+def parse_uid(fetch_response_header: bytes):
+  """Extract the UID from a FETCH response header e.g. b'1 (UID 42 RFC822 {460}'
+
+  Returns:
+    UID as an int, None if the response does not contain a UID
+  """
+  match = FETCH_UID_PATTERN.search(fetch_response_header)
+  return int(match.group(1)) if match else None
+
+LIST_RESPONSE_PATTERN = re.compile(rb'^\((?P<flags>[^)]*)\) (?P<delimiter>NIL|"(?:[^"\\]|\\.)*") ?(?P<name>.*)$', re.IGNORECASE)
+FETCH_LITERAL_PATTERN = re.compile(rb'^\* \d+ FETCH \(.*BODY\[\] \{(\d+)\}\r\n$')
+LITERAL_PATTERN = re.compile(rb'\{(\d+)\}\r\n$')
+INTERNALDATE_RESPONSE_PATTERN = re.compile(rb'^(?P<id>\d+) \(.*INTERNALDATE "(?P<day> ?\d{1,2})-(?P<month>[A-Za-z]{3})-(?P<year>\d{4}) (?P<time>\d{2}:\d{2}:\d{2}) (?P<zone>[-+]\d{4})"')
+STATUS_RESPONSE_PATTERN = re.compile(rb'^(?P<name>.*?) ?\((?P<items>[^()]*)\)\s*$')
+
+def parse_internaldate_response(item: bytes) -> tuple:
+  """Parse one FETCH (INTERNALDATE) response e.g. b'12 (UID 42 INTERNALDATE "05-Feb-2023 05:10:47 -0500")'
+
+  Returns:
+    Tuple of sequence number and timezone aware datetime, None if it can not be parsed
+  """
+  match = INTERNALDATE_RESPONSE_PATTERN.match(item or b'')
+  if not match or match.group('month').capitalize() not in imaplib.Mon2num:
+    return None
+  hour, minute, second = (int(value) for value in match.group('time').split(b':'))
+  zone = match.group('zone')
+  offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+  internaldate = datetime(
+    int(match.group('year')), imaplib.Mon2num[match.group('month').capitalize()], int(match.group('day')),
+    hour, minute, second,
+    tzinfo=timezone(-offset if zone.startswith(b'-') else offset)
+  )
+  return (int(match.group('id')), internaldate)
+
+class MailboxNotFound(Exception):
+  """The mailbox does not exist, can not be selected or its name is invalid"""
+
+def quote_string(value: str) -> str:
+  """Quote a value from a request as an IMAP quoted string the way imaplib does, e.g. Sent Mail becomes "Sent Mail"
+
+  Raises:
+    ValueError: If the value contains CR, LF or NUL, which would end the command and start another
+  """
+  if any(character in value for character in '\r\n\0'):
+    raise ValueError("CR, LF and NUL are not allowed")
+  return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def quote_mailbox(mailbox_name: str) -> str:
+  """Quote a mailbox name for a command, see quote_string
+
+  Raises:
+    MailboxNotFound: If the name contains CR, LF or NUL
+  """
+  try:
+    return quote_string(mailbox_name)
+  except ValueError:
+    raise MailboxNotFound("Invalid mailbox name")
+
+def to_sequence_set(ids: list) -> str:
+  """Compact a list of message numbers into an IMAP sequence set e.g. [1, 2, 3, 7] becomes 1:3,7"""
+  ranges = []
+  for message_id in sorted(set(ids)):
+    if ranges and ranges[-1][1] == message_id - 1:
+      ranges[-1][1] = message_id
+    else:
+      ranges.append([message_id, message_id])
+  return ','.join(f"{start}:{end}" if start != end else f"{start}" for start, end in ranges)
+
+def unquote_imap_string(value: bytes) -> str:
+  """Decode an IMAP atom or quoted string, quotes are removed and backslash escapes resolved"""
+  value = value.strip()
+  if len(value) >= 2 and value.startswith(b'"') and value.endswith(b'"'):
+    value = re.sub(rb'\\(.)', rb'\1', value[1:-1])
+  return value.decode('utf-8', 'replace')
+
+def parse_list_response(item) -> dict:
+  """Parse one LIST response e.g. b'(\\HasNoChildren) "/" "INBOX"'
+
+  Names sent as a literal arrive as a tuple (b'(\\HasNoChildren) "/" {5}', b'INBOX').
+
+  Returns:
+    Dictionary with name, delimiter and flags, None if the response can not be parsed
+  """
+  literal_name = None
+  if isinstance(item, tuple):
+    item, literal_name = item[0], item[1]
+  match = LIST_RESPONSE_PATTERN.match(item or b'')
+  if not match:
+    return None
+  delimiter = match.group('delimiter')
+  return {
+    'name': literal_name.decode('utf-8', 'replace') if literal_name is not None else unquote_imap_string(match.group('name')),
+    'delimiter': None if delimiter.upper() == b'NIL' else unquote_imap_string(delimiter),
+    'flags': match.group('flags').decode('ascii', 'replace').split(),
+  }
+
+def parse_status_response(item) -> tuple:
+  """Parse one STATUS response e.g. b'"INBOX" (MESSAGES 5 UNSEEN 1)'
+
+  Returns:
+    Tuple of mailbox name and dictionary of lower case item name to int, None if it can not be parsed
+  """
+  literal_name = None
+  if isinstance(item, tuple):
+    literal_name, item = item[1], item[0]
+  match = STATUS_RESPONSE_PATTERN.match(item or b'')
+  if not match:
+    return None
+  values = match.group('items').split()
+  status = {name.decode('ascii').lower(): int(value) for name, value in zip(values[::2], values[1::2])}
+  name = literal_name.decode('utf-8', 'replace') if literal_name is not None else unquote_imap_string(match.group('name'))
+  return (name, status)
 
 class IMAPReader:
-  def __init__(self, email_id="", email_password="", email_host="", port = 993):
+  def __init__(self, email_id="", email_password="", email_host="", port = 993, compress = True, message_id_index = None, thread_index = None, message_cache = None):
     self.email_id = email_id
     self.email_password = email_password
     self.email_host = email_host
     self.port = port
+    self.compress = compress
+    # Optional cache.MessageIdIndex shared between readers, filled in as messages are fetched
+    self.message_id_index = message_id_index
+    # Optional threads.ThreadIndex shared between readers, used when the server has no THREAD=REFERENCES
+    self.thread_index = thread_index
+    # Optional cache.MessageCache of parsed messages shared between readers
+    self.message_cache = message_cache
     self.logged_in = False
+    self.mailbox = None
+    self.uidvalidity = None
+    self._deadline = None
+    # Set by fetch_emails when the deadline cut the result short
+    self.partial = False
+    self.cursor = None
+    # Set when the connection can not be reused e.g. after a timeout mid-response
+    self.broken = False
+
+  @property
+  def deadline(self):
+    """time.monotonic() value by which the current request has to finish, None for no limit"""
+    return self._deadline
+
+  @deadline.setter
+  def deadline(self, deadline):
+    self._deadline = deadline
+    if hasattr(self, 'imap4_ssl'):
+      self.imap4_ssl.deadline = deadline
+
+  def deadline_expired(self) -> bool:
+    return self._deadline is not None and time.monotonic() >= self._deadline
 
   def login(self):
     """Connect and login to IMAP server
 
+    COMPRESS=DEFLATE is negotiated after LOGIN when enabled and advertised by the server.
+
     Args:
       None
 
@@ -24,18 +178,37 @@ class IMAPReader:
 
     Raises:
       IMAP4.error: Exception raised on any errors.
+      DeadlineExceeded: If the deadline has already passed.
     """
     logging.debug(f"IMAPReader -> Login {self.email_host} : {self.port}")
-    self.imap4_ssl = IMAP4_SSL(self.email_host, self.port)
+    timeout = None
+    if self._deadline is not None:
+      timeout = self._deadline - time.monotonic()
+      if timeout <= 0:
+        raise DeadlineExceeded("Request deadline exceeded before login")
+    self.imap4_ssl = DeflateIMAP4_SSL(self.email_host, self.port, timeout=timeout, deadline=self._deadline)
     response = self.imap4_ssl.login(self.email_id, self.email_password)
+    if self.compress:
+      compressed = self.imap4_ssl.compress()
+      logging.debug(f"IMAPReader -> Login : compression {'enabled' if compressed else 'not available'}")
     return response
 
   def close(self):
     """Logout and close the connection to the IMAP server"""
     logging.debug(f"IMAPReader -> Close")
-    self.imap4_ssl.close()
+    # CLOSE is only valid with a mailbox selected
+    if self.imap4_ssl.state == 'SELECTED':
+      self.imap4_ssl.close()
     self.imap4_ssl.logout()
 
+  def noop(self):
+    """Check the connection is still alive
+
+    Raises:
+      IMAP4.abort: If the connection has been dropped.
+    """
+    return self.imap4_ssl.noop()
+
   def select_mailbox_and_get_email_count_in_mailbox(self, mailbox_name: str = 'INBOX') -> tuple:
     """Selects a given mailbox and get the number of emails in the given mailbox
 
@@ -46,18 +219,342 @@ class IMAPReader:
       Tuple of response code and count of emails in mailbox
 
     Raises:
+      MailboxNotFound: If the server refuses to select the mailbox or the name is invalid.
       imaplib.IMAP4.error: Exception raised on any errors.
     """
-    response_code, mail_count = self.imap4_ssl.select(mailbox=mailbox_name, readonly=True)
+    self.mailbox = None
+    response_code, mail_count = self.imap4_ssl.select(mailbox=quote_mailbox(mailbox_name), readonly=True)
+    if response_code != 'OK':
+      # imaplib drops back to the AUTH state, nothing is selected any more
+      self.uidvalidity = None
+      logging.debug(f"IMAPReader -> select_mailbox_and_get_email_count_in_mailbox : {mailbox_name} response code {response_code}")
+      raise MailboxNotFound(f"Mailbox not found: {mailbox_name}")
+    uidvalidity = getattr(self.imap4_ssl, 'untagged_responses', {}).get('UIDVALIDITY')
+    self.uidvalidity = int(uidvalidity[-1]) if uidvalidity else None
+    self.mailbox = mailbox_name
     logging.debug(f"IMAPReader -> select_mailbox_and_get_email_count_in_mailbox : response code {response_code}, count {mail_count}")
     return (response_code, mail_count)
   
 
-  def get_mail(self, mailbox: str = 'INBOX') -> list:
+  def ensure_selected(self, mailbox_name: str = 'INBOX') -> None:
+    """Select the mailbox unless this session already has it selected"""
+    if self.mailbox == mailbox_name and getattr(self.imap4_ssl, 'state', None) == 'SELECTED' and self.uidvalidity is not None:
+      return
+    self.select_mailbox_and_get_email_count_in_mailbox(mailbox_name)
+
+  def get_email_by_uid(self, uid: int, mailbox: str = 'INBOX'):
+    """Get one message by UID with a single UID FETCH
+
+    Args:
+      uid: Message UID
+      mailbox: (optional) Mailbox name. Defaults to INBOX
+
+    Returns:
+      email.message.EmailMessage or None if there is no message with this UID
+    """
+    self.ensure_selected(mailbox)
+    message = self.cached_message(uid)
+    if message is not None:
+      return message
+    response_code, mail_data = self.imap4_ssl.uid('FETCH', str(uid), '(UID RFC822)')
+    logging.debug(f"IMAPReader -> get_email_by_uid : {uid} response code {response_code}")
+    for item in mail_data or []:
+      if isinstance(item, tuple) and parse_uid(item[0]) == uid:
+        message = email.message_from_bytes(item[1], policy=default_policy)
+        self.index_message(message, uid)
+        self.cache_message(message, uid, len(item[1]))
+        return message
+    return None
+
+  def cached_message(self, uid: int):
+    """Parsed message of the selected mailbox from the message cache, None if not cached"""
+    if self.message_cache is None or uid is None:
+      return None
+    return self.message_cache.get(self.mailbox, self.uidvalidity, uid)
+
+  def cache_message(self, message: email.message.EmailMessage, uid: int, raw_size: int) -> None:
+    if self.message_cache is not None:
+      self.message_cache.set(self.mailbox, self.uidvalidity, uid, message, raw_size)
+
+  def fetch_uids(self, mail_ids: list) -> dict:
+    """Map sequence numbers to UIDs with one FETCH (UID), no message data is transferred
+
+    Returns:
+      Dictionary of sequence number (str) to UID
+    """
+    if not mail_ids:
+      return {}
+    with phase('fetch'):
+      response_code, data = self.imap4_ssl.fetch(to_sequence_set([int(mail_id) for mail_id in mail_ids]), '(UID)')
+    logging.debug(f"IMAPReader -> fetch_uids : response code {response_code}")
+    uids = {}
+    for item in data or []:
+      item = item[0] if isinstance(item, tuple) else item
+      if isinstance(item, bytes) and item.split(b' ', 1)[0].isdigit():
+        uids[item.split(b' ', 1)[0].decode('ascii')] = parse_uid(item)
+    return uids
+
+  def get_email_by_message_id(self, message_id: str, mailbox: str = 'INBOX'):
+    """Get one message by its Message-ID header
+
+    Message-IDs seen before are resolved from the Message-ID index and fetched with one
+    UID FETCH, unknown ones are looked up with SEARCH HEADER Message-ID first.
+
+    Args:
+      message_id: Message-ID with or without the angle brackets
+      mailbox: (optional) Mailbox name. Defaults to INBOX
+
+    Returns:
+      Tuple of UID and email.message.EmailMessage, None if not found or the Message-ID contains CR, LF or NUL
+    """
+    self.ensure_selected(mailbox)
+    normalized_message_id = MessageIdIndex.normalize(message_id)
+    try:
+      quoted_message_id = quote_string(normalized_message_id)
+    except ValueError:
+      # No Message-ID header can contain line breaks, it would only inject commands
+      return None
+    if self.message_id_index is not None:
+      uid = self.message_id_index.get(message_id, mailbox, self.uidvalidity)
+      if uid is not None:
+        message = self.get_email_by_uid(uid, mailbox)
+        # The index can be stale, fall back to SEARCH if the UID now holds another message
+        if message is not None and str(message.get('Message-ID', '')).strip() == normalized_message_id:
+          return (uid, message)
+
+    response_code, uids = self.imap4_ssl.uid('SEARCH', 'HEADER', 'Message-ID', quoted_message_id)
+    logging.debug(f"IMAPReader -> get_email_by_message_id : response code {response_code}")
+    for uid in (uids[0].split() if uids and uids[0] else []):
+      message = self.get_email_by_uid(int(uid), mailbox)
+      if message is not None:
+        return (int(uid), message)
+    return None
+
+  def open_raw_message(self, uid: int, mailbox: str = 'INBOX', chunk_size: int = 65536):
+    """Start streaming the unparsed message, chunk by chunk as it is read from the socket
+
+    imaplib reads a whole literal into memory, so the UID FETCH is sent and its response
+    read here instead. The session can not be used for anything else until the returned
+    iterator is exhausted. If it is abandoned the session is marked broken.
+
+    Args:
+      uid: Message UID
+      mailbox: (optional) Mailbox name. Defaults to INBOX
+      chunk_size: (optional) Maximum bytes per chunk
+
+    Returns:
+      Tuple of message size in bytes and an iterator of bytes chunks, None if there is no message with this UID
+
+    Raises:
+      IMAP4.error: If the server rejects the command.
+    """
+    self.ensure_selected(mailbox)
+    imap4_ssl = self.imap4_ssl
+    tag = imap4_ssl._new_tag()
+    # Until the tagged response is read the connection is out of step with imaplib
+    self.broken = True
+    imap4_ssl.send(tag + b' UID FETCH %d (UID BODY.PEEK[])\r\n' % uid)
+    while True:
+      line = imap4_ssl.readline()
+      if line.startswith(tag + b' '):
+        self.finish_raw_command(tag, line)
+        return None
+      match = FETCH_LITERAL_PATTERN.match(line)
+      if match:
+        break
+      # Skip unsolicited responses, including any literal they carry
+      literal = LITERAL_PATTERN.search(line)
+      if literal:
+        imap4_ssl.read(int(literal.group(1)))
+    size = int(match.group(1))
+    logging.debug(f"IMAPReader -> open_raw_message : {uid} {size} bytes")
+    return (size, self.stream_raw_message(tag, size, chunk_size))
+
+  def stream_raw_message(self, tag: bytes, size: int, chunk_size: int):
+    """Yield the FETCH literal then read up to the tagged response, see open_raw_message"""
+    imap4_ssl = self.imap4_ssl
+    remaining = size
+    while remaining > 0:
+      chunk = imap4_ssl.read(min(chunk_size, remaining))
+      if not chunk:
+        raise imap4_ssl.abort('socket error: EOF')
+      remaining -= len(chunk)
+      yield chunk
+    while True:
+      # Rest of the FETCH response e.g. b' UID 42)' and the tagged response
+      line = imap4_ssl.readline()
+      if not line:
+        raise imap4_ssl.abort('socket error: EOF')
+      if line.startswith(tag + b' '):
+        self.finish_raw_command(tag, line)
+        return
+
+  def finish_raw_command(self, tag: bytes, line: bytes) -> None:
+    """Handle the tagged response of a command sent by open_raw_message"""
+    self.imap4_ssl.tagged_commands.pop(tag, None)
+    self.broken = False
+    response_code = line[len(tag) + 1:].split(b' ', 1)[0]
+    if response_code != b'OK':
+      raise self.imap4_ssl.error(line.decode('utf-8', 'replace').strip())
+
+  def index_message(self, message: email.message.EmailMessage, uid: int) -> None:
+    """Record the Message-ID of a fetched message in the Message-ID and thread indexes"""
+    if uid is None:
+      return
+    if self.message_id_index is not None:
+      self.message_id_index.add(message.get('Message-ID'), self.mailbox, self.uidvalidity, uid)
+    if self.thread_index is not None:
+      self.thread_index.add(self.mailbox, self.uidvalidity, uid, thread_record(message))
+
+  def fetch_thread_headers(self, uids: list, batch_size: int = 500):
+    """Fetch only the header fields needed for threading, see threads.THREAD_HEADER_FIELDS
+
+    Records are yielded as each batch arrives, so callers keep what was fetched before a
+    deadline cut the fetch short.
+
+    Args:
+      uids: List of UIDs
+
+    Yields:
+      Tuples (uid, threads.thread_record)
+    """
+    items = f"(UID BODY.PEEK[HEADER.FIELDS ({' '.join(THREAD_HEADER_FIELDS)})])"
+    for index in range(0, len(uids), batch_size):
+      with phase('fetch'):
+        response_code, mail_data = self.imap4_ssl.uid('FETCH', to_sequence_set(uids[index:index + batch_size]), items)
+      logging.debug(f"IMAPReader -> fetch_thread_headers : response code {response_code}")
+      for item in mail_data or []:
+        if isinstance(item, tuple):
+          with phase('parse'):
+            record = thread_record_from_bytes(item[1])
+          yield (parse_uid(item[0]), record)
+
+  def update_thread_index(self, thread_index: ThreadIndex) -> None:
+    """Bring the thread index of the selected mailbox up to date, only headers of new messages are fetched"""
+    known_uids = thread_index.known_uids(self.mailbox, self.uidvalidity)
+    uids = self.search_uids()
+    removed_uids = known_uids.difference(uids)
+    if removed_uids:
+      thread_index.remove(self.mailbox, self.uidvalidity, removed_uids)
+    new_uids = [uid for uid in uids if uid not in known_uids]
+    for uid, record in self.fetch_thread_headers(new_uids):
+      thread_index.add(self.mailbox, self.uidvalidity, uid, record)
+    logging.debug(f"IMAPReader -> update_thread_index : {len(new_uids)} added, {len(removed_uids)} removed")
+
+  def get_threads(self, mailbox: str = 'INBOX') -> list:
+    """Get the conversation threads of a mailbox
+
+    The server threads the messages with THREAD=REFERENCES (RFC 5256) when it supports it,
+    otherwise the local thread index is updated and used.
+
+    Returns:
+      List of threads (lists of UIDs), the thread with the newest message first
+    """
+    self.ensure_selected(mailbox)
+    if self.imap4_ssl.has_capability('THREAD=REFERENCES'):
+      with phase('search'):
+        response_code, data = self.imap4_ssl.uid('THREAD', 'REFERENCES', 'UTF-8', 'ALL')
+      logging.debug(f"IMAPReader -> get_threads : THREAD response code {response_code}")
+      threads = parse_thread_response(b''.join(item for item in data or [] if isinstance(item, bytes)))
+      return sorted(threads, key=lambda uids: uids[-1], reverse=True)
+
+    thread_index = self.thread_index if self.thread_index is not None else ThreadIndex()
+    self.update_thread_index(thread_index)
+    return thread_index.threads(self.mailbox, self.uidvalidity)
+
+  def get_thread_records(self, uids: list) -> dict:
+    """Header records for messages of the selected mailbox, from the thread index where possible
+
+    Returns:
+      Dictionary of UID to threads.thread_record
+    """
+    records = self.thread_index.records(self.mailbox, self.uidvalidity, uids) if self.thread_index is not None else {}
+    missing_uids = [uid for uid in uids if uid not in records]
+    for uid, record in self.fetch_thread_headers(missing_uids):
+      records[uid] = record
+      if self.thread_index is not None:
+        self.thread_index.add(self.mailbox, self.uidvalidity, uid, record)
+    return records
+
+  def status_items(self) -> str:
+    """STATUS data items to request, HIGHESTMODSEQ is only available with CONDSTORE"""
+    items = ['MESSAGES', 'UNSEEN', 'RECENT', 'UIDNEXT', 'UIDVALIDITY']
+    if self.imap4_ssl.has_capability('CONDSTORE'):
+      items.append('HIGHESTMODSEQ')
+    return '(' + ' '.join(items) + ')'
+
+  def get_mailbox_status(self, mailbox_name: str = 'INBOX') -> dict:
+    """Get message counts for a mailbox with a single STATUS command, nothing is fetched
+
+    Args:
+      mailbox_name: (optional) Mailbox name. Defaults to INBOX
+
+    Returns:
+      Dictionary of messages, unseen, recent, uidnext, uidvalidity and (if supported) highestmodseq,
+      None if the mailbox does not exist
+
+    Raises:
+      imaplib.IMAP4.error: Exception raised on any errors.
+    """
+    try:
+      quoted_mailbox_name = quote_mailbox(mailbox_name)
+    except MailboxNotFound:
+      return None
+    response_code, data = self.imap4_ssl.status(quoted_mailbox_name, self.status_items())
+    logging.debug(f"IMAPReader -> get_mailbox_status : {mailbox_name} response code {response_code}")
+    if response_code != 'OK':
+      return None
+    for item in data:
+      parsed = parse_status_response(item)
+      if parsed:
+        return parsed[1]
+    return None
+
+  def list_mailboxes(self) -> list:
+    """List all mailboxes with their status in one round trip
+
+    LIST-STATUS (RFC 5819) is used when available, otherwise STATUS commands for every
+    mailbox are pipelined (all sent before the first response is read).
+
+    Returns:
+      List of dictionaries with name, delimiter, flags and status (None for \\Noselect mailboxes)
+    """
+    imap4_ssl = self.imap4_ssl
+    items = self.status_items()
+    if imap4_ssl.has_capability('LIST-STATUS'):
+      response_code, data = imap4_ssl._simple_command('LIST', '""', '*', 'RETURN', f"(STATUS {items})")
+      _, list_data = imap4_ssl._untagged_response(response_code, data, 'LIST')
+      _, status_data = imap4_ssl._untagged_response(response_code, data, 'STATUS')
+    else:
+      response_code, list_data = imap4_ssl.list()
+      status_data = []
+    logging.debug(f"IMAPReader -> list_mailboxes : response code {response_code}")
+    mailboxes = [mailbox for mailbox in (parse_list_response(item) for item in list_data or []) if mailbox]
+
+    selectable = [mailbox['name'] for mailbox in mailboxes if '\\NOSELECT' not in (flag.upper() for flag in mailbox['flags'])]
+    if selectable and not status_data:
+      tags = [imap4_ssl._command('STATUS', imap4_ssl._quote(name), items) for name in selectable]
+      for tag in tags:
+        try:
+          imap4_ssl._command_complete('STATUS', tag)
+        except imaplib.IMAP4.abort:
+          raise
+        except imaplib.IMAP4.error as error:
+          # One bad mailbox should not hide the others
+          logging.debug(f"IMAPReader -> list_mailboxes : STATUS failed {error}")
+      _, status_data = imap4_ssl._untagged_response('OK', [None], 'STATUS')
+
+    statuses = dict(parsed for parsed in (parse_status_response(item) for item in status_data or [] if item) if parsed)
+    for mailbox in mailboxes:
+      mailbox['status'] = statuses.get(mailbox['name'])
+    return mailboxes
+
+  def get_mail(self, mailbox: str = 'INBOX', before_uid: int = None, limit: int = None) -> list:
     """Get all messages in mailbox
 
     Args:
-      None
+      before_uid: (optional) Only messages with a lower UID, used to continue a partial result
+      limit: (optional) Only fetch the newest limit messages
     
     Returns:
       List of email.message.Message
@@ -66,13 +563,10 @@ class IMAPReader:
 
     self.select_mailbox_and_get_email_count_in_mailbox()
     
-    response_code, mail_ids = self.imap4_ssl.search(None, 'ALL')
+    response_code, mail_ids = self.search(before_uid, 'ALL')
     logging.debug(f"IMAPReader -> get_mail : response code {response_code}, mail_ids {mail_ids}")
 
-    messages = self.fetch_emails(mail_ids)
-
-    # Reverse the list so emails are sorted newest to oldest
-    messages.reverse() 
+    messages = self.fetch_emails(mail_ids, limit)
     return messages
 
   def get_email_body(self, message: email.message.EmailMessage, format: str="") -> str:
@@ -91,17 +585,24 @@ class IMAPReader:
     if not message_type_is_valid:
       raise AttributeError('Invalid "message" type. Expected type to be email.message.EmailMessage')
     if format == 'plain' or format == 'html':
+      if self.message_cache is not None:
+        body = self.message_cache.get_field(message, format)
+        if body is not None:
+          return body
       email_body = message.get_body(preferencelist=(format)).as_string()
       body = email_body.split('\n\n', 1)[1]
+      if self.message_cache is not None:
+        self.message_cache.set_field(message, format, body)
     else:
       raise AttributeError('Invalid "format". Expected plain or html')
     return body
 
-  def get_emails_with_subject(self, search_string: str, mailbox: str = 'INBOX'):
+  def get_emails_with_subject(self, search_string: str, mailbox: str = 'INBOX', before_uid: int = None):
     """Get emails with subject containing <search string>
 
     Args:
       search_string: String to search for email subject
+      before_uid: (optional) Only messages with a lower UID, used to continue a partial result
 
     Returns:
       List of email.messages.Message
@@ -111,20 +612,18 @@ class IMAPReader:
     self.select_mailbox_and_get_email_count_in_mailbox()
     logging.debug(f"IMAPReader -> get_emails_with_subject: {search_string}")
     
-    response_code, mail_ids = self.imap4_ssl.search(None, 'SUBJECT', search_string)
+    response_code, mail_ids = self.search(before_uid, 'SUBJECT', search_string)
     logging.debug(f"IMAPReader -> get_mail : response code {response_code}, mail_ids {mail_ids}")
 
     messages = self.fetch_emails(mail_ids)
-
-    # Reverse the list so emails are sorted newest to oldest
-    messages.reverse() 
     return messages
 
-  def get_emails_with_body(self, search_string, mailbox='INBOX') -> list:
+  def get_emails_with_body(self, search_string, mailbox='INBOX', before_uid: int = None) -> list:
     """Get emails with body containing <search string>
 
     Args:
       search_string: String to search for email body
+      before_uid: (optional) Only messages with a lower UID, used to continue a partial result
 
     Returns:
       List of email.messages.Message
@@ -134,75 +633,202 @@ class IMAPReader:
     self.select_mailbox_and_get_email_count_in_mailbox()
     logging.debug(f"IMAPReader -> get_emails_with_body: {search_string}")
     
-    response_code, mail_ids = self.imap4_ssl.search(None, 'BODY', search_string)
+    response_code, mail_ids = self.search(before_uid, 'BODY', search_string)
     logging.debug(f"IMAPReader -> get_mail : response code {response_code}, mail_ids {mail_ids}")
     
     messages = self.fetch_emails(mail_ids)
-
-    # Reverse the list so emails are sorted newest to oldest
-    messages.reverse() 
     return messages
 
-  def get_emails_since_date(self, start_date, mailbox='INBOX'):
-    """Get emails since <date and time in ISO 8601 format>
+  def search(self, before_uid: int = None, *criteria) -> tuple:
+    """SEARCH the selected mailbox, optionally limited to UIDs below before_uid
+
+    Returns:
+      Tuple of response code and list with the space separated sequence numbers
+    """
+    if before_uid is not None:
+      if before_uid <= 1:
+        return ('OK', [b''])
+      criteria = ('UID', f"1:{before_uid - 1}") + criteria
+    with phase('search'):
+      return self.imap4_ssl.search(None, *criteria)
+
+  def search_uids(self, *criteria) -> list:
+    """Search the selected mailbox and return UIDs instead of sequence numbers
 
     Args:
-      start_date: Start date and time in ISO 8601 format
+      criteria: IMAP search keys e.g. 'SINCE', '01-Feb-2023'. Defaults to ALL
 
     Returns:
-      List of email.messages.Message
-
-    Raises:
-      ValueError: If invalid date / time string is provided.
+      List of UIDs (int) in ascending order
     """
-    messages = []
+    with phase('search'):
+      response_code, uids = self.imap4_ssl.uid('SEARCH', *(criteria or ('ALL',)))
+    logging.debug(f"IMAPReader -> search_uids : response code {response_code}")
+    return sorted(int(uid) for uid in uids[0].split()) if uids and uids[0] else []
 
-    self.select_mailbox_and_get_email_count_in_mailbox()
+  def fetch_raw_messages(self, uids: list) -> list:
+    """Fetch unparsed messages for a batch of UIDs in a single UID FETCH command
 
-    formatted_start_date = self.iso8601_datetime_to_rfc2822_date_string(start_date)
+    BODY.PEEK[] is used so the messages are not marked as \\Seen.
 
-    logging.debug(f"IMAPReader -> get_emails_since_date: {formatted_start_date}")
-    
-    # IMAP protocol - https://www.rfc-editor.org/rfc/rfc3501#section-6.4.4
-    # Date format - https://www.rfc-editor.org/rfc/rfc2822#section-3.3
-    # SEARCH SINCE 1-Feb-1994
-    response_code, mail_ids = self.imap4_ssl.search(None, 'SINCE', formatted_start_date)
-    logging.debug(f"IMAPReader -> get_mail : response code {response_code}, mail_ids {mail_ids}")
-    
-    messages = self.fetch_emails(mail_ids)
+    Args:
+      uids: List of UIDs
 
-    # Reverse the list so emails are sorted newest to oldest
-    messages.reverse() 
+    Returns:
+      List of tuples (uid, raw RFC822 bytes) in the order returned by the server
+    """
+    if not uids:
+      return []
+    message_set = ','.join(str(uid) for uid in uids)
+    response_code, mail_data = self.imap4_ssl.uid('FETCH', message_set, '(UID BODY.PEEK[])')
+    logging.debug(f"IMAPReader -> fetch_raw_messages : response code {response_code}, {len(uids)} uids")
+    messages = []
+    for item in mail_data:
+      # Literals are returned as (b'1 (UID 42 BODY[] {460}', b'<message>'), the closing b')' is skipped
+      if isinstance(item, tuple):
+        messages.append((parse_uid(item[0]), item[1]))
     return messages
 
+  def get_emails_between(self, since: datetime = None, until: datetime = None, mailbox='INBOX', before_uid: int = None) -> list:
+    """Get emails received (INTERNALDATE) from since up to but not including until
+
+    SEARCH SINCE / BEFORE only match whole days in the server timezone. With the WITHIN
+    extension (RFC 5032) SEARCH YOUNGER / OLDER is used instead. Either search is narrowed
+    to the exact window with one FETCH (INTERNALDATE) before any message is downloaded, as
+    YOUNGER / OLDER are relative to the clock of this service rather than the server.
+
+    Args:
+      since: (optional) Timezone aware start
+      until: (optional) Timezone aware end
+      before_uid: (optional) Only messages with a lower UID, used to continue a partial result
 
-  def fetch_emails(self, mail_ids):
+    Returns:
+      List of email.messages.Message
+    """
+    self.select_mailbox_and_get_email_count_in_mailbox(mailbox)
+    now = datetime.now(timezone.utc)
+    if (since is not None and since > now) or (since is not None and until is not None and since >= until):
+      return []
+
+    criteria = []
+    if self.imap4_ssl.has_capability('WITHIN'):
+      # Relative to this clock, rounded outwards, the exact window is applied below
+      if since is not None:
+        criteria += ['YOUNGER', str(math.ceil((now - since).total_seconds()))]
+      if until is not None and until < now:
+        criteria += ['OLDER', str(int((now - until).total_seconds()))]
+    else:
+      # Widen the UTC dates by a day either side, the server may be in any timezone
+      if since is not None:
+        criteria += ['SINCE', (since.astimezone(timezone.utc) - timedelta(days=1)).strftime("%d-%b-%Y")]
+      if until is not None:
+        criteria += ['BEFORE', (until.astimezone(timezone.utc) + timedelta(days=2)).strftime("%d-%b-%Y")]
+    response_code, mail_ids = self.search(before_uid, *(criteria or ['ALL']))
+    logging.debug(f"IMAPReader -> get_emails_between : response code {response_code}, mail_ids {mail_ids}")
+    candidate_ids = [int(mail_id) for mail_id in mail_ids[0].split()] if mail_ids and mail_ids[0] else []
+    if not candidate_ids or (since is None and until is None):
+      return self.fetch_emails(mail_ids)
+
+    response_code, internaldates = self.imap4_ssl.fetch(to_sequence_set(candidate_ids), '(UID INTERNALDATE)')
+    matching_ids = []
+    for item in internaldates or []:
+      parsed = parse_internaldate_response(item if isinstance(item, bytes) else b'')
+      if parsed is None:
+        continue
+      mail_id, internaldate = parsed
+      if (since is None or internaldate >= since) and (until is None or internaldate < until):
+        matching_ids.append(mail_id)
+    logging.debug(f"IMAPReader -> get_emails_between : {len(matching_ids)} of {len(candidate_ids)} messages in range")
+    return self.fetch_emails([' '.join(str(mail_id) for mail_id in sorted(matching_ids)).encode('utf-8')])
+
+  def fetch_emails(self, mail_ids, limit: int = None):
     """Fetch emails from server given a list of mail IDs
 
+    Messages are fetched newest first. If the deadline passes part way through, the
+    messages fetched so far are returned, partial is set and cursor is the UID to
+    continue from (pass it as before_uid).
+
     Args:
       mail_ids: A list of mail IDs
+      limit: (optional) Only fetch the newest limit of mail_ids
 
     Returns:
-      List of email.message.Message.
+      List of email.message.Message sorted newest to oldest.
 
     Raises:
       IMAP4.error: Exception raised on any errors. The reason for the exception is passed to the constructor as a string.
       IMAP4.abort: IMAP4 server errors cause this exception to be raised.
     """
     messages = []
+    self.partial = False
+    self.cursor = None
 
     # Sample response -> ('OK', [b'1 2 3 4 5'])
     # response_code, mail_ids = ('OK', [b'1 2 3 4 5'])
-    for mail_id in mail_ids[0].decode('utf-8').split():
-      response_code, mail_data = self.imap4_ssl.fetch(mail_id, '(RFC822)')
-      
+    mail_ids = mail_ids[0].decode('utf-8').split()
+    if limit is not None:
+      mail_ids = mail_ids[max(len(mail_ids) - limit, 0):]
+    # With a message cache the UIDs are looked up first so cached messages are not downloaded again
+    uids = self.fetch_uids(mail_ids) if self.message_cache is not None and mail_ids else {}
+    for mail_id in reversed(mail_ids):
+      if self.deadline_expired():
+        self.partial = True
+        break
+      message = self.cached_message(uids.get(mail_id))
+      if message is not None:
+        messages.append(message)
+        self.cursor = uids[mail_id]
+        continue
+      try:
+        with phase('fetch'):
+          response_code, mail_data = self.imap4_ssl.fetch(mail_id, '(UID RFC822)')
+      except (imaplib.IMAP4.abort, OSError):
+        if not self.deadline_expired():
+          raise
+        # Timed out mid-response, the connection is out of step with the server
+        self.broken = True
+        self.partial = True
+        break
+
       logging.debug(f"IMAPReader -> fetch_emails : response code {response_code}")
-      
-      message = email.message_from_bytes(mail_data[0][1], policy=default_policy)
+
+      with phase('parse'):
+        message = email.message_from_bytes(mail_data[0][1], policy=default_policy)
       messages.append(message)
+      self.cursor = parse_uid(mail_data[0][0])
+      self.index_message(message, self.cursor)
+      self.cache_message(message, self.cursor, len(mail_data[0][1]))
+    logging.debug(f"IMAPReader -> fetch_emails : {len(messages)} messages, partial {self.partial}")
     return messages
 
-  def iso8601_datetime_to_rfc2822_date_string(self, iso_date_time_string):
+  @staticmethod
+  def parse_iso8601_datetime(iso_date_time_string) -> datetime:
+    """Parse a date / time string in ISO 8601 format, keeping the time and timezone
+
+    Args:
+      iso_date_time_string: e.g. 2023-02-04T15:26:44.920Z, 2023-02-04T15:26:44+09:00 or 2023-02-04
+
+    Returns:
+      Timezone aware datetime, UTC is assumed when no timezone is given
+
+    Raises:
+      ValueError: If invalid date / time string is provided.
+    """
+    if not isinstance(iso_date_time_string, str):
+      raise ValueError("Invalid ISO 8601 string")
+    value = iso_date_time_string.strip()
+    if value.endswith(('Z', 'z')):
+      value = value[:-1] + '+00:00'
+    try:
+      date_time = datetime.fromisoformat(value)
+    except ValueError:
+      raise ValueError("Invalid ISO 8601 string")
+    if date_time.tzinfo is None:
+      date_time = date_time.replace(tzinfo=timezone.utc)
+    return date_time
+
+  @staticmethod
+  def iso8601_datetime_to_rfc2822_date_string(iso_date_time_string):
     """Converts a date / time string in ISO 8601 format to RFC2822 Date format
 
     Args:
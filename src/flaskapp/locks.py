@@ -0,0 +1,57 @@
+try:
+  import fcntl
+except ImportError:
+  # Windows
+  fcntl = None
+  import msvcrt
+
+class LeaderLock:
+  """Non blocking exclusive lock on a file, held by at most one process at a time
+
+  The operating system drops the lock when the owning process exits, so another
+  worker can take over after a crash.
+
+  Args:
+    path: Lock file path
+  """
+  def __init__(self, path: str):
+    self.path = path
+    self.file = None
+
+  @property
+  def held(self) -> bool:
+    return self.file is not None
+
+  def acquire(self) -> bool:
+    """Try to take the lock without waiting
+
+    Returns:
+      True if this process holds the lock
+    """
+    if self.file is not None:
+      return True
+    lock_file = open(self.path, 'a+b')
+    try:
+      if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+      lock_file.close()
+      return False
+    self.file = lock_file
+    return True
+
+  def release(self) -> None:
+    if self.file is None:
+      return
+    try:
+      if fcntl is not None:
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+      else:
+        self.file.seek(0)
+        msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+      self.file.close()
+      self.file = None
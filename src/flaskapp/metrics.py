@@ -0,0 +1,28 @@
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+
+def increment(name: str, value: int = 1) -> None:
+  """Add value to the named counter, creating it if needed
+
+  Args:
+    name: Counter name e.g. imap_bytes_sent
+    value: (optional) Amount to add. Defaults to 1
+  """
+  with _lock:
+    _counters[name] = _counters.get(name, 0) + value
+
+def snapshot() -> dict:
+  """Get a copy of all counters
+
+  Returns:
+    Dictionary of counter name to value
+  """
+  with _lock:
+    return dict(_counters)
+
+def reset() -> None:
+  """Clear all counters"""
+  with _lock:
+    _counters.clear()
@@ -0,0 +1,191 @@
+import os
+import re
+import io
+import hmac
+import time
+import uuid
+import asyncio
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+
+from fastapi.routing import APIRoute
+
+# Profile of the request being handled, None when the request is not profiled
+current_profile = ContextVar('current_profile', default=None)
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# cProfile can only profile one request at a time
+profiler_lock = threading.Lock()
+
+class RequestProfile:
+  """Phase timings and cProfile data of one request"""
+  def __init__(self):
+    self.id = uuid.uuid4().hex
+    self.phases = {}
+    self.profiler = None
+
+  def record(self, name: str, seconds: float) -> None:
+    """Add to the time of a phase, phases run more than once (e.g. per message) are summed"""
+    self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+  def server_timing(self) -> str:
+    """Server-Timing header value e.g. session;dur=12.1, fetch;dur=80.4"""
+    return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items())
+
+@contextmanager
+def phase(name: str):
+  """Time a block as a Server-Timing phase of the current request, does nothing when not profiling"""
+  profile = current_profile.get()
+  if profile is None:
+    yield
+    return
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    profile.record(name, time.perf_counter() - started)
+
+@contextmanager
+def profiled():
+  """cProfile the calling thread for the rest of the block if the current request is profiled
+
+  cProfile only sees the thread it was enabled in, and sync endpoints run in a worker thread,
+  so this is entered around the endpoint (see ProfiledRoute) rather than in the middleware.
+  If another request is being profiled only timings are recorded.
+  """
+  profile = current_profile.get()
+  if profile is None or profile.profiler is not None or not profiler_lock.acquire(blocking=False):
+    yield
+    return
+  # Imported here so the service does not load the profiler unless a request asks for it
+  import cProfile
+  profile.profiler = cProfile.Profile()
+  profile.profiler.enable()
+  try:
+    yield
+  finally:
+    profile.profiler.disable()
+    profiler_lock.release()
+
+def admin_token_valid(token: str, admin_token: str) -> bool:
+  """Compare an X-Admin-Token header with the configured token, always False if none is configured"""
+  return bool(admin_token) and hmac.compare_digest(token.encode('utf-8'), admin_token.encode('utf-8'))
+
+def profiled_endpoint(endpoint):
+  """Wrap a sync endpoint so it runs under profiled() in its worker thread"""
+  if asyncio.iscoroutinefunction(endpoint):
+    return endpoint
+
+  @functools.wraps(endpoint)
+  def wrapper(*args, **kwargs):
+    with phase('handler'), profiled():
+      return endpoint(*args, **kwargs)
+  return wrapper
+
+class ProfiledRoute(APIRoute):
+  """APIRoute whose endpoint can be profiled, use as the router route_class"""
+  def __init__(self, path: str, endpoint, **kwargs):
+    super().__init__(path, profiled_endpoint(endpoint), **kwargs)
+
+class ProfileStore:
+  """Directory of cProfile dumps (pstats format), the oldest are deleted beyond max_profiles
+
+  Args:
+    profile_dir: Directory the profiles are written to
+    max_profiles: (optional) Number of profiles kept. Defaults to 20
+  """
+  def __init__(self, profile_dir: str, max_profiles: int = 20):
+    self.profile_dir = profile_dir
+    self.max_profiles = max_profiles
+
+  def path(self, profile_id: str):
+    """Returns:
+      Path of a stored profile or None
+    """
+    if not PROFILE_ID_PATTERN.match(profile_id):
+      return None
+    path = os.path.join(self.profile_dir, f"{profile_id}.prof")
+    return path if os.path.exists(path) else None
+
+  def save(self, profile: RequestProfile) -> str:
+    os.makedirs(self.profile_dir, exist_ok=True)
+    path = os.path.join(self.profile_dir, f"{profile.id}.prof")
+    profile.profiler.dump_stats(path)
+    profiles = sorted((os.path.join(self.profile_dir, name) for name in os.listdir(self.profile_dir) if name.endswith('.prof')), key=os.path.getmtime)
+    for old_path in profiles[:-self.max_profiles]:
+      try:
+        os.remove(old_path)
+      except OSError:
+        pass
+    logging.info(f"ProfileStore -> save : {path}")
+    return path
+
+  def text(self, profile_id: str, limit: int = 50):
+    """Returns:
+      Most expensive functions by cumulative time as text, None if the profile does not exist
+    """
+    path = self.path(profile_id)
+    if path is None:
+      return None
+    import pstats
+    output = io.StringIO()
+    pstats.Stats(path, stream=output).sort_stats('cumulative').print_stats(limit)
+    return output.getvalue()
+
+class ProfilingMiddleware:
+  """ASGI middleware profiling requests with ?profile=1 and a valid X-Admin-Token header, or every request with always
+
+  Profiled responses get a Server-Timing header and, when cProfile ran, X-Profile-Id to
+  download the profile with. Other requests only pay for one check of the query string.
+
+  Args:
+    app: ASGI application
+    store: ProfileStore
+    admin_token: (optional) Token required in X-Admin-Token, per request profiling is off without one
+    always: (optional) Profile every request. Defaults to False
+  """
+  def __init__(self, app, store: ProfileStore, admin_token: str = None, always: bool = False):
+    self.app = app
+    self.store = store
+    self.admin_token = admin_token
+    self.always = always
+
+  def requested(self, scope) -> bool:
+    if self.always:
+      return True
+    if not self.admin_token or b'profile=' not in scope.get('query_string', b''):
+      return False
+    if parse_qs(scope['query_string'].decode('latin-1')).get('profile') not in (['1'], ['true']):
+      return False
+    return admin_token_valid(dict(scope.get('headers') or []).get(b'x-admin-token', b'').decode('latin-1'), self.admin_token)
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http' or not self.requested(scope):
+      await self.app(scope, receive, send)
+      return
+
+    profile = RequestProfile()
+    token = current_profile.set(profile)
+    started = time.perf_counter()
+
+    async def send_with_timing(message):
+      if message['type'] == 'http.response.start':
+        profile.record('total', time.perf_counter() - started)
+        headers = list(message.get('headers', []))
+        headers.append((b'server-timing', profile.server_timing().encode('latin-1')))
+        if profile.profiler is not None:
+          headers.append((b'x-profile-id', profile.id.encode('latin-1')))
+        message = {**message, 'headers': headers}
+      await send(message)
+
+    try:
+      await self.app(scope, receive, send_with_timing)
+    finally:
+      current_profile.reset(token)
+      if profile.profiler is not None:
+        self.store.save(profile)
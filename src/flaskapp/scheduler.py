@@ -0,0 +1,231 @@
+import math
+import time
+import imaplib
+import heapq
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+class SchedulerBusy(Exception):
+  """Raised when a session can not be handed out
+
+  Args:
+    message: Error detail
+    retry_after: Suggested number of seconds to wait before retrying
+  """
+  def __init__(self, message: str, retry_after: int):
+    super().__init__(message)
+    self.retry_after = retry_after
+
+class QueueFull(SchedulerBusy):
+  """The wait queue is full, the request is rejected without waiting"""
+
+class QueueTimeout(SchedulerBusy):
+  """The request deadline passed while waiting in the queue"""
+
+class SessionScheduler:
+  """Admission control for upstream IMAP sessions
+
+  Every request gets a logged in IMAPReader for its exclusive use. At most max_sessions
+  readers are in use at once, further requests wait in a bounded queue ordered by
+  deadline (earliest first) and are rejected straight away when the queue is full.
+  Released readers are kept logged in and handed to the next request.
+
+  Background work (exports, syncs, webhooks) waits behind every queued request, never
+  counts against the queue size and is limited to max_background sessions so the
+  rest stay available for requests.
+
+  Args:
+    reader_factory: Callable returning a new (not logged in) IMAPReader
+    max_sessions: (optional) Maximum number of upstream sessions. Defaults to 4
+    max_queue: (optional) Maximum number of waiting requests. Defaults to 16
+    queue_timeout: (optional) Seconds a request waits when no deadline is given. Defaults to 10
+    idle_timeout: (optional) Seconds an idle session is kept for reuse. Defaults to 300
+    max_background: (optional) Maximum number of sessions used by background work. Defaults to half of max_sessions, at least 1
+  """
+  # Idle sessions older than this are checked with NOOP before reuse
+  NOOP_AFTER_SECONDS = 30
+
+  def __init__(self, reader_factory, max_sessions: int = 4, max_queue: int = 16, queue_timeout: float = 10, idle_timeout: float = 300, max_background: int = None):
+    self.reader_factory = reader_factory
+    self.max_sessions = max_sessions
+    self.max_background = max(1, max_sessions // 2) if max_background is None else max_background
+    self.max_queue = max_queue
+    self.queue_timeout = queue_timeout
+    self.idle_timeout = idle_timeout
+    self.active = 0
+    self.background_active = 0
+    self.idle = []
+    self.waiters = []
+    self.counter = itertools.count()
+    self.condition = threading.Condition()
+    # Moving average of how long a session is held, used for Retry-After
+    self.average_hold_seconds = 1.0
+
+  def retry_after(self) -> int:
+    """Estimate in seconds until a queued request would get a session"""
+    waiting = len(self.waiters) + 1
+    return max(1, math.ceil(self.average_hold_seconds * waiting / self.max_sessions))
+
+  def acquire(self, deadline: float = None, background: bool = False):
+    """Wait for a free session slot and return a logged in IMAPReader
+
+    Args:
+      deadline: (optional) time.monotonic() value by which the request has to finish.
+        It limits the wait for a session and is handed to the reader. Without one the
+        request waits up to queue_timeout and the reader has no deadline
+      background: (optional) Wait as background work, for as long as it takes. The deadline is ignored
+
+    Returns:
+      IMAPReader
+
+    Raises:
+      QueueFull: If the wait queue is full.
+      QueueTimeout: If the deadline passed while waiting.
+      IMAP4.error: If login fails.
+      OSError: If the server can not be reached in time.
+    """
+    request_deadline = None if deadline is None or math.isinf(deadline) or background else deadline
+    if deadline is None:
+      deadline = time.monotonic() + self.queue_timeout
+    with self.condition:
+      if background:
+        while self.waiters or self.active >= self.max_sessions or self.background_active >= self.max_background:
+          self.condition.wait()
+        self.background_active += 1
+      elif self.active >= self.max_sessions or self.waiters:
+        if len(self.waiters) >= self.max_queue:
+          metrics.increment('scheduler_rejected')
+          raise QueueFull("Too many requests", self.retry_after())
+        waiter = (deadline, next(self.counter))
+        heapq.heappush(self.waiters, waiter)
+        metrics.increment('scheduler_queued')
+        while not (self.waiters[0] == waiter and self.active < self.max_sessions):
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            self.waiters.remove(waiter)
+            heapq.heapify(self.waiters)
+            self.condition.notify_all()
+            metrics.increment('scheduler_timed_out')
+            raise QueueTimeout("Timed out waiting for an IMAP session", self.retry_after())
+          self.condition.wait(None if math.isinf(remaining) else remaining)
+        heapq.heappop(self.waiters)
+        # The next waiter may also fit if several sessions were released
+        self.condition.notify_all()
+      self.active += 1
+      idle = self.idle.pop() if self.idle else None
+
+    try:
+      reader = self._reuse(*idle, request_deadline) if idle else None
+      if reader is None:
+        reader = self.reader_factory()
+        reader.deadline = request_deadline
+        reader.login()
+        metrics.increment('scheduler_sessions_opened')
+    except BaseException:
+      with self.condition:
+        self.active -= 1
+        if background:
+          self.background_active -= 1
+        self.condition.notify_all()
+      raise
+    reader.deadline = request_deadline
+    reader.background = background
+    reader.acquired_at = time.monotonic()
+    return reader
+
+  def release(self, reader, healthy: bool = True) -> None:
+    """Return a reader, unhealthy readers are logged out instead of reused"""
+    now = time.monotonic()
+    reader.deadline = None
+    healthy = healthy and not getattr(reader, 'broken', False)
+    with self.condition:
+      self.active -= 1
+      if getattr(reader, 'background', False):
+        self.background_active -= 1
+        reader.background = False
+      hold_seconds = now - getattr(reader, 'acquired_at', now)
+      self.average_hold_seconds = 0.8 * self.average_hold_seconds + 0.2 * hold_seconds
+      if healthy:
+        self.idle.append((reader, now))
+      self.condition.notify_all()
+    if not healthy:
+      self._discard(reader)
+
+  def prewarm(self, count: int) -> threading.Thread:
+    """Log in up to count sessions in a background thread and keep them idle for the first requests
+
+    Prewarming stops early when the pool is busy or a login fails, requests never wait for it.
+
+    Returns:
+      The started thread
+    """
+    def run():
+      for _ in range(count):
+        with self.condition:
+          if self.active + len(self.idle) >= self.max_sessions or self.waiters:
+            return
+          # Reserve the slot like a request would
+          self.active += 1
+        reader = None
+        try:
+          reader = self.reader_factory()
+          reader.login()
+          metrics.increment('scheduler_sessions_opened')
+          metrics.increment('scheduler_sessions_prewarmed')
+        except Exception:
+          logging.exception("SessionScheduler -> prewarm : login failed")
+          reader = None
+        finally:
+          with self.condition:
+            self.active -= 1
+            if reader is not None:
+              self.idle.append((reader, time.monotonic()))
+            self.condition.notify_all()
+        if reader is None:
+          return
+
+    thread = threading.Thread(target=run, name='prewarm', daemon=True)
+    thread.start()
+    return thread
+
+  @contextmanager
+  def session(self, deadline: float = None, background: bool = False):
+    """Context manager around acquire and release, see acquire"""
+    reader = self.acquire(deadline, background)
+    healthy = True
+    try:
+      yield reader
+    except (imaplib.IMAP4.abort, OSError):
+      # Connection errors (including socket timeouts) leave the session in an unknown state
+      healthy = False
+      raise
+    finally:
+      self.release(reader, healthy)
+
+  def _reuse(self, reader, idle_since: float, deadline: float = None):
+    """Return the idle reader if it is still usable, None otherwise"""
+    reader.deadline = deadline
+    idle_seconds = time.monotonic() - idle_since
+    if idle_seconds > self.idle_timeout:
+      self._discard(reader)
+      return None
+    if idle_seconds > self.NOOP_AFTER_SECONDS:
+      try:
+        reader.noop()
+      except Exception:
+        logging.debug("SessionScheduler -> reuse : idle session is gone")
+        self._discard(reader)
+        return None
+    metrics.increment('scheduler_sessions_reused')
+    return reader
+
+  def _discard(self, reader) -> None:
+    try:
+      reader.close()
+    except Exception:
+      pass
+    metrics.increment('scheduler_sessions_closed')
@@ -0,0 +1,173 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from exporter import message_to_jsonl
+from locks import LeaderLock
+import metrics
+
+class SharedStore:
+  """Messages of one mailbox in a SQLite database shared by all uvicorn workers
+
+  The database is opened in WAL mode so readers in every worker do not block the
+  single writer (the elected syncer) and always see the last committed sync.
+
+  Args:
+    path: Database file path
+  """
+  def __init__(self, path: str):
+    self.path = path
+    self.local = threading.local()
+    with self.connection() as connection:
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('CREATE TABLE IF NOT EXISTS messages (mailbox TEXT NOT NULL, uid INTEGER NOT NULL, message TEXT NOT NULL, PRIMARY KEY (mailbox, uid))')
+      connection.execute('CREATE TABLE IF NOT EXISTS mailboxes (mailbox TEXT PRIMARY KEY, uidvalidity INTEGER, synced_at REAL)')
+
+  def connection(self) -> sqlite3.Connection:
+    """Connection for the calling thread, sqlite3 connections can not be shared between threads"""
+    connection = getattr(self.local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=30)
+      connection.execute('PRAGMA synchronous=NORMAL')
+      self.local.connection = connection
+    return connection
+
+  def sync_state(self, mailbox: str = 'INBOX') -> tuple:
+    """Returns:
+      Tuple (uidvalidity, synced_at), both None if the mailbox was never synced
+    """
+    row = self.connection().execute('SELECT uidvalidity, synced_at FROM mailboxes WHERE mailbox = ?', (mailbox,)).fetchone()
+    return row if row else (None, None)
+
+  def synced(self, mailbox: str = 'INBOX', max_age: float = None) -> bool:
+    """Returns:
+      True if a sync has finished, within the last max_age seconds if given
+    """
+    synced_at = self.sync_state(mailbox)[1]
+    return synced_at is not None and (max_age is None or time.time() - synced_at <= max_age)
+
+  def uids(self, mailbox: str = 'INBOX') -> set:
+    rows = self.connection().execute('SELECT uid FROM messages WHERE mailbox = ?', (mailbox,))
+    return {row[0] for row in rows}
+
+  def messages(self, mailbox: str = 'INBOX', limit: int = None, before_uid: int = None) -> list:
+    """Stored messages newest (highest UID) first
+
+    Args:
+      limit: (optional) Maximum number of messages
+      before_uid: (optional) Only messages with a lower UID
+
+    Returns:
+      List of message dicts with to, from, subject, date, body and uid
+    """
+    query = 'SELECT message FROM messages WHERE mailbox = ?'
+    parameters = [mailbox]
+    if before_uid is not None:
+      query += ' AND uid < ?'
+      parameters.append(before_uid)
+    query += ' ORDER BY uid DESC'
+    if limit is not None:
+      query += ' LIMIT ?'
+      parameters.append(limit)
+    metrics.increment('shared_store_reads')
+    return [json.loads(row[0]) for row in self.connection().execute(query, parameters)]
+
+  def message(self, uid: int, mailbox: str = 'INBOX'):
+    """Returns:
+      Message dict or None if not stored
+    """
+    row = self.connection().execute('SELECT message FROM messages WHERE mailbox = ? AND uid = ?', (mailbox, uid)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def apply(self, mailbox: str, uidvalidity: int, added: list, removed: set = (), complete: bool = True) -> None:
+    """Commit part of a sync in a single transaction
+
+    Args:
+      uidvalidity: UIDVALIDITY of the mailbox, a change drops every stored message
+      added: List of tuples (uid, message dict)
+      removed: (optional) UIDs expunged from the mailbox
+      complete: (optional) False while more batches follow, the sync time is only recorded at the end
+    """
+    connection = self.connection()
+    with connection:
+      stored_uidvalidity, synced_at = self.sync_state(mailbox)
+      if stored_uidvalidity is not None and stored_uidvalidity != uidvalidity:
+        connection.execute('DELETE FROM messages WHERE mailbox = ?', (mailbox,))
+        synced_at = None
+      connection.executemany('DELETE FROM messages WHERE mailbox = ? AND uid = ?', [(mailbox, uid) for uid in removed])
+      connection.executemany('INSERT OR REPLACE INTO messages (mailbox, uid, message) VALUES (?, ?, ?)',
+        [(mailbox, uid, json.dumps(message)) for uid, message in added])
+      connection.execute('INSERT OR REPLACE INTO mailboxes (mailbox, uidvalidity, synced_at) VALUES (?, ?, ?)',
+        (mailbox, uidvalidity, time.time() if complete else synced_at))
+
+class SharedSync:
+  """Keeps a SharedStore up to date from IMAP in the one worker holding the leader lock
+
+  Every worker runs the loop but only the lock holder talks to the IMAP server, the
+  others retry the lock each interval and take over if the leader exits.
+
+  Args:
+    store: SharedStore
+    lock: LeaderLock
+    session_factory: Callable returning a context manager that yields a logged in IMAPReader
+    interval: (optional) Seconds between syncs. Defaults to 30
+    mailbox: (optional) Mailbox to sync. Defaults to INBOX
+    batch_size: (optional) Messages per UID FETCH. Defaults to 50
+  """
+  def __init__(self, store: SharedStore, lock: LeaderLock, session_factory, interval: float = 30, mailbox: str = 'INBOX', batch_size: int = 50):
+    self.store = store
+    self.lock = lock
+    self.session_factory = session_factory
+    self.interval = interval
+    self.mailbox = mailbox
+    self.batch_size = batch_size
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def start(self) -> None:
+    self.thread = threading.Thread(target=self.run, name='shared-sync', daemon=True)
+    self.thread.start()
+
+  def stop(self) -> None:
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join(timeout=5)
+    self.lock.release()
+
+  def run(self) -> None:
+    while not self.stopped.is_set():
+      if self.lock.acquire():
+        try:
+          self.sync()
+        except Exception:
+          logging.exception("SharedSync -> run : sync failed")
+          metrics.increment('shared_sync_failed')
+      self.stopped.wait(self.interval)
+
+  def sync(self) -> None:
+    """Store new messages and drop expunged ones, only UIDs not in the store are fetched
+
+    Each batch is committed on its own so a large first sync is not held in memory.
+    """
+    added_count = 0
+    with self.session_factory() as reader:
+      reader.select_mailbox_and_get_email_count_in_mailbox(self.mailbox)
+      stored_uidvalidity = self.store.sync_state(self.mailbox)[0]
+      stored_uids = self.store.uids(self.mailbox) if stored_uidvalidity == reader.uidvalidity else set()
+      server_uids = reader.search_uids()
+      new_uids = [uid for uid in server_uids if uid not in stored_uids]
+      removed_uids = stored_uids.difference(server_uids)
+
+      # Newest first so an interrupted first sync has stored the latest messages, the next
+      # sync keeps them and fetches only the rest. Followers wait until the last batch.
+      new_uids.reverse()
+      batches = [new_uids[index:index + self.batch_size] for index in range(0, len(new_uids), self.batch_size)] or [[]]
+      for number, batch in enumerate(batches, start=1):
+        added = [(uid, json.loads(message_to_jsonl(reader, uid, raw_message))) for uid, raw_message in reader.fetch_raw_messages(batch)]
+        self.store.apply(self.mailbox, reader.uidvalidity, added, removed_uids if number == 1 else (), complete=number == len(batches))
+        added_count += len(added)
+    metrics.increment('shared_sync_runs')
+    metrics.increment('shared_sync_messages', added_count)
+    logging.debug(f"SharedSync -> sync : {added_count} added, {len(removed_uids)} removed")
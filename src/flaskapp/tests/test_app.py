@@ -11,7 +11,12 @@ from http import HTTPStatus
 import importlib
 
 from imapreader import IMAPReader
-from app import app
+from app import app, scheduler, mailbox_status_cache
+from scheduler import QueueFull, QueueTimeout
+from exporter import ExportManager
+from sharedstore import SharedStore
+from webhooks import WebhookStore, WebhookManager
+import app as app_module
 
 
 class TestApp(object):
@@ -112,8 +117,8 @@ class TestApp(object):
       def mock_close(self):
           return None
 
-      def mock_get_mail(self):
-        return read_messages_from_file(input_filename)
+      def mock_get_mail(self, limit=None):
+        return read_messages_from_file(input_filename)[:limit]
 
       monkeypatch.setattr(IMAPReader, "login", mock_login)
       monkeypatch.setattr(IMAPReader, "close", mock_close)
@@ -151,8 +156,8 @@ class TestApp(object):
       def mock_close(self):
           return None
 
-      def mock_get_mail(self):
-        return read_messages_from_file(input_filenames)
+      def mock_get_mail(self, before_uid=None, limit=None):
+        return read_messages_from_file(input_filenames)[:limit]
 
       monkeypatch.setattr(IMAPReader, "login", mock_login)
       monkeypatch.setattr(IMAPReader, "close", mock_close)
@@ -223,6 +228,8 @@ class TestApp(object):
     [
         ("body=test&subject=test"),
         ("body=test&subject=test&datetime=123"),
+        ("datetime=2023-02-04T15:26:44Z&since=2023-02-04T15:26:44Z"),
+        ("subject=test&until=2023-02-04T15:26:44Z"),
     ]
   )
   def test_search_by_too_many_params(self, monkeypatch: MonkeyPatch, query_params):
@@ -238,4 +245,330 @@ class TestApp(object):
       response = self.client.get(f"/messages/search?{query_params}")
 
       assert response.status_code == HTTPStatus.BAD_REQUEST
-      assert self.bad_request_schema.is_valid(response.json()) == True
\ No newline at end of file
+      assert self.bad_request_schema.is_valid(response.json()) == True
+
+  @pytest.mark.parametrize(
+    "range_header, expected_status, expected_content",
+    [
+      (None, HTTPStatus.OK, b"0123456789"),
+      ("bytes=2-5", HTTPStatus.PARTIAL_CONTENT, b"2345"),
+      ("bytes=-3", HTTPStatus.PARTIAL_CONTENT, b"789"),
+      ("bytes=20-", HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, b""),
+    ]
+  )
+  def test_download_export(self, monkeypatch: MonkeyPatch, tmp_path, range_header, expected_status, expected_content):
+      exports = ExportManager(str(tmp_path), None)
+      monkeypatch.setattr(app_module, "exports", exports)
+      job = exports.create("jsonl")
+      with open(exports.export_path(job), "wb") as export_file:
+        export_file.write(b"0123456789")
+      job.status = "complete"
+
+      headers = {"Range": range_header} if range_header else {}
+      response = self.client.get(f"/export/{job.id}/download", headers=headers)
+
+      assert response.status_code == expected_status
+      assert response.content == expected_content
+
+  def test_download_export_not_complete(self, monkeypatch: MonkeyPatch, tmp_path):
+      exports = ExportManager(str(tmp_path), None)
+      monkeypatch.setattr(app_module, "exports", exports)
+      job = exports.create("mbox")
+
+      response = self.client.get(f"/export/{job.id}/download")
+
+      assert response.status_code == HTTPStatus.CONFLICT
+      assert self.client.get("/export/0123").status_code == HTTPStatus.NOT_FOUND
+
+  def test_delete_export(self, monkeypatch: MonkeyPatch, tmp_path):
+      exports = ExportManager(str(tmp_path), None)
+      monkeypatch.setattr(app_module, "exports", exports)
+      job = exports.create("jsonl")
+      job.status = "running"
+
+      assert self.client.delete(f"/export/{job.id}").status_code == HTTPStatus.CONFLICT
+      job.status = "complete"
+      assert self.client.delete(f"/export/{job.id}").status_code == HTTPStatus.NO_CONTENT
+      assert self.client.get(f"/export/{job.id}").status_code == HTTPStatus.NOT_FOUND
+      assert self.client.delete(f"/export/{job.id}").status_code == HTTPStatus.NOT_FOUND
+
+  @pytest.mark.parametrize(
+    "error, expected_status",
+    [
+      (QueueFull("Too many requests", 3), HTTPStatus.TOO_MANY_REQUESTS),
+      (QueueTimeout("Timed out waiting for an IMAP session", 3), HTTPStatus.SERVICE_UNAVAILABLE),
+    ]
+  )
+  def test_busy_scheduler_returns_retry_after(self, monkeypatch: MonkeyPatch, error, expected_status):
+      def mock_acquire(deadline=None, background=False):
+          raise error
+
+      monkeypatch.setattr(scheduler, "acquire", mock_acquire)
+      response = self.client.get("/messages/all")
+
+      assert response.status_code == expected_status
+      assert response.headers["Retry-After"] == "3"
+      assert self.bad_request_schema.is_valid(response.json()) == True
+
+  def test_partial_result_headers(self, monkeypatch: MonkeyPatch):
+      def mock_login(self):
+          return None
+
+      def mock_get_mail(self, before_uid=None):
+        self.partial = True
+        self.cursor = 42
+        return []
+
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(IMAPReader, "get_mail", mock_get_mail)
+      response = self.client.get("/messages/all?timeout_ms=100&cursor=50")
+
+      assert response.status_code == HTTPStatus.OK
+      assert response.json() == []
+      assert response.headers["X-Partial-Result"] == "true"
+      assert response.headers["X-Continuation-Cursor"] == "42"
+
+  @pytest.mark.parametrize("count, partial", [(2, False), (5, True)])
+  def test_last_n_partial_result_headers(self, monkeypatch: MonkeyPatch, count, partial):
+      def mock_login(self):
+          return None
+
+      def mock_get_mail(self, before_uid=None, limit=None):
+        # The deadline passed after three messages, UIDs 9, 8 and 7
+        uids = (9, 8, 7)[:limit]
+        self.partial = len(uids) < limit
+        self.cursor = uids[-1]
+        return [email.message_from_string(f"Subject: Test {uid}\n\nbody\n", policy=default_policy) for uid in uids]
+
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(IMAPReader, "get_mail", mock_get_mail)
+      response = self.client.get(f"/messages/last?count={count}&timeout_ms=100")
+
+      assert len(response.json()) == min(count, 3)
+      assert ("X-Partial-Result" in response.headers) == partial
+      assert response.headers.get("X-Continuation-Cursor") == ("7" if partial else None)
+
+  @pytest.mark.parametrize(
+    "mailbox_name, status, expected_status_code",
+    [
+      ("INBOX", {"messages": 5, "unseen": 1}, HTTPStatus.OK),
+      ("[Gmail]/Sent Mail", {"messages": 2, "unseen": 0}, HTTPStatus.OK),
+      ("Missing", None, HTTPStatus.NOT_FOUND),
+    ]
+  )
+  def test_get_mailbox_status(self, monkeypatch: MonkeyPatch, mailbox_name, status, expected_status_code):
+      calls = []
+
+      def mock_login(self):
+          return None
+
+      def mock_get_mailbox_status(self, name):
+        calls.append(name)
+        return status
+
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(IMAPReader, "get_mailbox_status", mock_get_mailbox_status)
+      mailbox_status_cache.clear()
+
+      for _ in range(2):
+        response = self.client.get(f"/mailboxes/{mailbox_name}/status")
+        assert response.status_code == expected_status_code
+      if status:
+        assert response.json() == {"name": mailbox_name, **status}
+        # Second request is served from the cache
+        assert calls == [mailbox_name]
+
+  @pytest.mark.parametrize(
+    "input_filename, expected_status_code",
+    [
+      ("email_with_html.txt", HTTPStatus.OK),
+      (None, HTTPStatus.NOT_FOUND),
+    ]
+  )
+  def test_get_message_by_uid(self, monkeypatch: MonkeyPatch, input_filename, expected_status_code):
+      def mock_login(self):
+          return None
+
+      def mock_get_email_by_uid(self, uid, mailbox='INBOX'):
+        if input_filename is None:
+          return None
+        with open(os.path.join(os.getcwd(), "..", "email_examples", input_filename), "r") as email_file:
+          return email.message_from_string(email_file.read(), policy=default_policy)
+
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(IMAPReader, "get_email_by_uid", mock_get_email_by_uid)
+      response = self.client.get("/messages/42")
+
+      assert response.status_code == expected_status_code
+      if expected_status_code == HTTPStatus.OK:
+        assert response.json()["uid"] == 42
+        assert self.json_response_schema.is_valid({key: value for key, value in response.json().items() if key != "uid"}) == True
+
+  @pytest.mark.parametrize("path", ["/messages/42", "/messages/42/raw", "/messages/by-message-id/1@test.local", "/threads"])
+  @pytest.mark.parametrize("mailbox_name", ["Missing Folder", "INBOX\r\nA1 DELETE INBOX"])
+  def test_missing_mailbox_returns_not_found(self, monkeypatch: MonkeyPatch, path, mailbox_name):
+      selected = []
+
+      class imap4_ssl_mock:
+        state = 'AUTH'
+
+        def select(mailbox, readonly):
+          selected.append(mailbox)
+          return ('NO', [b'Mailbox does not exist'])
+
+      def mock_login(self):
+          self.imap4_ssl = imap4_ssl_mock
+
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      # New sessions so every reader uses the mock connection
+      monkeypatch.setattr(scheduler, "idle", [])
+      response = self.client.get(path, params={"mailbox": mailbox_name})
+
+      assert response.status_code == HTTPStatus.NOT_FOUND
+      assert selected == (['"Missing Folder"'] if mailbox_name == "Missing Folder" else [])
+      assert scheduler.active == 0
+
+  def test_get_raw_message_is_streamed(self, monkeypatch: MonkeyPatch):
+      def mock_login(self):
+          return None
+
+      def mock_open_raw_message(self, uid, mailbox='INBOX'):
+        if uid != 42:
+          return None
+        return (10, iter([b"01234", b"56789"]))
+
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(IMAPReader, "open_raw_message", mock_open_raw_message)
+      response = self.client.get("/messages/42/raw")
+
+      assert response.status_code == HTTPStatus.OK
+      assert response.headers["Content-Type"] == "message/rfc822"
+      assert response.content == b"0123456789"
+      assert self.client.get("/messages/7/raw").status_code == HTTPStatus.NOT_FOUND
+      # The session is released once the body has been sent
+      assert scheduler.active == 0
+
+  @pytest.mark.parametrize(
+    "query_params",
+    [
+        ("since=2023/02/04"),
+        ("until=yesterday"),
+        ("datetime=2023-02-04T15:26:44Z&until=not-a-date"),
+    ]
+  )
+  def test_search_by_invalid_date(self, query_params):
+      response = self.client.get(f"/messages/search?{query_params}")
+
+      assert response.status_code == HTTPStatus.BAD_REQUEST
+      assert response.json() == {"detail": "Invalid ISO 8601 string"}
+
+  def test_messages_are_served_from_the_shared_store(self, monkeypatch: MonkeyPatch, tmp_path):
+      def mock_login(self):
+          raise AssertionError("IMAP login while the shared store is synced")
+
+      store = SharedStore(str(tmp_path / "store.db"))
+      store.apply('INBOX', 1, [(uid, {"to": "to", "from": "from", "subject": f"Test {uid}", "date": "date", "body": "body", "uid": uid}) for uid in (1, 2, 3)])
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(app_module, "shared_store", store)
+
+      response = self.client.get("/messages/all?cursor=3")
+      assert [message["subject"] for message in response.json()] == ["Test 2", "Test 1"]
+      assert self.json_response_schema.is_valid(response.json()[0]) == True
+      assert self.client.get("/messages/last?count=1").json()[0]["subject"] == "Test 3"
+      assert self.client.get("/messages/latest").json()["subject"] == "Test 3"
+      assert self.client.get("/messages/2").json()["uid"] == 2
+
+  def test_stale_shared_store_falls_back_to_imap(self, monkeypatch: MonkeyPatch, tmp_path):
+      def mock_login(self):
+          return None
+
+      def mock_get_mail(self, before_uid=None):
+        return [email.message_from_string("Subject: From IMAP\n\nbody\n", policy=default_policy)]
+
+      store = SharedStore(str(tmp_path / "store.db"))
+      store.apply('INBOX', 1, [(1, {"to": "to", "from": "from", "subject": "Stored", "date": "date", "body": "body", "uid": 1})])
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(IMAPReader, "get_mail", mock_get_mail)
+      monkeypatch.setattr(app_module, "shared_store", store)
+      monkeypatch.setattr(app_module, "shared_store_max_age", -1)
+
+      assert self.client.get("/messages/all").json()[0]["subject"] == "From IMAP"
+
+  @pytest.mark.parametrize(
+    "admin_token, headers, expected_status_code",
+    [
+      (None, {"X-Admin-Token": "secret"}, HTTPStatus.NOT_FOUND),
+      ("secret", {"X-Admin-Token": "wrong"}, HTTPStatus.FORBIDDEN),
+      ("secret", {"X-Admin-Token": "secret"}, HTTPStatus.NOT_FOUND),
+    ]
+  )
+  def test_get_profile_requires_admin_token(self, monkeypatch: MonkeyPatch, admin_token, headers, expected_status_code):
+      monkeypatch.setattr(app_module, "admin_token", admin_token)
+      response = self.client.get("/admin/profiles/0123456789abcdef0123456789abcdef", headers=headers)
+
+      assert response.status_code == expected_status_code
+
+  def test_get_threads(self, monkeypatch: MonkeyPatch):
+      def mock_login(self):
+          return None
+
+      def mock_get_threads(self, mailbox='INBOX'):
+        return [[5], [1, 3], [2]]
+
+      def mock_get_thread_records(self, uids):
+        return {uid: {'message_id': f"<{uid}@test.local>", 'from': "a@test.local", 'to': "b@test.local", 'cc': None, 'subject': f"Test {uid}", 'date': "Sun, 5 Feb 2023 05:10:47 -0500"} for uid in uids}
+
+      monkeypatch.setattr(IMAPReader, "login", mock_login)
+      monkeypatch.setattr(IMAPReader, "get_threads", mock_get_threads)
+      monkeypatch.setattr(IMAPReader, "get_thread_records", mock_get_thread_records)
+
+      response = self.client.get("/threads?page=2&page_size=2")
+      assert response.status_code == HTTPStatus.OK
+      assert response.json()["total"] == 3
+      assert [thread["id"] for thread in response.json()["threads"]] == [2]
+      assert "body" not in response.json()["threads"][0]
+
+      response = self.client.get("/threads/1")
+      assert response.status_code == HTTPStatus.OK
+      assert response.json()["id"] == 1
+      assert [message["uid"] for message in response.json()["messages"]] == [1, 3]
+      # Only the thread id, not the UID of another message in the thread
+      assert self.client.get("/threads/3").status_code == HTTPStatus.NOT_FOUND
+      assert self.client.get("/threads/4").status_code == HTTPStatus.NOT_FOUND
+      assert self.client.get("/threads?page_size=101").status_code == HTTPStatus.BAD_REQUEST
+
+  def test_webhook_subscriptions(self, monkeypatch: MonkeyPatch, tmp_path):
+      manager = WebhookManager(WebhookStore(str(tmp_path / "webhooks.db")), None)
+      started = []
+      monkeypatch.setattr(manager, "start", lambda: started.append(True))
+      monkeypatch.setattr(app_module, "webhooks", manager)
+
+      response = self.client.post("/webhooks?url=http://receiver.test/hook&from=shop.test")
+      assert response.status_code == HTTPStatus.CREATED
+      subscription = response.json()
+      assert subscription["sender"] == "shop.test"
+      # The poller only runs once there is a subscription
+      assert started == [True]
+
+      assert [item["id"] for item in self.client.get("/webhooks").json()] == [subscription["id"]]
+      assert self.client.get(f"/webhooks/{subscription['id']}").json()["pending"] == 0
+      assert self.client.post("/webhooks?url=not-a-url").status_code == HTTPStatus.BAD_REQUEST
+      assert self.client.delete(f"/webhooks/{subscription['id']}").status_code == HTTPStatus.NO_CONTENT
+      assert self.client.get(f"/webhooks/{subscription['id']}").status_code == HTTPStatus.NOT_FOUND
+
+  def test_openapi_schema_is_built_once(self, monkeypatch: MonkeyPatch):
+      calls = []
+      get_openapi = app_module.get_openapi
+
+      def mock_get_openapi(**kwargs):
+        calls.append(1)
+        return get_openapi(**kwargs)
+
+      monkeypatch.setattr(app_module, "get_openapi", mock_get_openapi)
+      monkeypatch.setattr(app, "openapi_schema", None)
+      first = self.client.get("/openapi.json")
+      second = self.client.get("/openapi.json")
+
+      assert first.status_code == HTTPStatus.OK
+      assert first.json() == second.json()
+      assert len(calls) == 1
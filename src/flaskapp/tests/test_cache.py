@@ -0,0 +1,113 @@
+import sys
+import time
+import email
+import pytest
+from email.policy import default as default_policy
+
+# App imports
+import metrics
+from cache import TTLCache, MessageIdIndex, MessageCache
+
+
+class TestTTLCache(object):
+
+  def test_entries_expire(self) -> None:
+    cache = TTLCache(0.05)
+    cache.set('INBOX', {'messages': 1})
+    assert cache.get('INBOX') == {'messages': 1}
+    time.sleep(0.06)
+    assert cache.get('INBOX') is None
+
+  def test_zero_ttl_disables_cache(self) -> None:
+    cache = TTLCache(0)
+    cache.set('INBOX', {'messages': 1})
+    assert cache.get('INBOX') is None
+
+
+class TestMessageIdIndex(object):
+
+  @pytest.mark.parametrize("stored_id, lookup_id",
+  [
+    ("<abc@test.local>", "<abc@test.local>"),
+    ("<abc@test.local>", "abc@test.local"),
+    ("abc@test.local", " <abc@test.local> "),
+  ])
+  def test_lookup_normalizes_angle_brackets(self, stored_id, lookup_id) -> None:
+    index = MessageIdIndex()
+    index.add(stored_id, 'INBOX', 1, 42)
+    assert index.get(lookup_id, 'INBOX', 1) == 42
+    assert index.get(lookup_id, 'Sent', 1) is None
+
+  def test_uidvalidity_change_invalidates_entry(self) -> None:
+    index = MessageIdIndex()
+    index.add('<abc@test.local>', 'INBOX', 1, 42)
+    assert index.get('<abc@test.local>', 'INBOX', 2) is None
+    assert len(index) == 0
+
+  def test_least_recently_used_entries_are_dropped(self) -> None:
+    index = MessageIdIndex(max_entries=2)
+    index.add('<1@test.local>', 'INBOX', 1, 1)
+    index.add('<2@test.local>', 'INBOX', 1, 2)
+    index.get('<1@test.local>', 'INBOX', 1)
+    index.add('<3@test.local>', 'INBOX', 1, 3)
+
+    assert len(index) == 2
+    assert index.get('<2@test.local>', 'INBOX', 1) is None
+    assert index.get('<1@test.local>', 'INBOX', 1) == 1
+
+
+def parse(raw_message: bytes):
+  return email.message_from_bytes(raw_message, policy=default_policy)
+
+
+class TestMessageCache(object):
+
+  def test_hits_and_misses_are_counted(self) -> None:
+    metrics.reset()
+    cache = MessageCache(10000)
+    message = parse(b'Subject: Test\r\n\r\nBody\r\n')
+    cache.set('INBOX', 1, 42, message, 100)
+
+    assert cache.get('INBOX', 1, 42) is message
+    assert cache.get('INBOX', 2, 42) is None
+    assert cache.get('Archive', 1, 42) is None
+    counters = metrics.snapshot()
+    assert counters['message_cache_hits'] == 1
+    assert counters['message_cache_misses'] == 2
+
+  def test_least_recently_used_is_evicted_over_budget(self) -> None:
+    metrics.reset()
+    cache = MessageCache(3 * (int(100 * MessageCache.PARSED_SIZE_FACTOR) + MessageCache.ENTRY_OVERHEAD_BYTES))
+    for uid in (1, 2, 3):
+      cache.set('INBOX', 1, uid, parse(b'Subject: Test\r\n\r\nBody\r\n'), 100)
+    cache.get('INBOX', 1, 1)
+    cache.set('INBOX', 1, 4, parse(b'Subject: Test\r\n\r\nBody\r\n'), 100)
+
+    assert cache.get('INBOX', 1, 2) is None
+    assert cache.get('INBOX', 1, 1) is not None
+    assert len(cache) == 3
+    assert cache.size <= cache.max_bytes
+    assert metrics.snapshot()['message_cache_evictions'] == 1
+
+  def test_message_larger_than_budget_is_not_cached(self) -> None:
+    cache = MessageCache(100)
+    cache.set('INBOX', 1, 1, parse(b'Subject: Test\r\n\r\nBody\r\n'), 1000)
+    assert len(cache) == 0
+
+  def test_small_messages_count_their_parsed_size(self) -> None:
+    # A 240 byte message parses to well over 1 KB, the budget must not fit hundreds of them
+    cache = MessageCache(64 * 1024)
+    for uid in range(1, 101):
+      cache.set('INBOX', 1, uid, parse(b'Subject: Test\r\n\r\nBody\r\n'), 240)
+    assert len(cache) <= 64 * 1024 // 1700
+
+  def test_fields_count_against_budget(self) -> None:
+    cache = MessageCache(10000)
+    message = parse(b'Subject: Test\r\n\r\nBody\r\n')
+    cache.set('INBOX', 1, 1, message, 100)
+    cache.set_field(message, 'plain', 'Body\n')
+
+    assert cache.get_field(message, 'plain') == 'Body\n'
+    assert cache.get_field(message, 'html') is None
+    assert cache.get_field(parse(b'Subject: Other\r\n\r\n'), 'plain') is None
+    assert cache.size == int(100 * MessageCache.PARSED_SIZE_FACTOR) + MessageCache.ENTRY_OVERHEAD_BYTES + sys.getsizeof('Body\n')
@@ -0,0 +1,148 @@
+import os
+import json
+import pytest
+from contextlib import nullcontext
+
+# App imports
+from imapreader import IMAPReader
+from exporter import ExportManager
+from helpers import parse_range_header
+
+SAMPLE_MESSAGE = b'Date: Sun, 5 Feb 2023 05:10:47 -0500\r\nFrom: user <user@test.local>\r\nTo: user@test.local\r\nSubject: Test %d\r\nMessage-ID: <%d@test.local>\r\nMIME-Version: 1.0\r\nContent-Type: text/plain; charset=us-ascii\r\n\r\nTest email body\r\nFrom the body\r\n'
+
+
+class FakeReader(IMAPReader):
+  """IMAPReader with an in-memory mailbox, optionally failing on the nth UID FETCH"""
+  def __init__(self, uids, fail_on_batch=None):
+    super().__init__()
+    self.uids = uids
+    self.fail_on_batch = fail_on_batch
+    self.batches = 0
+
+  def select_mailbox_and_get_email_count_in_mailbox(self, mailbox_name='INBOX'):
+    self.uidvalidity = 1
+    return ('OK', [str(len(self.uids)).encode()])
+
+  def search_uids(self, *criteria):
+    return list(self.uids)
+
+  def fetch_raw_messages(self, uids):
+    self.batches += 1
+    if self.fail_on_batch == self.batches:
+      raise OSError('Connection reset')
+    return [(uid, SAMPLE_MESSAGE % (uid, uid)) for uid in uids]
+
+
+class TestExportManager(object):
+
+  @pytest.mark.parametrize("format, batch_size", [("jsonl", 2), ("mbox", 2), ("jsonl", 50)])
+  def test_run_writes_every_message(self, tmp_path, format, batch_size) -> None:
+    manager = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([1, 2, 3, 4, 5])), batch_size=batch_size)
+    job = manager.create(format)
+    manager.run(job)
+
+    assert job.status == 'complete'
+    assert job.exported == 5
+    with open(manager.export_path(job), 'rb') as export_file:
+      content = export_file.read()
+    if format == 'jsonl':
+      lines = [json.loads(line) for line in content.splitlines()]
+      assert [line['uid'] for line in lines] == [1, 2, 3, 4, 5]
+      assert lines[0]['subject'] == 'Test 1'
+    else:
+      assert content.count(b'\nFrom MAILER-DAEMON ') + content.startswith(b'From MAILER-DAEMON ') == 5
+      assert b'\n>From the body\n' in content
+
+  def test_run_resumes_after_failure(self, tmp_path) -> None:
+    readers = [FakeReader([1, 2, 3, 4, 5], fail_on_batch=2), FakeReader([1, 2, 3, 4, 5])]
+    manager = ExportManager(str(tmp_path), lambda: nullcontext(readers.pop(0)), batch_size=2)
+    job = manager.create('jsonl')
+    manager.run(job)
+
+    assert job.status == 'failed'
+    assert job.last_uid == 2
+
+    manager.run(job)
+    assert job.status == 'complete'
+    with open(manager.export_path(job), 'rb') as export_file:
+      lines = [json.loads(line) for line in export_file.read().splitlines()]
+    assert [line['uid'] for line in lines] == [1, 2, 3, 4, 5]
+
+  def test_get_loads_interrupted_job_from_disk(self, tmp_path) -> None:
+    manager = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([])))
+    job = manager.create('mbox')
+    job.status = 'running'
+    manager.save(job)
+
+    manager.release(job.id)
+
+    job = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([]))).get(job.id)
+    assert job.status == 'failed'
+    assert ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([]))).get('../etc/passwd') is None
+
+  def test_job_running_in_another_worker_is_not_interrupted(self, tmp_path) -> None:
+    owner = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([])))
+    job = owner.create('jsonl')
+    job.status = 'running'
+    owner.save(job)
+
+    other = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([1])))
+    other_job = other.get(job.id)
+    assert other_job.status == 'running'
+    other_job.status = 'failed'
+    with pytest.raises(RuntimeError):
+      other.start(other_job)
+    with pytest.raises(RuntimeError):
+      other.delete(job.id)
+
+  @pytest.mark.parametrize("format, since", [("csv", None), ("jsonl", "2023/02/04"), ("jsonl", "2023-02-04T10:00:00")])
+  def test_create_with_invalid_parameters(self, tmp_path, format, since) -> None:
+    manager = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([])))
+    with pytest.raises(ValueError):
+      manager.create(format, since)
+    assert os.listdir(str(tmp_path)) == []
+
+  def test_delete_removes_export_and_state(self, tmp_path) -> None:
+    manager = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([1, 2])))
+    job = manager.create('jsonl')
+    manager.run(job)
+
+    assert manager.delete(job.id) == True
+    assert os.listdir(str(tmp_path)) == []
+    assert manager.get(job.id) is None
+    assert manager.delete(job.id) == False
+
+  def test_create_prunes_oldest_exports(self, tmp_path) -> None:
+    manager = ExportManager(str(tmp_path), lambda: nullcontext(FakeReader([1])), max_exports=2)
+    jobs = []
+    for mtime in range(3):
+      job = manager.create('jsonl')
+      manager.run(job)
+      os.utime(manager.state_path(job.id), (mtime, mtime))
+      jobs.append(job)
+
+    manager.create('jsonl')
+    assert manager.get(jobs[0].id) is None
+    assert manager.get(jobs[1].id) is None
+    assert manager.get(jobs[2].id) is not None
+    assert not os.path.exists(manager.export_path(jobs[0]))
+
+
+class TestParseRangeHeader(object):
+
+  @pytest.mark.parametrize("range_header, expected",
+  [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-1", None),
+  ])
+  def test_parse_range_header(self, range_header, expected) -> None:
+    assert parse_range_header(range_header, 1000) == expected
+
+  @pytest.mark.parametrize("range_header", ["bytes=1000-", "bytes=5-1", "bytes=a-b", "bytes=-0"])
+  def test_parse_range_header_not_satisfiable(self, range_header) -> None:
+    with pytest.raises(ValueError):
+      parse_range_header(range_header, 1000)
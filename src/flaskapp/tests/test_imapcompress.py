@@ -0,0 +1,117 @@
+import io
+import time
+import zlib
+import socket
+import imaplib
+import pytest
+import threading
+from pytest import MonkeyPatch
+
+# App imports
+import metrics
+from imapcompress import DeflateIMAP4_SSL
+
+
+class FakeSocket(object):
+  def __init__(self):
+    self.sent = b''
+
+  def sendall(self, data):
+    self.sent += data
+
+
+def create_connection(server_bytes: bytes = b'', capabilities: tuple = ('IMAP4REV1', 'COMPRESS=DEFLATE')) -> DeflateIMAP4_SSL:
+  # Skip IMAP4_SSL.__init__ so no network connection is opened
+  connection = DeflateIMAP4_SSL.__new__(DeflateIMAP4_SSL)
+  connection.deadline = None
+  connection.state = 'AUTH'
+  connection._capabilities_refreshed = True
+  connection._deadline_applied = False
+  connection._compressor = None
+  connection._decompressor = None
+  connection._inbuf = bytearray()
+  connection.capabilities = capabilities
+  connection.sock = FakeSocket()
+  connection.file = io.BufferedReader(io.BytesIO(server_bytes), buffer_size=8)
+  return connection
+
+
+def deflate(data: bytes) -> bytes:
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class TestDeflateIMAP4_SSL(object):
+
+  def test_compress_not_advertised(self) -> None:
+    connection = create_connection(capabilities=('IMAP4REV1',))
+    assert connection.compress() == False
+    assert connection.compressed == False
+
+  def test_compress_enabled(self, monkeypatch: MonkeyPatch) -> None:
+    connection = create_connection()
+    monkeypatch.setattr(DeflateIMAP4_SSL, "_simple_command", lambda self, name, *args: ('OK', [b'DEFLATE active']))
+    assert connection.compress() == True
+    assert connection.compressed == True
+
+  def test_compress_rejected(self, monkeypatch: MonkeyPatch) -> None:
+    connection = create_connection()
+    monkeypatch.setattr(DeflateIMAP4_SSL, "_simple_command", lambda self, name, *args: ('NO', [b'Not now']))
+    assert connection.compress() == False
+
+  @pytest.mark.parametrize("commands",
+  [
+    ([b'a001 NOOP\r\n']),
+    ([b'a001 NOOP\r\n', b'a002 SELECT INBOX\r\n', b'a003 FETCH 1 (RFC822)\r\n']),
+  ])
+  def test_send_is_deflated(self, commands, monkeypatch: MonkeyPatch) -> None:
+    connection = create_connection()
+    monkeypatch.setattr(DeflateIMAP4_SSL, "_simple_command", lambda self, name, *args: ('OK', [b'']))
+    connection.compress()
+    for command in commands:
+      connection.send(command)
+
+    assert zlib.decompressobj(-zlib.MAX_WBITS).decompress(connection.sock.sent) == b''.join(commands)
+
+  def test_read_and_readline_are_inflated(self, monkeypatch: MonkeyPatch) -> None:
+    literal = b'Subject: Test 1\r\n\r\n' + b'Test 1 email body\r\n' * 200
+    server_response = b'* 1 FETCH (RFC822 {%d}\r\n' % len(literal) + literal + b')\r\na001 OK FETCH completed\r\n'
+    connection = create_connection(deflate(server_response))
+    monkeypatch.setattr(DeflateIMAP4_SSL, "_simple_command", lambda self, name, *args: ('OK', [b'']))
+    connection.compress()
+    metrics.reset()
+
+    assert connection.readline() == b'* 1 FETCH (RFC822 {%d}\r\n' % len(literal)
+    assert connection.read(len(literal)) == literal
+    assert connection.readline() == b')\r\n'
+    assert connection.readline() == b'a001 OK FETCH completed\r\n'
+    counters = metrics.snapshot()
+    assert counters['imap_bytes_received'] == len(server_response)
+    assert counters['imap_bytes_received_wire'] < counters['imap_bytes_received']
+
+  def test_read_without_compression(self) -> None:
+    connection = create_connection(b'* OK ready\r\n')
+    assert connection.readline() == b'* OK ready\r\n'
+
+  def test_deadline_covers_capability_while_connecting(self, monkeypatch: MonkeyPatch) -> None:
+    # Greeting without capabilities, so imaplib sends CAPABILITY, then the server stalls
+    server = socket.create_server(('127.0.0.1', 0))
+    closed = threading.Event()
+
+    def serve():
+      connection, _ = server.accept()
+      connection.sendall(b'* OK ready\r\n')
+      closed.wait(10)
+      connection.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    # Plain TCP instead of TLS
+    monkeypatch.setattr(DeflateIMAP4_SSL, "_create_socket", imaplib.IMAP4._create_socket)
+    started = time.monotonic()
+    try:
+      with pytest.raises((TimeoutError, imaplib.IMAP4.abort)):
+        DeflateIMAP4_SSL('127.0.0.1', server.getsockname()[1], timeout=0.5, deadline=time.monotonic() + 0.5)
+      assert time.monotonic() - started < 3
+    finally:
+      closed.set()
+      server.close()
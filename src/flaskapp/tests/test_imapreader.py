@@ -1,13 +1,19 @@
 import unittest
+import io
 import os
+import time
 import email
 import pytest
+import imaplib
 from email.policy import default as default_policy
 from imaplib import IMAP4_SSL
 from pytest import MonkeyPatch
 
 # App imports
-from imapreader import IMAPReader
+from datetime import datetime, timedelta, timezone
+from threads import ThreadIndex
+from imapreader import IMAPReader, parse_list_response, parse_status_response, parse_internaldate_response, to_sequence_set, quote_mailbox, MailboxNotFound
+from cache import MessageIdIndex, MessageCache
 
 class TestImapReader(object):
   reader = IMAPReader()
@@ -126,41 +132,41 @@ class TestImapReader(object):
     reader.imap4_ssl = imap4_ssl_mock
     assert reader.select_mailbox_and_get_email_count_in_mailbox() == (response_code, count)
 
-  @pytest.mark.parametrize("mail_ids, expected_count", 
-  [
-    ([b'1'], 1),
-    ([b'1 2 3 4 5'], 5)
-  ])
-  def test_fetch_emails(self, mail_ids, expected_count, monkeypatch: MonkeyPatch) -> None:
+  def test_select_missing_mailbox_raises_mailbox_not_found(self) -> None:
     class imap4_ssl_mock:
-      
-      def fetch(mail_id, format='(RFC822)'):
-        sample_fetch_response = ('OK', [(b'1 (FLAGS (\\Seen \\Recent) RFC822 {460}', b'Return-Path: <user@test.local>\r\nX-Original-To: user@test.local\r\nDelivered-To: user@test.local\r\nReceived: by user (Postfix, from userid 1000)\r\n\tid 82C7A280DB0; Sun,  5 Feb 2023 05:10:47 -0500 (EST)\r\nDate: Sun, 5 Feb 2023 05:10:47 -0500\r\nFrom: user <user@test.local>\r\nTo: user@test.local\r\nSubject: Test 1\r\nMessage-ID: <Y9+Apzn2XyMvNzpd@test.local>\r\nMIME-Version: 1.0\r\nContent-Type: text/plain; charset=us-ascii\r\nContent-Disposition: inline\r\n\r\nTest 1 email body\r\n'), b')'])
-        return sample_fetch_response
-    
-    monkeypatch.setattr("imaplib.IMAP4_SSL", imap4_ssl_mock)
+      state = 'AUTH'
+
+      def select(mailbox, readonly):
+        return ('NO', [b'Mailbox does not exist'])
 
     reader = IMAPReader(email_id="", email_password="", email_host="")
     reader.imap4_ssl = imap4_ssl_mock
-    messages = reader.fetch_emails(mail_ids)
+    reader.mailbox = "Missing"
+    with pytest.raises(MailboxNotFound):
+      reader.ensure_selected("Missing")
+    assert reader.mailbox is None
 
-    print(messages[0].get_body().as_string())
-    assert len(messages) == expected_count
-    assert isinstance(messages[0], email.message.Message)
+  @pytest.mark.parametrize("mailbox_name, expected", [
+    ("INBOX", '"INBOX"'),
+    ("Sent Mail", '"Sent Mail"'),
+    ('Say "hi" \\o/', '"Say \\"hi\\" \\\\o/"'),
+  ])
+  def test_quote_mailbox(self, mailbox_name, expected) -> None:
+    assert quote_mailbox(mailbox_name) == expected
 
-  @pytest.mark.parametrize("start_date, expected_count", 
+  @pytest.mark.parametrize("mailbox_name", ["INBOX\r\nA1 LOGOUT", "INBOX\n", "IN\0BOX"])
+  def test_quote_mailbox_rejects_line_breaks(self, mailbox_name) -> None:
+    with pytest.raises(MailboxNotFound):
+      quote_mailbox(mailbox_name)
+
+  @pytest.mark.parametrize("mail_ids, expected_count", 
   [
-    ("2023-02-04T15:26:44.920Z", 5),
+    ([b'1'], 1),
+    ([b'1 2 3 4 5'], 5)
   ])
-  def test_get_emails_since_emails(self, start_date, expected_count, monkeypatch: MonkeyPatch) -> None:
+  def test_fetch_emails(self, mail_ids, expected_count, monkeypatch: MonkeyPatch) -> None:
     class imap4_ssl_mock:
-      def select(mailbox, readonly):
-        return ("OK", expected_count)
       
-      def search(charset, command, parameters):
-        search_response = ('OK', [b'1 2 3 4 5'])
-        return search_response
-
       def fetch(mail_id, format='(RFC822)'):
         sample_fetch_response = ('OK', [(b'1 (FLAGS (\\Seen \\Recent) RFC822 {460}', b'Return-Path: <user@test.local>\r\nX-Original-To: user@test.local\r\nDelivered-To: user@test.local\r\nReceived: by user (Postfix, from userid 1000)\r\n\tid 82C7A280DB0; Sun,  5 Feb 2023 05:10:47 -0500 (EST)\r\nDate: Sun, 5 Feb 2023 05:10:47 -0500\r\nFrom: user <user@test.local>\r\nTo: user@test.local\r\nSubject: Test 1\r\nMessage-ID: <Y9+Apzn2XyMvNzpd@test.local>\r\nMIME-Version: 1.0\r\nContent-Type: text/plain; charset=us-ascii\r\nContent-Disposition: inline\r\n\r\nTest 1 email body\r\n'), b')'])
         return sample_fetch_response
@@ -169,13 +175,12 @@ class TestImapReader(object):
 
     reader = IMAPReader(email_id="", email_password="", email_host="")
     reader.imap4_ssl = imap4_ssl_mock
-    messages = reader.get_emails_since_date(start_date)
+    messages = reader.fetch_emails(mail_ids)
 
-    assert isinstance(messages, list)
+    print(messages[0].get_body().as_string())
     assert len(messages) == expected_count
     assert isinstance(messages[0], email.message.Message)
 
-
   @pytest.mark.parametrize("expected_count", 
   [
     (5),
@@ -261,4 +266,487 @@ class TestImapReader(object):
     assert isinstance(messages, list)
     assert len(messages) == expected_count
     if expected_count > 0:
-      assert isinstance(messages[0], email.message.Message)
\ No newline at end of file
+      assert isinstance(messages[0], email.message.Message)
+
+  @pytest.mark.parametrize("expire_after, expected_count, expected_partial, expected_cursor",
+  [
+    (None, 5, False, 1),
+    (2, 2, True, 4),
+    (0, 0, True, None),
+  ])
+  def test_fetch_emails_stops_at_deadline(self, expire_after, expected_count, expected_partial, expected_cursor) -> None:
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+
+    class imap4_ssl_mock:
+      fetched = []
+
+      def fetch(mail_id, format='(UID RFC822)'):
+        imap4_ssl_mock.fetched.append(mail_id)
+        if expire_after is not None and len(imap4_ssl_mock.fetched) >= expire_after:
+          reader.deadline = time.monotonic() - 1
+        return ('OK', [(b'%s (UID %s RFC822 {68}' % (mail_id.encode(), mail_id.encode()), b'From: user@test.local\r\nSubject: Test ' + mail_id.encode() + b'\r\n\r\nTest email body\r\n'), b')'])
+
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.deadline = time.monotonic() - 1 if expire_after == 0 else time.monotonic() + 60
+    messages = reader.fetch_emails([b'1 2 3 4 5'])
+
+    assert len(messages) == expected_count
+    assert reader.partial == expected_partial
+    assert reader.cursor == expected_cursor
+    if expected_count > 0:
+      # Newest first
+      assert messages[0].get('Subject') == 'Test 5'
+
+  def test_fetch_emails_timeout_marks_connection_broken(self) -> None:
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+
+    class imap4_ssl_mock:
+      def fetch(mail_id, format='(UID RFC822)'):
+        reader.deadline = time.monotonic() - 1
+        raise TimeoutError('The read operation timed out')
+
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.deadline = time.monotonic() + 60
+    messages = reader.fetch_emails([b'1 2'])
+
+    assert messages == []
+    assert reader.partial == True
+    assert reader.broken == True
+
+  @pytest.mark.parametrize("before_uid, expected_criteria",
+  [
+    (None, ('ALL',)),
+    (10, ('UID', '1:9', 'ALL')),
+    (1, None),
+  ])
+  def test_search_before_uid(self, before_uid, expected_criteria) -> None:
+    class imap4_ssl_mock:
+      criteria = None
+
+      def search(charset, *criteria):
+        imap4_ssl_mock.criteria = criteria
+        return ('OK', [b'1'])
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.search(before_uid, 'ALL')
+
+    assert imap4_ssl_mock.criteria == expected_criteria
+
+  @pytest.mark.parametrize("item, expected",
+  [
+    (b'(\\HasNoChildren) "/" "INBOX"', {'name': 'INBOX', 'delimiter': '/', 'flags': ['\\HasNoChildren']}),
+    (b'(\\Noselect \\HasChildren) "." "[Gmail]"', {'name': '[Gmail]', 'delimiter': '.', 'flags': ['\\Noselect', '\\HasChildren']}),
+    (b'() NIL Drafts', {'name': 'Drafts', 'delimiter': None, 'flags': []}),
+    ((b'(\\HasNoChildren) "/" {8}', b'My "Box"'), {'name': 'My "Box"', 'delimiter': '/', 'flags': ['\\HasNoChildren']}),
+    (b'garbage', None),
+  ])
+  def test_parse_list_response(self, item, expected) -> None:
+    assert parse_list_response(item) == expected
+
+  @pytest.mark.parametrize("item, expected",
+  [
+    (b'"INBOX" (MESSAGES 5 UNSEEN 1 UIDVALIDITY 3)', ('INBOX', {'messages': 5, 'unseen': 1, 'uidvalidity': 3})),
+    (b'Sent (MESSAGES 0 HIGHESTMODSEQ 1234)', ('Sent', {'messages': 0, 'highestmodseq': 1234})),
+    (b'"Sent \\"Old\\"" (MESSAGES 2)', ('Sent "Old"', {'messages': 2})),
+    (b'garbage', None),
+  ])
+  def test_parse_status_response(self, item, expected) -> None:
+    assert parse_status_response(item) == expected
+
+  @pytest.mark.parametrize("capabilities, expected_items",
+  [
+    (('IMAP4REV1',), '(MESSAGES UNSEEN RECENT UIDNEXT UIDVALIDITY)'),
+    (('IMAP4REV1', 'CONDSTORE'), '(MESSAGES UNSEEN RECENT UIDNEXT UIDVALIDITY HIGHESTMODSEQ)'),
+  ])
+  def test_get_mailbox_status(self, capabilities, expected_items) -> None:
+    class imap4_ssl_mock:
+      def has_capability(name):
+        return name in capabilities
+
+      def _quote(name):
+        return '"' + name + '"'
+
+      def status(mailbox, names):
+        assert mailbox == '"INBOX"'
+        assert names == expected_items
+        return ('OK', [b'"INBOX" (MESSAGES 5 UNSEEN 1 RECENT 0 UIDNEXT 6 UIDVALIDITY 3)'])
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    assert reader.get_mailbox_status('INBOX') == {'messages': 5, 'unseen': 1, 'recent': 0, 'uidnext': 6, 'uidvalidity': 3}
+
+  @pytest.mark.parametrize("list_status", [True, False])
+  def test_list_mailboxes(self, list_status) -> None:
+    list_data = [b'(\\HasNoChildren) "/" "INBOX"', b'(\\Noselect \\HasChildren) "/" "[Gmail]"', b'(\\HasNoChildren) "/" "[Gmail]/Sent Mail"']
+    status_data = [b'"INBOX" (MESSAGES 5 UNSEEN 1)', b'"[Gmail]/Sent Mail" (MESSAGES 2 UNSEEN 0)']
+
+    class imap4_ssl_mock:
+      commands = []
+      untagged_responses = {}
+
+      def has_capability(name):
+        return list_status and name == 'LIST-STATUS'
+
+      def _quote(name):
+        return '"' + name + '"'
+
+      def list():
+        return ('OK', list_data)
+
+      def _simple_command(name, *args):
+        imap4_ssl_mock.untagged_responses = {'LIST': list_data, 'STATUS': status_data}
+        return ('OK', [b'LIST completed'])
+
+      def _command(name, *args):
+        imap4_ssl_mock.commands.append(args[0])
+        return len(imap4_ssl_mock.commands)
+
+      def _command_complete(name, tag):
+        imap4_ssl_mock.untagged_responses.setdefault('STATUS', []).append(status_data[tag - 1])
+        return ('OK', [b'STATUS completed'])
+
+      def _untagged_response(typ, dat, name):
+        return (typ, imap4_ssl_mock.untagged_responses.pop(name, [None]))
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    mailboxes = reader.list_mailboxes()
+
+    assert [mailbox['name'] for mailbox in mailboxes] == ['INBOX', '[Gmail]', '[Gmail]/Sent Mail']
+    assert [mailbox['status'] for mailbox in mailboxes] == [{'messages': 5, 'unseen': 1}, None, {'messages': 2, 'unseen': 0}]
+    # \\Noselect mailboxes have no status
+    assert imap4_ssl_mock.commands == ([] if list_status else ['"INBOX"', '"[Gmail]/Sent Mail"'])
+
+  @pytest.mark.parametrize("message_id", ['x"\r\nA1 DELETE Archive\r\n', 'x\nA1 DELETE Archive', 'x\0'])
+  def test_get_email_by_message_id_rejects_line_breaks(self, message_id) -> None:
+    class RecordingIMAP4(imaplib.IMAP4):
+      """Real imaplib command building, everything written to the socket is recorded"""
+      def open(self, host='', port=0, timeout=None):
+        self.sent = []
+        self.lines = [b'* OK ready\r\n']
+
+      def readline(self):
+        return self.lines.pop(0) if self.lines else b''
+
+      def send(self, data):
+        self.sent.append(data)
+        if b' CAPABILITY' in data:
+          self.lines += [b'* CAPABILITY IMAP4rev1\r\n', data.split(b' ')[0] + b' OK done\r\n']
+
+    imap4 = RecordingIMAP4()
+    imap4.sent = []
+    imap4.state = 'SELECTED'
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4
+    reader.mailbox = 'INBOX'
+    reader.uidvalidity = 1
+
+    assert reader.get_email_by_message_id(message_id) is None
+    assert imap4.sent == []
+
+  @pytest.mark.parametrize("indexed, expected_commands",
+  [
+    (False, ['SEARCH', 'FETCH']),
+    (True, ['FETCH']),
+  ])
+  def test_get_email_by_message_id(self, indexed, expected_commands) -> None:
+    class imap4_ssl_mock:
+      state = 'SELECTED'
+      commands = []
+
+      def _quote(value):
+        return '"' + value + '"'
+
+      def uid(command, *args):
+        imap4_ssl_mock.commands.append(command)
+        if command == 'SEARCH':
+          assert args == ('HEADER', 'Message-ID', '"<Y9+Apzn2XyMvNzpd@test.local>"')
+          return ('OK', [b'42'])
+        return ('OK', [(b'7 (UID 42 RFC822 {94}', b'From: user@test.local\r\nSubject: Test 1\r\nMessage-ID: <Y9+Apzn2XyMvNzpd@test.local>\r\n\r\nTest 1 email body\r\n'), b')'])
+
+    index = MessageIdIndex()
+    reader = IMAPReader(email_id="", email_password="", email_host="", message_id_index=index)
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.mailbox = 'INBOX'
+    reader.uidvalidity = 1
+    if indexed:
+      index.add('<Y9+Apzn2XyMvNzpd@test.local>', 'INBOX', 1, 42)
+
+    uid, message = reader.get_email_by_message_id('Y9+Apzn2XyMvNzpd@test.local')
+
+    assert uid == 42
+    assert message.get('Subject') == 'Test 1'
+    assert imap4_ssl_mock.commands == expected_commands
+    # Fetched messages are added to the index
+    assert index.get('<Y9+Apzn2XyMvNzpd@test.local>', 'INBOX', 1) == 42
+
+  def test_get_email_by_uid_not_found(self) -> None:
+    class imap4_ssl_mock:
+      state = 'SELECTED'
+
+      def uid(command, *args):
+        return ('OK', [None])
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.mailbox = 'INBOX'
+    reader.uidvalidity = 1
+
+    assert reader.get_email_by_uid(99) is None
+
+  @pytest.mark.parametrize("server_response, expected_message",
+  [
+    (b'* 3 EXISTS\r\n* 1 FETCH (UID 42 BODY[] {30}\r\nSubject: Test 1\r\n\r\nTest body\r\n)\r\nA1 OK UID FETCH completed\r\n', b'Subject: Test 1\r\n\r\nTest body\r\n'),
+    (b'* 1 FETCH (FLAGS (\\Seen) BODY[] {5}\r\nabcde UID 42)\r\nA1 OK UID FETCH completed\r\n', b'abcde'),
+    (b'A1 OK UID FETCH completed\r\n', None),
+  ])
+  def test_open_raw_message_streams_literal(self, server_response, expected_message) -> None:
+    class imap4_ssl_mock:
+      state = 'SELECTED'
+      tagged_commands = {}
+      sent = []
+      server = io.BytesIO(server_response)
+      error = Exception
+      abort = Exception
+
+      def _new_tag():
+        imap4_ssl_mock.tagged_commands[b'A1'] = None
+        return b'A1'
+
+      def send(data):
+        imap4_ssl_mock.sent.append(data)
+
+      def readline():
+        return imap4_ssl_mock.server.readline()
+
+      def read(size):
+        return imap4_ssl_mock.server.read(size)
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.mailbox = 'INBOX'
+    reader.uidvalidity = 1
+    raw_message = reader.open_raw_message(42, chunk_size=4)
+
+    assert imap4_ssl_mock.sent == [b'A1 UID FETCH 42 (UID BODY.PEEK[])\r\n']
+    if expected_message is None:
+      assert raw_message is None
+    else:
+      size, chunks = raw_message
+      assert reader.broken == True
+      chunks = list(chunks)
+      assert size == len(expected_message)
+      assert max(len(chunk) for chunk in chunks) <= 4
+      assert b''.join(chunks) == expected_message
+    assert reader.broken == False
+    assert imap4_ssl_mock.tagged_commands == {}
+
+  @pytest.mark.parametrize("input_string, expected_output",
+    [
+      ("2023-02-04T15:26:44.920Z", datetime(2023, 2, 4, 15, 26, 44, 920000, tzinfo=timezone.utc)),
+      ("2023-02-04T15:39:29", datetime(2023, 2, 4, 15, 39, 29, tzinfo=timezone.utc)),
+      ("2000-01-23T01:23:45+09:00", datetime(2000, 1, 22, 16, 23, 45, tzinfo=timezone.utc)),
+      ("2023-02-04", datetime(2023, 2, 4, tzinfo=timezone.utc)),
+    ]
+  )
+  def test_parse_iso8601_datetime(self, input_string, expected_output) -> None:
+    assert self.reader.parse_iso8601_datetime(input_string) == expected_output
+
+  @pytest.mark.parametrize("input_string", [(""), (None), (123), ("2023/02/04 15:26:44")])
+  def test_parse_iso8601_datetime_with_invalid_dates_raises_an_exception(self, input_string) -> None:
+    with pytest.raises(ValueError, match = "Invalid ISO 8601 string"):
+      self.reader.parse_iso8601_datetime(input_string)
+
+  @pytest.mark.parametrize("item, expected",
+  [
+    (b'12 (UID 42 INTERNALDATE "05-Feb-2023 05:10:47 -0500")', (12, datetime(2023, 2, 5, 10, 10, 47, tzinfo=timezone.utc))),
+    (b'3 (INTERNALDATE " 5-Feb-2023 05:10:47 +0100" UID 7)', (3, datetime(2023, 2, 5, 4, 10, 47, tzinfo=timezone.utc))),
+    (b'3 (UID 7)', None),
+  ])
+  def test_parse_internaldate_response(self, item, expected) -> None:
+    assert parse_internaldate_response(item) == expected
+
+  def test_to_sequence_set(self) -> None:
+    assert to_sequence_set([7, 1, 2, 3, 9, 10]) == '1:3,7,9:10'
+
+  @pytest.mark.parametrize("within", [False, True])
+  def test_get_emails_between(self, within) -> None:
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(minutes=30)
+    internaldates = {
+      1: now - timedelta(hours=5),
+      2: now - timedelta(minutes=20),
+      3: now - timedelta(minutes=10),
+    }
+
+    class imap4_ssl_mock:
+      searches = []
+      fetched = []
+
+      def select(mailbox, readonly):
+        return ('OK', [b'3'])
+
+      def has_capability(name):
+        return within and name == 'WITHIN'
+
+      def search(charset, *criteria):
+        imap4_ssl_mock.searches.append(criteria)
+        # YOUNGER is relative to the proxy clock, a skewed server returns the older message too
+        return ('OK', [b'1 2 3'])
+
+      def fetch(message_set, items):
+        if items == '(UID INTERNALDATE)':
+          assert message_set == '1:3'
+          return ('OK', [b'%d (UID %d INTERNALDATE "%s")' % (mail_id, mail_id, date.strftime("%d-%b-%Y %H:%M:%S +0000").encode()) for mail_id, date in internaldates.items()])
+        imap4_ssl_mock.fetched.append(message_set)
+        return ('OK', [(b'%s (UID %s RFC822 {33}' % (message_set.encode(), message_set.encode()), b'Subject: Test\r\n\r\nTest email body\r\n'), b')'])
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    messages = reader.get_emails_between(since=since)
+
+    assert len(messages) == 2
+    assert imap4_ssl_mock.fetched == ['3', '2']
+    if within:
+      assert imap4_ssl_mock.searches[0][0] == 'YOUNGER'
+      assert 1800 <= int(imap4_ssl_mock.searches[0][1]) <= 1802
+    else:
+      assert imap4_ssl_mock.searches[0][0] == 'SINCE'
+
+  def test_get_emails_between_widens_utc_dates(self) -> None:
+    class imap4_ssl_mock:
+      searches = []
+
+      def select(mailbox, readonly):
+        return ('OK', [b'0'])
+
+      def has_capability(name):
+        return False
+
+      def search(charset, *criteria):
+        imap4_ssl_mock.searches.append(criteria)
+        return ('OK', [b''])
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    # 5 Feb in the client timezones, 4 Feb and 6 Feb in UTC
+    reader.get_emails_between(since=datetime(2023, 2, 5, 0, 30, tzinfo=timezone(timedelta(hours=14))), until=datetime(2023, 2, 5, 23, 30, tzinfo=timezone(timedelta(hours=-10))))
+
+    assert imap4_ssl_mock.searches == [('SINCE', '03-Feb-2023', 'BEFORE', '08-Feb-2023')]
+
+  def test_get_emails_between_future_since(self) -> None:
+    class imap4_ssl_mock:
+      def select(mailbox, readonly):
+        return ('OK', [b'3'])
+
+    reader = IMAPReader(email_id="", email_password="", email_host="")
+    reader.imap4_ssl = imap4_ssl_mock
+    assert reader.get_emails_between(since=datetime.now(timezone.utc) + timedelta(hours=1)) == []
+
+  @pytest.mark.parametrize("capabilities", [("THREAD=REFERENCES",), ()])
+  def test_get_threads(self, capabilities) -> None:
+    headers = {
+      1: b'Message-ID: <1@test.local>\r\nFrom: a@test.local\r\n\r\n',
+      2: b'Message-ID: <2@test.local>\r\nFrom: b@test.local\r\n\r\n',
+      3: b'Message-ID: <3@test.local>\r\nIn-Reply-To: <1@test.local>\r\n\r\n',
+    }
+
+    class imap4_ssl_mock:
+      header_fetches = []
+
+      def select(mailbox, readonly):
+        return ('OK', [b'3'])
+
+      def has_capability(name):
+        return name in capabilities
+
+      def uid(command, *args):
+        if command == 'THREAD':
+          return ('OK', [b'(1 3)(2)'])
+        if command == 'SEARCH':
+          return ('OK', [b'1 2 3'])
+        imap4_ssl_mock.header_fetches.append(args[0])
+        uids = [int(uid) for uid in args[0].replace(':', ',').split(',')]
+        return ('OK', [(b'1 (UID %d BODY[HEADER.FIELDS (MESSAGE-ID)] {10}' % uid, headers[uid]) for uid in range(uids[0], uids[-1] + 1)])
+
+    reader = IMAPReader(email_id="", email_password="", email_host="", thread_index=ThreadIndex())
+    reader.imap4_ssl = imap4_ssl_mock
+
+    assert reader.get_threads() == [[1, 3], [2]]
+    assert reader.get_threads() == [[1, 3], [2]]
+    records = reader.get_thread_records([1, 2, 3])
+    assert records[3]['references'] == ['<1@test.local>']
+    # Headers are only fetched once, the second call is served by the thread index
+    assert imap4_ssl_mock.header_fetches == ['1:3']
+
+  def test_thread_index_keeps_batches_fetched_before_a_timeout(self) -> None:
+    class imap4_ssl_mock:
+      def uid(command, *args):
+        if command == 'SEARCH':
+          return ('OK', [' '.join(str(uid) for uid in range(1, 601)).encode()])
+        if args[0] == '501:600':
+          raise TimeoutError('timed out')
+        return ('OK', [(b'1 (UID %d BODY[HEADER.FIELDS (MESSAGE-ID)] {10}' % uid, b'Message-ID: <%d@test.local>\r\n\r\n' % uid) for uid in range(1, 501)])
+
+    thread_index = ThreadIndex()
+    reader = IMAPReader(email_id="", email_password="", email_host="", thread_index=thread_index)
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.mailbox, reader.uidvalidity = 'INBOX', 1
+    with pytest.raises(TimeoutError):
+      reader.update_thread_index(thread_index)
+
+    # The next request only fetches the headers of the second batch
+    assert thread_index.known_uids('INBOX', 1) == set(range(1, 501))
+
+  def test_fetch_emails_uses_the_message_cache(self) -> None:
+    raw_message = b'Subject: Test\r\nContent-Type: text/plain\r\n\r\nTest email body\r\n'
+
+    class imap4_ssl_mock:
+      fetched = []
+
+      def fetch(message_set, items):
+        if items == '(UID)':
+          return ('OK', [b'1 (UID 11)', b'2 (UID 12)'])
+        imap4_ssl_mock.fetched.append(message_set)
+        return ('OK', [(b'%s (UID 1%s RFC822 {%d}' % (message_set.encode(), message_set.encode(), len(raw_message)), raw_message), b')'])
+
+    cache = MessageCache(1024 * 1024)
+    reader = IMAPReader(email_id="", email_password="", email_host="", message_cache=cache)
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.mailbox, reader.uidvalidity = 'INBOX', 1
+
+    first = reader.fetch_emails([b'1 2'])
+    second = reader.fetch_emails([b'1 2'])
+
+    assert imap4_ssl_mock.fetched == ['2', '1']
+    assert [message is cached for message, cached in zip(first, second)] == [True, True]
+    assert reader.cursor == 11
+    assert reader.get_email_body(second[0], format='plain') == 'Test email body\n'
+    assert cache.get_field(second[0], 'plain') == 'Test email body\n'
+
+  def test_fetch_emails_limit_keeps_the_newest_cached(self) -> None:
+    raw_message = b'Subject: Test\r\nContent-Type: text/plain\r\n\r\nTest email body\r\n'
+
+    class imap4_ssl_mock:
+      fetched = []
+
+      def fetch(message_set, items):
+        imap4_ssl_mock.fetched.append((message_set, items))
+        if items == '(UID)':
+          return ('OK', [b'%d (UID %d)' % (mail_id, mail_id + 100) for mail_id in (19, 20)])
+        return ('OK', [(b'%s (UID 1%s RFC822 {%d}' % (message_set.encode(), message_set.encode(), len(raw_message)), raw_message), b')'])
+
+    # Room for three messages in a mailbox of twenty
+    cache = MessageCache(3 * (int(len(raw_message) * MessageCache.PARSED_SIZE_FACTOR) + MessageCache.ENTRY_OVERHEAD_BYTES))
+    reader = IMAPReader(email_id="", email_password="", email_host="", message_cache=cache)
+    reader.imap4_ssl = imap4_ssl_mock
+    reader.mailbox, reader.uidvalidity = 'INBOX', 1
+    mail_ids = [' '.join(str(mail_id) for mail_id in range(1, 21)).encode()]
+
+    assert len(reader.fetch_emails(mail_ids, limit=2)) == 2
+    imap4_ssl_mock.fetched = []
+    assert len(reader.fetch_emails(mail_ids, limit=2)) == 2
+
+    # Only the UIDs of the newest two are looked up and both are cache hits
+    assert imap4_ssl_mock.fetched == [('19:20', '(UID)')]
@@ -0,0 +1,17 @@
+# App imports
+from locks import LeaderLock
+
+
+class TestLeaderLock(object):
+
+  def test_only_one_holder(self, tmp_path) -> None:
+    path = str(tmp_path / "sync.lock")
+    leader = LeaderLock(path)
+    follower = LeaderLock(path)
+
+    assert leader.acquire() == True
+    assert follower.acquire() == False
+    leader.release()
+    assert follower.acquire() == True
+    assert follower.held == True
+    follower.release()
@@ -0,0 +1,69 @@
+import os
+import pstats
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from http import HTTPStatus
+
+# App imports
+from profiling import ProfiledRoute, ProfilingMiddleware, ProfileStore, RequestProfile, current_profile, phase
+
+
+def create_client(profile_dir: str, admin_token: str = "secret", always: bool = False, max_profiles: int = 20) -> TestClient:
+  test_app = FastAPI()
+  test_app.router.route_class = ProfiledRoute
+
+  @test_app.get('/work')
+  def work():
+    with phase('fetch'):
+      total = sum(range(1000))
+    return {'total': total}
+
+  test_app.add_middleware(ProfilingMiddleware, store=ProfileStore(profile_dir, max_profiles), admin_token=admin_token, always=always)
+  return TestClient(test_app)
+
+
+class TestProfiling(object):
+
+  def test_phase_without_profile_does_nothing(self) -> None:
+    assert current_profile.get() is None
+    with phase('fetch'):
+      pass
+
+  def test_server_timing_sums_phases(self) -> None:
+    profile = RequestProfile()
+    profile.record('fetch', 0.010)
+    profile.record('parse', 0.002)
+    profile.record('fetch', 0.005)
+    assert profile.server_timing() == "fetch;dur=15.0, parse;dur=2.0"
+
+  @pytest.mark.parametrize("query, headers, admin_token",
+  [
+    ("", {"X-Admin-Token": "secret"}, "secret"),
+    ("?profile=1", {}, "secret"),
+    ("?profile=1", {"X-Admin-Token": "wrong"}, "secret"),
+    ("?profile=1", {"X-Admin-Token": ""}, None),
+  ])
+  def test_not_profiled(self, tmp_path, query, headers, admin_token) -> None:
+    response = create_client(str(tmp_path), admin_token).get(f"/work{query}", headers=headers)
+
+    assert response.status_code == HTTPStatus.OK
+    assert "server-timing" not in response.headers
+    assert os.listdir(str(tmp_path)) == []
+
+  def test_profiled_request(self, tmp_path) -> None:
+    response = create_client(str(tmp_path)).get("/work?profile=1", headers={"X-Admin-Token": "secret"})
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == {'total': 499500}
+    phases = [entry.split(';')[0] for entry in response.headers["server-timing"].split(', ')]
+    assert phases == ['fetch', 'handler', 'total']
+    profile_path = ProfileStore(str(tmp_path)).path(response.headers["x-profile-id"])
+    assert any(function[2] == 'work' for function in pstats.Stats(profile_path).stats)
+
+  def test_profile_store_keeps_newest(self, tmp_path) -> None:
+    client = create_client(str(tmp_path), always=True, max_profiles=2)
+    for _ in range(3):
+      client.get("/work")
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert ProfileStore(str(tmp_path)).path('../../etc/passwd') is None
@@ -0,0 +1,167 @@
+import time
+import threading
+import pytest
+
+# App imports
+from scheduler import SessionScheduler, QueueFull, QueueTimeout
+
+
+class FakeReader(object):
+  def __init__(self):
+    self.logins = 0
+    self.closed = False
+
+  def login(self):
+    self.logins += 1
+
+  def close(self):
+    self.closed = True
+
+  def noop(self):
+    return ('OK', [b''])
+
+
+class TestSessionScheduler(object):
+
+  def test_released_sessions_are_reused(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=2)
+    reader = scheduler.acquire()
+    scheduler.release(reader)
+
+    assert scheduler.acquire() is reader
+    assert reader.logins == 1
+
+  def test_unhealthy_sessions_are_closed(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=2)
+    with pytest.raises(OSError):
+      with scheduler.session() as reader:
+        raise OSError('Connection reset')
+
+    assert reader.closed == True
+    assert scheduler.acquire() is not reader
+
+  def test_queue_full_is_rejected_immediately(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=1, max_queue=0)
+    scheduler.acquire()
+
+    started = time.monotonic()
+    with pytest.raises(QueueFull) as exception:
+      scheduler.acquire()
+    assert time.monotonic() - started < 0.5
+    assert exception.value.retry_after >= 1
+
+  def test_waiting_past_the_deadline_times_out(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=1)
+    scheduler.acquire()
+
+    with pytest.raises(QueueTimeout):
+      scheduler.acquire(deadline=time.monotonic() + 0.05)
+    assert scheduler.waiters == []
+
+  def test_never_more_than_max_sessions(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=2, max_queue=20)
+    in_use = []
+    peak = []
+    lock = threading.Lock()
+
+    def request():
+      with scheduler.session():
+        with lock:
+          in_use.append(1)
+          peak.append(len(in_use))
+        time.sleep(0.01)
+        with lock:
+          in_use.pop()
+
+    threads = [threading.Thread(target=request) for _ in range(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    assert max(peak) == 2
+    assert len(peak) == 10
+    assert len(scheduler.idle) <= 2
+
+  def test_earliest_deadline_is_served_first(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=1)
+    reader = scheduler.acquire()
+    served = []
+
+    def request(name, deadline):
+      with scheduler.session(deadline):
+        served.append(name)
+
+    late = threading.Thread(target=request, args=("late", time.monotonic() + 10))
+    late.start()
+    while len(scheduler.waiters) < 1:
+      time.sleep(0.001)
+    early = threading.Thread(target=request, args=("early", time.monotonic() + 5))
+    early.start()
+    while len(scheduler.waiters) < 2:
+      time.sleep(0.001)
+
+    scheduler.release(reader)
+    late.join()
+    early.join()
+    assert served == ["early", "late"]
+
+  def test_background_sessions_leave_room_for_requests(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=2, max_queue=0)
+    background_reader = scheduler.acquire(background=True)
+    acquired = []
+    waiting = threading.Thread(target=lambda: acquired.append(scheduler.acquire(background=True)))
+    waiting.start()
+    time.sleep(0.05)
+
+    # The second background session waits without taking the last session or a queue slot
+    assert acquired == []
+    reader = scheduler.acquire()
+    assert reader.deadline is None
+
+    scheduler.release(background_reader)
+    waiting.join(timeout=1)
+    assert len(acquired) == 1
+    assert scheduler.background_active == 1
+
+  def test_background_sessions_wait_behind_queued_requests(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=1, max_background=1)
+    reader = scheduler.acquire()
+    served = []
+
+    def work(name, background):
+      with scheduler.session(time.monotonic() + 5, background=background):
+        served.append(name)
+
+    background = threading.Thread(target=work, args=("background", True))
+    background.start()
+    time.sleep(0.02)
+    request = threading.Thread(target=work, args=("request", False))
+    request.start()
+    while len(scheduler.waiters) < 1:
+      time.sleep(0.001)
+
+    scheduler.release(reader)
+    background.join()
+    request.join()
+    assert served == ["request", "background"]
+
+  def test_prewarm_fills_idle_sessions(self) -> None:
+    scheduler = SessionScheduler(FakeReader, max_sessions=2)
+    scheduler.prewarm(5).join()
+
+    assert len(scheduler.idle) == 2
+    assert scheduler.active == 0
+    reader = scheduler.acquire()
+    assert reader.logins == 1
+    assert len(scheduler.idle) == 1
+
+  def test_prewarm_stops_on_login_failure(self) -> None:
+    class FailingReader(FakeReader):
+      def login(self):
+        raise OSError('Connection refused')
+
+    scheduler = SessionScheduler(FailingReader, max_sessions=2)
+    scheduler.prewarm(2).join()
+    assert scheduler.idle == []
+    assert scheduler.active == 0
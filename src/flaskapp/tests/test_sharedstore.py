@@ -0,0 +1,68 @@
+import time
+import pytest
+from contextlib import nullcontext
+
+# App imports
+from sharedstore import SharedStore, SharedSync
+from locks import LeaderLock
+from tests.test_exporter import FakeReader
+
+
+class TestSharedStore(object):
+
+  def test_messages_newest_first(self, tmp_path) -> None:
+    store = SharedStore(str(tmp_path / "store.db"))
+    assert store.synced() == False
+    store.apply('INBOX', 1, [(uid, {'subject': f"Test {uid}", 'uid': uid}) for uid in (1, 2, 3)])
+
+    assert store.synced() == True
+    assert [message['uid'] for message in store.messages()] == [3, 2, 1]
+    assert [message['uid'] for message in store.messages(limit=1, before_uid=3)] == [2]
+    assert store.message(2)['subject'] == "Test 2"
+    assert store.message(7) is None
+
+  def test_uidvalidity_change_drops_messages(self, tmp_path) -> None:
+    store = SharedStore(str(tmp_path / "store.db"))
+    store.apply('INBOX', 1, [(1, {'uid': 1}), (2, {'uid': 2})])
+    store.apply('INBOX', 2, [(5, {'uid': 5})], complete=False)
+
+    assert store.uids() == {5}
+    assert store.synced() == False
+
+  def test_synced_with_max_age(self, tmp_path) -> None:
+    store = SharedStore(str(tmp_path / "store.db"))
+    store.apply('INBOX', 1, [(1, {'uid': 1})])
+    assert store.synced(max_age=90) == True
+
+    with store.connection() as connection:
+      connection.execute('UPDATE mailboxes SET synced_at = ?', (time.time() - 91,))
+    assert store.synced(max_age=90) == False
+    assert store.synced() == True
+
+
+class TestSharedSync(object):
+
+  def test_sync_fetches_only_new_uids(self, tmp_path) -> None:
+    store = SharedStore(str(tmp_path / "store.db"))
+    readers = [FakeReader([1, 2, 3]), FakeReader([2, 3, 4])]
+    sync = SharedSync(store, LeaderLock(str(tmp_path / "store.lock")), lambda: nullcontext(readers[0]), batch_size=2)
+    sync.sync()
+
+    assert [message['subject'] for message in store.messages()] == ["Test 3", "Test 2", "Test 1"]
+
+    sync.session_factory = lambda: nullcontext(readers[1])
+    sync.sync()
+    # UID 1 was expunged, only UID 4 is fetched
+    assert store.uids() == {2, 3, 4}
+    assert readers[1].batches == 1
+
+  def test_only_the_leader_syncs(self, tmp_path) -> None:
+    store = SharedStore(str(tmp_path / "store.db"))
+    leader_lock = LeaderLock(str(tmp_path / "store.lock"))
+    leader_lock.acquire()
+    sync = SharedSync(store, LeaderLock(str(tmp_path / "store.lock")), lambda: pytest.fail("follower opened a session"), interval=0.01)
+    sync.start()
+    sync.stop()
+
+    assert store.synced() == False
+    leader_lock.release()
@@ -0,0 +1,90 @@
+import pytest
+
+# App imports
+from threads import ThreadIndex, parse_thread_response, summarize_thread, thread_record_from_bytes
+
+
+def record(message_id, references=(), sender="a@test.local", date="Sun, 5 Feb 2023 05:10:47 -0500"):
+  return {'message_id': message_id, 'references': list(references), 'from': sender, 'to': "b@test.local", 'cc': None, 'date': date, 'subject': f"Subject {message_id}"}
+
+
+class TestThreadIndex(object):
+
+  def test_reply_before_parent_is_joined(self) -> None:
+    index = ThreadIndex()
+    # Reply to <1> arrives before <1> itself is indexed
+    index.add('INBOX', 1, 3, record('<3>', ['<1>', '<2>']))
+    index.add('INBOX', 1, 4, record('<4>'))
+    index.add('INBOX', 1, 1, record('<1>'))
+    index.add('INBOX', 1, 2, record('<2>', ['<1>']))
+
+    assert index.threads('INBOX', 1) == [[4], [1, 2, 3]]
+
+  def test_remove_splits_threads(self) -> None:
+    index = ThreadIndex()
+    index.add('INBOX', 1, 1, record('<1>'))
+    index.add('INBOX', 1, 2, record('<2>', ['<1>']))
+    index.add('INBOX', 1, 3, record(None))
+    index.remove('INBOX', 1, [2])
+
+    assert index.threads('INBOX', 1) == [[3], [1]]
+    assert index.known_uids('INBOX', 1) == {1, 3}
+
+  def test_uidvalidity_change_resets_mailbox(self) -> None:
+    index = ThreadIndex()
+    index.add('INBOX', 1, 1, record('<1>'))
+    assert index.known_uids('INBOX', 2) == set()
+
+  def test_least_recently_used_mailbox_is_dropped(self) -> None:
+    index = ThreadIndex(max_records=3)
+    index.add('INBOX', 1, 1, record('<1>'))
+    index.add('INBOX', 1, 2, record('<2>', ['<1>']))
+    index.add('Sent', 1, 1, record('<3>'))
+    index.known_uids('INBOX', 1)
+    index.add('Archive', 1, 1, record('<4>'))
+
+    assert index.known_uids('INBOX', 1) == {1, 2}
+    assert index.known_uids('Sent', 1) == set()
+
+  def test_mailbox_larger_than_the_index_is_not_kept(self) -> None:
+    index = ThreadIndex(max_records=2)
+    for uid in range(1, 4):
+      index.add('INBOX', 1, uid, record(f"<{uid}>"))
+
+    assert index.threads('INBOX', 1) == [[3], [2], [1]]
+    assert index.known_uids('INBOX', 1) == set()
+
+
+class TestThreadHelpers(object):
+
+  @pytest.mark.parametrize("data, expected",
+  [
+    (b'(2)(3 6 (4 23)(44 7 96))', [[2], [3, 4, 6, 7, 23, 44, 96]]),
+    (b'((1)(2))(3)', [[1, 2], [3]]),
+    (b'', []),
+  ])
+  def test_parse_thread_response(self, data, expected) -> None:
+    assert parse_thread_response(data) == expected
+
+  def test_thread_record_from_bytes(self) -> None:
+    headers = b'Message-ID: <2@test.local>\r\nIn-Reply-To: <1@test.local>\r\nReferences: <0@test.local> <1@test.local>\r\nSubject: Re: Test\r\n\r\n'
+    parsed = thread_record_from_bytes(headers)
+    assert parsed['message_id'] == '<2@test.local>'
+    assert parsed['references'] == ['<0@test.local>', '<1@test.local>']
+    assert parsed['subject'] == 'Re: Test'
+
+  def test_summarize_thread(self) -> None:
+    records = {
+      1: record('<1>', sender="Alice <Alice@test.local>", date="Sun, 5 Feb 2023 05:10:47 -0500"),
+      2: record('<2>', ['<1>'], sender="c@test.local", date="Mon, 6 Feb 2023 05:10:47 -0500"),
+    }
+    summary = summarize_thread([2, 1], records)
+
+    assert summary == {
+      'id': 1,
+      'subject': 'Subject <1>',
+      'count': 2,
+      'last_date': "Mon, 6 Feb 2023 05:10:47 -0500",
+      'participants': ['alice@test.local', 'b@test.local', 'c@test.local'],
+      'uids': [1, 2],
+    }
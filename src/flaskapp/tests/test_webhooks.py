@@ -0,0 +1,194 @@
+import os
+import json
+import threading
+import pytest
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# App imports
+from webhooks import WebhookStore, WebhookManager, message_matches
+from tests.test_exporter import FakeReader
+
+
+class Receiver(object):
+  """Local HTTP server recording webhook POSTs, answering 500 to the first `failures` requests"""
+  def __init__(self, failures: int = 0):
+    self.requests = []
+    self.failures = failures
+    receiver = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with lock:
+          receiver.requests.append(body)
+          status = 500 if len(receiver.requests) <= receiver.failures else 204
+        self.send_response(status)
+        self.end_headers()
+
+      def log_message(self, *args):
+        pass
+
+    lock = threading.Lock()
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+@pytest.fixture
+def receiver():
+  receiver = Receiver()
+  yield receiver
+  receiver.close()
+
+
+def create_manager(tmp_path, readers, **kwargs) -> WebhookManager:
+  return WebhookManager(WebhookStore(str(tmp_path / "webhooks.db")), lambda: nullcontext(readers.pop(0)), backoff=0, **kwargs)
+
+
+class TestWebhookManager(object):
+
+  def test_new_messages_are_delivered_in_batches(self, tmp_path, receiver) -> None:
+    readers = [FakeReader([1, 2]), FakeReader([1, 2, 3, 4, 5])]
+    manager = create_manager(tmp_path, readers, batch_size=2)
+    subscription = manager.subscribe(receiver.url)
+    filtered = manager.subscribe(receiver.url, subject="Test 4")
+
+    # The first poll only records where the mailbox is
+    assert manager.poll() == 0
+    assert manager.poll() == 3
+    manager.deliver()
+
+    delivered = sorted((request['subscription_id'], [message['uid'] for message in request['messages']]) for request in receiver.requests)
+    assert delivered == sorted([(subscription['id'], [3, 4]), (subscription['id'], [5]), (filtered['id'], [4])])
+    assert manager.store.subscription(subscription['id'])['pending'] == 0
+
+  def test_failed_deliveries_are_retried_from_the_outbox(self, tmp_path) -> None:
+    receiver = Receiver(failures=1)
+    try:
+      manager = create_manager(tmp_path, [FakeReader([1]), FakeReader([1, 2])], max_attempts=3)
+      subscription = manager.subscribe(receiver.url)
+      manager.poll()
+      manager.poll()
+      manager.deliver()
+      assert manager.store.subscription(subscription['id'])['pending'] == 1
+
+      # A restarted manager picks the delivery up from the database
+      manager = create_manager(tmp_path, [])
+      manager.deliver()
+      assert len(receiver.requests) == 2
+      assert receiver.requests[0]['delivery_id'] == receiver.requests[1]['delivery_id']
+      assert manager.store.subscription(subscription['id'])['pending'] == 0
+    finally:
+      receiver.close()
+
+  def test_unreachable_endpoint_is_marked_failed(self, tmp_path) -> None:
+    manager = create_manager(tmp_path, [FakeReader([1]), FakeReader([1, 2])], max_attempts=2)
+    subscription = manager.subscribe("http://127.0.0.1:9/hook")
+    manager.poll()
+    manager.poll()
+    manager.deliver()
+    manager.deliver()
+
+    assert manager.store.subscription(subscription['id'])['failed'] == 1
+
+  def test_concurrency_is_bounded_per_endpoint(self, tmp_path, monkeypatch) -> None:
+    manager = create_manager(tmp_path, [FakeReader([]), FakeReader(list(range(1, 11)))], batch_size=1, concurrency=2)
+    manager.subscribe("http://receiver.test/hook")
+    manager.poll()
+    manager.poll()
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def send(delivery):
+      with lock:
+        in_flight.append(delivery['id'])
+        peak.append(len(in_flight))
+      threading.Event().wait(0.01)
+      with lock:
+        in_flight.remove(delivery['id'])
+      manager.store.delivered(delivery['id'])
+      return True
+
+    monkeypatch.setattr(manager, "send", send)
+    manager.deliver()
+    assert len(peak) == 10
+    assert max(peak) == 2
+
+  def test_failed_endpoint_is_skipped_for_the_rest_of_the_round(self, tmp_path, monkeypatch) -> None:
+    manager = create_manager(tmp_path, [FakeReader([]), FakeReader(list(range(1, 11)))], batch_size=1, concurrency=1)
+    subscription = manager.subscribe("http://127.0.0.1:9/hook")
+    manager.poll()
+    manager.poll()
+    attempts = []
+    send = manager.send
+    monkeypatch.setattr(manager, "send", lambda delivery: attempts.append(delivery['id']) or send(delivery))
+    manager.backoff = 60
+    manager.deliver()
+
+    assert len(attempts) == 1
+    # The other deliveries wait for the retry of the failed one
+    assert manager.store.due() == []
+    assert manager.store.subscription(subscription['id'])['pending'] == 10
+
+  def test_endpoint_failed_for_good_still_postpones_the_round(self, tmp_path) -> None:
+    manager = create_manager(tmp_path, [FakeReader([]), FakeReader(list(range(1, 4)))], batch_size=1, concurrency=1, max_attempts=1)
+    subscription = manager.subscribe("http://127.0.0.1:9/hook")
+    manager.poll()
+    manager.poll()
+    manager.backoff = 60
+    manager.deliver()
+
+    assert manager.store.due() == []
+    assert manager.store.subscription(subscription['id'])['failed'] == 1
+    assert manager.store.subscription(subscription['id'])['pending'] == 2
+
+  def test_store_is_created_on_first_use(self, tmp_path) -> None:
+    store = WebhookStore(str(tmp_path / "webhooks.db"))
+    assert os.listdir(str(tmp_path)) == []
+    assert store.exists() == False
+
+    assert store.subscriptions() == []
+    assert store.exists() == True
+
+  def test_poll_without_subscriptions_does_not_write(self, tmp_path) -> None:
+    manager = create_manager(tmp_path, [])
+    manager.store.clear_mailbox_state = lambda mailbox: pytest.fail("wrote the mailbox state")
+
+    assert manager.poll() == 0
+
+  def test_deliveries_do_not_wait_for_the_poll_interval(self, tmp_path, receiver) -> None:
+    manager = create_manager(tmp_path, [FakeReader([1])] + [FakeReader([1, 2]) for _ in range(100)], interval=0.05, retry_interval=0.01)
+    manager.subscribe(receiver.url)
+    manager.start()
+    manager.start()
+    try:
+      for _ in range(200):
+        if receiver.requests:
+          break
+        threading.Event().wait(0.01)
+    finally:
+      manager.stop()
+
+    assert len(manager.threads) == 2
+    assert [message['uid'] for message in receiver.requests[0]['messages']] == [2]
+
+  @pytest.mark.parametrize("subscription, expected",
+  [
+    ({'subject': None, 'sender': None}, True),
+    ({'subject': 'order', 'sender': None}, True),
+    ({'subject': 'order', 'sender': 'shop.test'}, True),
+    ({'subject': None, 'sender': 'bank.test'}, False),
+  ])
+  def test_message_matches(self, subscription, expected) -> None:
+    message = {'subject': 'Your ORDER confirmation', 'from': 'Shop <noreply@shop.test>'}
+    assert message_matches(subscription, message) == expected
+
+  def test_subscribe_invalid_url(self, tmp_path) -> None:
+    with pytest.raises(ValueError):
+      create_manager(tmp_path, []).subscribe("ftp://receiver.test/hook")
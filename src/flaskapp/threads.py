@@ -0,0 +1,212 @@
+import re
+import email
+import threading
+from collections import OrderedDict
+from email.policy import default as default_policy
+from email.utils import getaddresses, parsedate_to_datetime
+
+# Header fields needed to thread and summarize a message, fetched instead of the whole message
+THREAD_HEADER_FIELDS = ('FROM', 'TO', 'CC', 'DATE', 'SUBJECT', 'MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES')
+MESSAGE_ID_PATTERN = re.compile(r'<[^<>\s]+>')
+THREAD_TOKEN_PATTERN = re.compile(rb'\(|\)|\d+')
+
+def thread_record(message: email.message.Message) -> dict:
+  """Header fields of a message used for threading and thread summaries
+
+  Args:
+    message: Message, only the headers are read
+
+  Returns:
+    Dictionary of message_id, references (In-Reply-To and References Message-IDs), from, to, cc, date and subject
+  """
+  def header(name):
+    try:
+      value = message.get(name)
+    except Exception:
+      # Malformed header, treat it as missing rather than failing the whole index
+      return None
+    return str(value) if value is not None else None
+
+  message_ids = MESSAGE_ID_PATTERN.findall(header('Message-ID') or '')
+  references = MESSAGE_ID_PATTERN.findall(header('References') or '') + MESSAGE_ID_PATTERN.findall(header('In-Reply-To') or '')
+  return {
+    'message_id': message_ids[0] if message_ids else None,
+    'references': list(dict.fromkeys(references)),
+    'from': header('From'),
+    'to': header('To'),
+    'cc': header('Cc'),
+    'date': header('Date'),
+    'subject': header('Subject'),
+  }
+
+def thread_record_from_bytes(headers: bytes) -> dict:
+  return thread_record(email.message_from_bytes(headers, policy=default_policy))
+
+def parse_thread_response(data: bytes) -> list:
+  """Parse a THREAD response (RFC 5256) into threads
+
+  Sample response -> b'(2)(3 6 (4 23)(44 7 96))'
+
+  Returns:
+    List of threads, each a list of UIDs (or sequence numbers) in ascending order
+  """
+  threads = []
+  depth = 0
+  current = []
+  for token in THREAD_TOKEN_PATTERN.findall(data or b''):
+    if token == b'(':
+      depth += 1
+    elif token == b')':
+      depth -= 1
+      if depth == 0 and current:
+        threads.append(sorted(current))
+        current = []
+    else:
+      current.append(int(token))
+  return threads
+
+def parse_date(date: str):
+  try:
+    return parsedate_to_datetime(date) if date else None
+  except (TypeError, ValueError):
+    return None
+
+def summarize_thread(uids: list, records: dict) -> dict:
+  """Summary of a thread from the header records of its messages, no bodies are needed
+
+  Args:
+    uids: UIDs of the messages in the thread
+    records: Dictionary of UID to thread_record
+
+  Returns:
+    Dictionary of id (lowest UID), subject (of the first message), count, last_date, participants and uids
+  """
+  uids = sorted(uids)
+  participants = []
+  last_date = None
+  last_datetime = None
+  for uid in uids:
+    record = records.get(uid) or {}
+    for _, address in getaddresses([record.get(name) or '' for name in ('from', 'to', 'cc')]):
+      address = address.lower()
+      if address and address not in participants:
+        participants.append(address)
+    parsed_date = parse_date(record.get('date'))
+    if parsed_date is not None and parsed_date.tzinfo is not None and (last_datetime is None or parsed_date > last_datetime):
+      last_datetime, last_date = parsed_date, record.get('date')
+  return {
+    'id': uids[0],
+    'subject': (records.get(uids[0]) or {}).get('subject'),
+    'count': len(uids),
+    'last_date': last_date,
+    'participants': participants,
+    'uids': uids,
+  }
+
+class ThreadIndex:
+  """Threads of each mailbox built from Message-ID, In-Reply-To and References headers
+
+  Messages are added one at a time and joined to the threads of every Message-ID they
+  reference (union-find), so the index is kept up to date without rebuilding it. Threads
+  are only valid for one UIDVALIDITY of a mailbox, a new one starts an empty index.
+
+  Memory is bounded by max_records header records: the least recently used mailboxes are
+  dropped first, and a mailbox with more messages than max_records on its own is threaded
+  for the request and not kept.
+
+  Args:
+    max_records: (optional) Maximum number of header records kept. Defaults to 100000
+  """
+  def __init__(self, max_records: int = 100000):
+    self.max_records = max_records
+    self.mailboxes = OrderedDict()
+    self.lock = threading.Lock()
+
+  def _state(self, mailbox: str, uidvalidity: int) -> dict:
+    state = self.mailboxes.get(mailbox)
+    if state is None or state['uidvalidity'] != uidvalidity:
+      state = {'uidvalidity': uidvalidity, 'records': {}, 'parent': {}, 'members': {}}
+      self.mailboxes[mailbox] = state
+    self.mailboxes.move_to_end(mailbox)
+    return state
+
+  def _evict(self) -> None:
+    """Drop least recently used mailboxes until the records fit, the most recent one is kept"""
+    while len(self.mailboxes) > 1 and sum(len(state['records']) for state in self.mailboxes.values()) > self.max_records:
+      self.mailboxes.popitem(last=False)
+
+  @staticmethod
+  def _find(state: dict, key: str) -> str:
+    parent = state['parent']
+    root = key
+    while parent.get(root, root) != root:
+      root = parent[root]
+    # Path compression
+    while key != root:
+      key, parent[key] = parent[key], root
+    return root
+
+  def _union(self, state: dict, key: str, other_key: str) -> None:
+    root, other_root = self._find(state, key), self._find(state, other_key)
+    if root == other_root:
+      return
+    members = state['members']
+    # Attach the smaller thread to the larger one
+    if len(members.get(root, ())) < len(members.get(other_root, ())):
+      root, other_root = other_root, root
+    state['parent'][other_root] = root
+    other_members = members.pop(other_root, None)
+    if other_members:
+      members.setdefault(root, set()).update(other_members)
+
+  def _add(self, state: dict, uid: int, record: dict) -> None:
+    key = record.get('message_id') or f"uid:{uid}"
+    state['records'][uid] = record
+    state['parent'].setdefault(key, key)
+    state['members'].setdefault(self._find(state, key), set()).add(uid)
+    for reference in record.get('references') or []:
+      state['parent'].setdefault(reference, reference)
+      self._union(state, key, reference)
+
+  def add(self, mailbox: str, uidvalidity: int, uid: int, record: dict) -> None:
+    if uid is None:
+      return
+    with self.lock:
+      state = self._state(mailbox, uidvalidity)
+      if uid not in state['records']:
+        self._add(state, uid, record)
+        self._evict()
+
+  def remove(self, mailbox: str, uidvalidity: int, uids) -> None:
+    """Drop expunged messages, the threads are rebuilt from the remaining header records"""
+    with self.lock:
+      removed = set(uids)
+      records = {uid: record for uid, record in self._state(mailbox, uidvalidity)['records'].items() if uid not in removed}
+      del self.mailboxes[mailbox]
+      state = self._state(mailbox, uidvalidity)
+      for uid in sorted(records):
+        self._add(state, uid, records[uid])
+
+  def known_uids(self, mailbox: str, uidvalidity: int) -> set:
+    with self.lock:
+      return set(self._state(mailbox, uidvalidity)['records'])
+
+  def records(self, mailbox: str, uidvalidity: int, uids) -> dict:
+    """Returns:
+      Dictionary of UID to thread_record for the known UIDs
+    """
+    with self.lock:
+      records = self._state(mailbox, uidvalidity)['records']
+      return {uid: records[uid] for uid in uids if uid in records}
+
+  def threads(self, mailbox: str, uidvalidity: int) -> list:
+    """Returns:
+      List of threads (lists of UIDs), the thread with the newest message first
+    """
+    with self.lock:
+      state = self._state(mailbox, uidvalidity)
+      threads = [sorted(uids) for uids in state['members'].values() if uids]
+      if len(state['records']) > self.max_records:
+        del self.mailboxes[mailbox]
+    return sorted(threads, key=lambda uids: uids[-1], reverse=True)
+
@@ -0,0 +1,348 @@
+import os
+import json
+import time
+import uuid
+import random
+import sqlite3
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlparse
+
+from exporter import message_to_jsonl
+import metrics
+
+class WebhookStore:
+  """Subscriptions, the delivery outbox and the last seen UID in a SQLite database
+
+  Outbox rows are written in the same transaction that advances the last seen UID, so
+  every new message is queued exactly once and survives restarts until delivered. The
+  database file is created on first use, importing the app does not write it.
+
+  Args:
+    path: Database file path
+  """
+  def __init__(self, path: str):
+    self.path = path
+    self.local = threading.local()
+    self.created = False
+    self.create_lock = threading.Lock()
+
+  def exists(self) -> bool:
+    return self.created or os.path.exists(self.path)
+
+  def create(self, connection: sqlite3.Connection) -> None:
+    with self.create_lock:
+      if self.created:
+        return
+      with connection:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS subscriptions (id TEXT PRIMARY KEY, url TEXT NOT NULL, subject TEXT, sender TEXT, created_at REAL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id TEXT NOT NULL, url TEXT NOT NULL, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL, status TEXT NOT NULL DEFAULT \'pending\', last_error TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS mailboxes (mailbox TEXT PRIMARY KEY, uidvalidity INTEGER, last_uid INTEGER)')
+      self.created = True
+
+  def connection(self) -> sqlite3.Connection:
+    """Connection for the calling thread, sqlite3 connections can not be shared between threads"""
+    connection = getattr(self.local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=30)
+      connection.row_factory = sqlite3.Row
+      self.create(connection)
+      self.local.connection = connection
+    return connection
+
+  def add_subscription(self, url: str, subject: str = None, sender: str = None) -> dict:
+    subscription = {'id': uuid.uuid4().hex, 'url': url, 'subject': subject, 'sender': sender, 'created_at': time.time()}
+    with self.connection() as connection:
+      connection.execute('INSERT INTO subscriptions (id, url, subject, sender, created_at) VALUES (:id, :url, :subject, :sender, :created_at)', subscription)
+    return subscription
+
+  def remove_subscription(self, subscription_id: str) -> bool:
+    with self.connection() as connection:
+      deleted = connection.execute('DELETE FROM subscriptions WHERE id = ?', (subscription_id,)).rowcount
+      connection.execute('DELETE FROM outbox WHERE subscription_id = ?', (subscription_id,))
+    return deleted > 0
+
+  def subscriptions(self) -> list:
+    return [dict(row) for row in self.connection().execute('SELECT * FROM subscriptions ORDER BY created_at')]
+
+  def subscription(self, subscription_id: str):
+    """Returns:
+      Subscription with its pending and failed delivery counts, None if it does not exist
+    """
+    connection = self.connection()
+    row = connection.execute('SELECT * FROM subscriptions WHERE id = ?', (subscription_id,)).fetchone()
+    if row is None:
+      return None
+    counts = dict(connection.execute('SELECT status, COUNT(*) FROM outbox WHERE subscription_id = ? GROUP BY status', (subscription_id,)).fetchall())
+    return {**dict(row), 'pending': counts.get('pending', 0), 'failed': counts.get('failed', 0)}
+
+  def mailbox_state(self, mailbox: str) -> tuple:
+    """Returns:
+      Tuple (uidvalidity, last_uid), both None before the first poll
+    """
+    row = self.connection().execute('SELECT uidvalidity, last_uid FROM mailboxes WHERE mailbox = ?', (mailbox,)).fetchone()
+    return tuple(row) if row else (None, None)
+
+  def clear_mailbox_state(self, mailbox: str) -> None:
+    with self.connection() as connection:
+      connection.execute('DELETE FROM mailboxes WHERE mailbox = ?', (mailbox,))
+
+  def enqueue(self, mailbox: str, uidvalidity: int, last_uid: int, deliveries: list) -> None:
+    """Queue deliveries and advance the last seen UID in one transaction
+
+    Args:
+      deliveries: List of tuples (subscription, payload dict)
+    """
+    now = time.time()
+    with self.connection() as connection:
+      connection.executemany('INSERT INTO outbox (subscription_id, url, payload, next_attempt_at) VALUES (?, ?, ?, ?)',
+        [(subscription['id'], subscription['url'], json.dumps(payload), now) for subscription, payload in deliveries])
+      connection.execute('INSERT OR REPLACE INTO mailboxes (mailbox, uidvalidity, last_uid) VALUES (?, ?, ?)', (mailbox, uidvalidity, last_uid))
+
+  def due(self, limit: int = 1000) -> list:
+    rows = self.connection().execute("SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?", (time.time(), limit))
+    return [dict(row) for row in rows]
+
+  def delivered(self, delivery_id: int) -> None:
+    with self.connection() as connection:
+      connection.execute('DELETE FROM outbox WHERE id = ?', (delivery_id,))
+
+  def retry(self, delivery_id: int, attempts: int, next_attempt_at: float, error: str, failed: bool = False) -> None:
+    with self.connection() as connection:
+      connection.execute('UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, status = ? WHERE id = ?',
+        (attempts, next_attempt_at, error, 'failed' if failed else 'pending', delivery_id))
+
+  def postpone(self, url: str, delivery_ids: list) -> None:
+    """Move deliveries to the latest retry time of their URL without counting an attempt
+
+    Every undelivered row counts, a delivery that just ran out of attempts is failed
+    rather than pending but its URL still failed.
+    """
+    with self.connection() as connection:
+      connection.executemany("UPDATE outbox SET next_attempt_at = (SELECT MAX(next_attempt_at) FROM outbox WHERE url = ?) WHERE id = ?",
+        [(url, delivery_id) for delivery_id in delivery_ids])
+
+def message_matches(subscription: dict, message: dict) -> bool:
+  """Case insensitive substring match of the subscription subject and from filters"""
+  for key, field in (('subject', 'subject'), ('sender', 'from')):
+    expected = subscription.get(key)
+    if expected and expected.lower() not in (message.get(field) or '').lower():
+      return False
+  return True
+
+class WebhookManager:
+  """Detects new messages once for all subscriptions and POSTs them in batches
+
+  Each poll searches for UIDs above the last seen one, fetches the new messages once,
+  matches them against every subscription and queues one delivery per subscription and
+  batch in the outbox. A second thread sends the outbox, so slow receivers never hold up
+  polling. Failed deliveries are retried with exponential backoff, and after a failure the
+  rest of that URL's deliveries wait for its retry instead of being sent in the same round.
+
+  Args:
+    store: WebhookStore
+    session_factory: Callable returning a context manager that yields a logged in IMAPReader
+    lock: (optional) locks.LeaderLock, only the holder polls and delivers when several workers share the store
+    mailbox: (optional) Mailbox to watch. Defaults to INBOX
+    interval: (optional) Seconds between polls. Defaults to 30
+    retry_interval: (optional) Longest wait before checking the outbox for due retries. Defaults to 1
+    batch_size: (optional) Maximum messages per POST. Defaults to 50
+    concurrency: (optional) Maximum concurrent POSTs to one URL. Defaults to 2
+    max_attempts: (optional) Attempts before a delivery is marked failed. Defaults to 8
+    backoff: (optional) Seconds before the first retry, doubled on every attempt. Defaults to 5
+    max_backoff: (optional) Longest wait between attempts. Defaults to 3600
+    timeout: (optional) Seconds to wait for a receiver. Defaults to 10
+  """
+  def __init__(self, store: WebhookStore, session_factory, lock=None, mailbox: str = 'INBOX', interval: float = 30, retry_interval: float = 1,
+      batch_size: int = 50, concurrency: int = 2, max_attempts: int = 8, backoff: float = 5, max_backoff: float = 3600, timeout: float = 10):
+    self.store = store
+    self.session_factory = session_factory
+    self.lock = lock
+    self.mailbox = mailbox
+    self.interval = interval
+    self.retry_interval = retry_interval
+    self.batch_size = batch_size
+    self.concurrency = concurrency
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.timeout = timeout
+    self.executor = None
+    self.stopped = threading.Event()
+    # Set when a poll queued deliveries, so they are sent without waiting for retry_interval
+    self.queued = threading.Event()
+    self.threads = []
+    self.start_lock = threading.Lock()
+
+  def subscribe(self, url: str, subject: str = None, sender: str = None) -> dict:
+    """Raises:
+      ValueError: If the URL is not http(s)
+    """
+    parsed_url = urlparse(url or '')
+    if parsed_url.scheme not in ('http', 'https') or not parsed_url.netloc:
+      raise ValueError("url must be an http or https URL")
+    return self.store.add_subscription(url, subject, sender)
+
+  def start(self) -> None:
+    """Start the poll and delivery threads, does nothing if they are running"""
+    with self.start_lock:
+      if self.threads:
+        return
+      self.threads = [
+        threading.Thread(target=self.run, name='webhooks', daemon=True),
+        threading.Thread(target=self.run_deliveries, name='webhook-deliveries', daemon=True),
+      ]
+      for thread in self.threads:
+        thread.start()
+
+  def stop(self) -> None:
+    self.stopped.set()
+    self.queued.set()
+    for thread in self.threads:
+      thread.join(timeout=5)
+    if self.lock is not None:
+      self.lock.release()
+
+  def run(self) -> None:
+    while not self.stopped.is_set():
+      if self.lock is None or self.lock.acquire():
+        try:
+          if self.poll():
+            self.queued.set()
+        except Exception:
+          logging.exception("WebhookManager -> run : poll failed")
+          metrics.increment('webhook_poll_failed')
+      self.stopped.wait(self.interval)
+
+  def run_deliveries(self) -> None:
+    while not self.stopped.is_set():
+      # The poll thread takes the lock, deliveries follow it
+      if self.lock is None or self.lock.held:
+        try:
+          self.deliver()
+        except Exception:
+          logging.exception("WebhookManager -> run_deliveries : delivery failed")
+      self.queued.wait(self.retry_interval)
+      self.queued.clear()
+
+  def poll(self) -> int:
+    """Queue deliveries for messages that arrived since the last poll
+
+    The first poll only records the newest UID, messages already in the mailbox are not sent.
+
+    Returns:
+      Number of new messages
+    """
+    subscriptions = self.store.subscriptions()
+    if not subscriptions:
+      # Nobody is listening, the next subscriber starts from the mail arriving after it
+      if self.store.mailbox_state(self.mailbox) != (None, None):
+        self.store.clear_mailbox_state(self.mailbox)
+      return 0
+
+    uidvalidity, last_uid = self.store.mailbox_state(self.mailbox)
+    with self.session_factory() as reader:
+      reader.select_mailbox_and_get_email_count_in_mailbox(self.mailbox)
+      if last_uid is None or uidvalidity != reader.uidvalidity:
+        uids = reader.search_uids()
+        self.store.enqueue(self.mailbox, reader.uidvalidity, uids[-1] if uids else 0, [])
+        return 0
+      # n:* always matches the newest message, even when its UID is below n
+      new_uids = [uid for uid in reader.search_uids('UID', f"{last_uid + 1}:*") if uid > last_uid]
+      if not new_uids:
+        return 0
+
+      messages = []
+      for index in range(0, len(new_uids), self.batch_size):
+        for uid, raw_message in reader.fetch_raw_messages(new_uids[index:index + self.batch_size]):
+          messages.append(json.loads(message_to_jsonl(reader, uid, raw_message)))
+      uidvalidity = reader.uidvalidity
+
+    # Match every message against every subscription in one pass
+    matched = {subscription['id']: [] for subscription in subscriptions}
+    for message in messages:
+      for subscription in subscriptions:
+        if message_matches(subscription, message):
+          matched[subscription['id']].append(message)
+
+    deliveries = []
+    for subscription in subscriptions:
+      subscription_messages = matched[subscription['id']]
+      for index in range(0, len(subscription_messages), self.batch_size):
+        deliveries.append((subscription, {
+          'subscription_id': subscription['id'],
+          'mailbox': self.mailbox,
+          'messages': subscription_messages[index:index + self.batch_size],
+        }))
+    self.store.enqueue(self.mailbox, uidvalidity, new_uids[-1], deliveries)
+    metrics.increment('webhook_messages', len(messages))
+    metrics.increment('webhook_deliveries_queued', len(deliveries))
+    logging.debug(f"WebhookManager -> poll : {len(messages)} new messages, {len(deliveries)} deliveries")
+    return len(messages)
+
+  def deliver(self) -> None:
+    """Send every due delivery, at most concurrency at a time per URL, and wait for them
+
+    The first failure to a URL ends its round, the deliveries not yet sent are postponed
+    to its retry so an unreachable receiver costs at most concurrency timeouts per round.
+    """
+    queues = {}
+    for delivery in self.store.due():
+      queues.setdefault(delivery['url'], deque()).append(delivery)
+    failed_urls = set()
+
+    def drain(url, queue):
+      while url not in failed_urls:
+        try:
+          delivery = queue.popleft()
+        except IndexError:
+          return
+        if not self.send(delivery):
+          failed_urls.add(url)
+
+    if not queues:
+      return
+    if self.executor is None:
+      # Created on the first delivery, most instances never send a webhook
+      from concurrent.futures import ThreadPoolExecutor
+      self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='webhook')
+    futures = [self.executor.submit(drain, url, queue) for url, queue in queues.items() for _ in range(min(self.concurrency, len(queue)))]
+    for future in futures:
+      future.result()
+    for url in failed_urls:
+      if queues[url]:
+        self.store.postpone(url, [delivery['id'] for delivery in queues[url]])
+
+  def send(self, delivery: dict) -> bool:
+    """POST one delivery, on failure it is rescheduled with backoff
+
+    Returns:
+      True if the receiver answered with a 2xx status
+    """
+    import http.client
+    import urllib.error
+    import urllib.request
+    payload = json.loads(delivery['payload'])
+    payload['delivery_id'] = delivery['id']
+    request = urllib.request.Request(
+      delivery['url'],
+      data=json.dumps(payload).encode('utf-8'),
+      headers={'Content-Type': 'application/json', 'X-Webhook-Delivery': str(delivery['id'])},
+      method='POST'
+    )
+    try:
+      with urllib.request.urlopen(request, timeout=self.timeout):
+        pass
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as error:
+      attempts = delivery['attempts'] + 1
+      failed = attempts >= self.max_attempts
+      delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff) * random.uniform(0.5, 1)
+      self.store.retry(delivery['id'], attempts, time.time() + delay, str(error), failed)
+      metrics.increment('webhook_deliveries_failed' if failed else 'webhook_deliveries_retried')
+      logging.debug(f"WebhookManager -> send : delivery {delivery['id']} attempt {attempts} failed {error}")
+      return False
+    self.store.delivered(delivery['id'])
+    metrics.increment('webhook_deliveries_sent')
+    return True